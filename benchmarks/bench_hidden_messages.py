@@ -0,0 +1,69 @@
+"""Inline `hide` query throughput: a row per keystroke (old) vs in-memory drafts (now).
+
+Run from the repository root: python benchmarks/bench_hidden_messages.py
+Only the storage part of handle_inline_hide is measured, no Telegram round trip.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+MESSAGE = "встретимся завтра у входа в парк в семь вечера"
+
+
+def keystrokes(users: int):
+    """Every prefix of MESSAGE for each user, as Telegram sends them while typing."""
+    for user_id in range(users):
+        for length in range(1, len(MESSAGE) + 1):
+            yield user_id, MESSAGE[:length]
+
+
+async def row_per_keystroke(users: int) -> int:
+    count = 0
+    for user_id, text in keystrokes(users):
+        async with aiosqlite.connect(main.DB_NAME) as db:
+            await db.execute('''
+                INSERT INTO hidden_messages (message_id, chat_id, creator_id, target_user_id, message_text)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (str(uuid4()), user_id, user_id, 1, text))
+            await db.commit()
+        count += 1
+    return count
+
+
+async def drafts_in_memory(users: int) -> int:
+    count = 0
+    for user_id, text in keystrokes(users):
+        message_id = main.create_hidden_draft(user_id, 1, text)
+        count += 1
+    # One send per typed message is what reaches the database.
+    main.store_hidden_message(message_id)
+    await main.db_writer.flush()
+    return count
+
+
+async def run():
+    await main.init_db()
+    await main.run_migrations()
+    for name, bench, users in (('row per keystroke', row_per_keystroke, 20), ('in-memory drafts', drafts_in_memory, 2000)):
+        started_at = time.perf_counter()
+        count = await bench(users)
+        elapsed = time.perf_counter() - started_at
+        async with aiosqlite.connect(main.DB_NAME) as db:
+            cursor = await db.execute('SELECT COUNT(*) FROM hidden_messages')
+            rows = (await cursor.fetchone())[0]
+            await db.execute('DELETE FROM hidden_messages')
+            await db.commit()
+        print(f"{name:>18}: {count / elapsed:10.0f} queries/s, {rows} rows for {users} messages")
+
+
+if __name__ == '__main__':
+    os.chdir(tempfile.mkdtemp())
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+"""Spam tracker memory per tracked user and is_spam checks/s: per-user deque (old) vs ring buffer (now).
+
+Run from the repository root: python benchmarks/bench_message_tracker.py [users]
+Memory is traced with tracemalloc in one pass, speed is timed in another without it.
+"""
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+class DequeTracker:
+    """MessageTracker as it was: a deque of datetimes per user, never dropped."""
+
+    def __init__(self, message_limit: int = 3, time_window: int = 5):
+        self.message_limit = message_limit
+        self.time_window = time_window
+        self.user_messages: Dict[int, deque] = {}
+
+    def is_spam(self, user_id: int) -> bool:
+        if user_id not in self.user_messages:
+            self.user_messages[user_id] = deque()
+
+        messages = self.user_messages[user_id]
+        current_time = datetime.now()
+
+        while messages and (current_time - messages[0]) > timedelta(seconds=self.time_window):
+            messages.popleft()
+
+        if len(messages) >= self.message_limit:
+            return True
+
+        messages.append(current_time)
+        return False
+
+
+def check_all(tracker, users: int) -> None:
+    for user_id in range(users):
+        tracker.is_spam(user_id)
+
+
+def run(users: int) -> None:
+    for name, factory in (('deque', DequeTracker), ('ring buffer', main.MessageTracker)):
+        tracemalloc.start()
+        tracker = factory()
+        check_all(tracker, users)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del tracker
+
+        tracker = factory()
+        started_at = time.perf_counter()
+        check_all(tracker, users)
+        elapsed = time.perf_counter() - started_at
+        print(f"{name:>11}: {memory / users:6.0f} bytes per user, {users / elapsed:10.0f} checks/s ({users} users)")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -3,14 +3,20 @@ import aiosqlite
 import html
 import re
 import json
+import csv
 import os
 import time
 import uuid
+import hashlib
+import secrets
 import logging
 import io
+import gzip
+import zlib
 import platform
-from typing import List, Set, Dict, Optional, Deque
-from collections import deque
+from typing import List, Set, Dict, Optional
+from array import array
+from collections import OrderedDict, Counter
 from datetime import datetime, timedelta
 from uuid import uuid4
 from html import escape
@@ -19,6 +25,7 @@ import requests
 import aiohttp
 
 import random
+import heapq
 import numpy as np
 import psutil
 import matplotlib.pyplot as plt
@@ -29,10 +36,11 @@ from aiohttp import ClientSession
 from PyCharacterAI import get_client
 from PyCharacterAI.exceptions import SessionClosedError
 
-from aiogram import Bot, Dispatcher, types, Router, F
+from aiogram import Bot, Dispatcher, types, Router, F, BaseMiddleware
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ChatType, ChatMemberStatus, ChatAction
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
@@ -47,7 +55,7 @@ from aiogram.types import (
     ChatPermissions
 )
 from aiogram.filters import BaseFilter
-from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent, ChosenInlineResult
 from aiogram.utils.markdown import hbold
 import traceback
 
@@ -56,6 +64,9 @@ logging.basicConfig(level=logging.INFO)
 router = Router()
 
 DB_NAME = 'database.db'
+HISTORY_SHARDS = 0 # message_history shard files (0 - keep it in DB_NAME)
+HISTORY_SHARD_DIR = 'shards'
+COMPRESS_MESSAGE_TEXT = False # store message_history.message_text as dictionary-compressed BLOBs
 REQUIRED_MESSAGES = 1
 ADMIN_USER_ID = 7777 # ADMIN ID
 STICKER_IDS = [] # STICKER IDS (OPTION)
@@ -65,14 +76,16 @@ LOCAL_GIFS = {} # LOCAL GIFTS (OPTION)
 async def init_db():
     """Init DB"""
     async with aiosqlite.connect(DB_NAME) as db:
+        # Readers (backups, exports, stats) then never block writers. The mode persists in the file.
+        await db.execute('PRAGMA journal_mode=WAL')
         await db.execute('''
             CREATE TABLE IF NOT EXISTS message_history (
+                id INTEGER PRIMARY KEY,
                 chat_id INTEGER,
                 user_id INTEGER,
                 target_user_id INTEGER DEFAULT NULL,
                 message_text TEXT,
-                timestamp INTEGER,
-                PRIMARY KEY (chat_id, timestamp)
+                timestamp INTEGER
             )
         ''')
         
@@ -191,11 +204,419 @@ async def init_db():
                 chat_id INTEGER,
                 creator_id INTEGER,
                 target_user_id INTEGER,
-                message_text TEXT
+                message_text TEXT,
+                created_at INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS media_files (
+                path TEXT PRIMARY KEY,
+                content_hash TEXT,
+                file_id TEXT,
+                uploaded_at INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                chat_id INTEGER,
+                day TEXT,
+                message_count INTEGER DEFAULT 0,
+                PRIMARY KEY (chat_id, day)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS group_storage_policy (
+                chat_id INTEGER PRIMARY KEY,
+                policy TEXT DEFAULT 'full',
+                sample_rate REAL DEFAULT 0.1
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS purge_jobs (
+                user_id INTEGER PRIMARY KEY,
+                status TEXT DEFAULT 'running',
+                deleted_rows INTEGER DEFAULT 0,
+                admin_chat_id INTEGER,
+                progress_message_id INTEGER,
+                started_at INTEGER,
+                finished_at INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS group_retention (
+                chat_id INTEGER PRIMARY KEY,
+                retention_days INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS compression_dicts (
+                id INTEGER PRIMARY KEY,
+                data BLOB,
+                created_at INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS word_sketches (
+                chat_id INTEGER,
+                day TEXT,
+                sketch BLOB,
+                PRIMARY KEY (chat_id, day)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS top_words (
+                chat_id INTEGER,
+                day TEXT,
+                word TEXT,
+                count INTEGER,
+                PRIMARY KEY (chat_id, day, word)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS distinct_counters (
+                chat_id INTEGER,
+                day TEXT,
+                words BLOB,
+                users BLOB,
+                PRIMARY KEY (chat_id, day)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS history_layout (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                shards INTEGER
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS group_latency (
+                chat_id INTEGER PRIMARY KEY,
+                max_latency REAL
             )
         ''')
         await db.commit()
         
+async def column_exists(db: aiosqlite.Connection, table: str, column: str) -> bool:
+    cursor = await db.execute(f'PRAGMA table_info({table})')
+    return any(row[1] == column for row in await cursor.fetchall())
+
+async def migrate_hidden_messages_created_at(db: aiosqlite.Connection):
+    if not await column_exists(db, 'hidden_messages', 'created_at'):
+        await db.execute('ALTER TABLE hidden_messages ADD COLUMN created_at INTEGER')
+    await db.execute(
+        'UPDATE hidden_messages SET created_at = ? WHERE created_at IS NULL',
+        (int(time.time()),)
+    )
+
+async def migrate_premium_end_date_epoch(db: aiosqlite.Connection):
+    cursor = await db.execute(
+        "SELECT group_id, end_date FROM premium_groups WHERE typeof(end_date) = 'text'"
+    )
+    for group_id, end_date in await cursor.fetchall():
+        await db.execute(
+            'UPDATE premium_groups SET end_date = ? WHERE group_id = ?',
+            (int(datetime.fromisoformat(end_date).timestamp()), group_id)
+        )
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_premium_groups_end_date ON premium_groups (end_date)')
+
+async def migrate_history_user_index(db: aiosqlite.Connection):
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user ON message_history (user_id, chat_id)')
+
+async def migrate_history_chat_user_index(db: aiosqlite.Connection):
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_message_history_chat_user_time ON message_history (chat_id, user_id, timestamp)'
+    )
+
+async def migrate_blocked_at_indexes(db: aiosqlite.Connection):
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_blocked_stickers_time ON blocked_stickers (group_id, blocked_at)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_blocked_packs_time ON blocked_packs (group_id, blocked_at)')
+
+HISTORY_REKEY_CHUNK_SIZE = 5000
+
+async def migrate_history_rowid_key(db: aiosqlite.Connection):
+    """Copy message_history into a table keyed by an explicit id, one chunk per transaction.
+
+    Rows keep their rowid as id. Only the tail inserted during the copy is moved in the
+    final IMMEDIATE transaction, so ingestion waits for that swap instead of the whole copy.
+    Nothing deletes or updates history before migrations_done is set, so copied rows stay
+    current, and a restart resumes after the last copied id.
+    """
+    if not await column_exists(db, 'message_history', 'id'):
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS message_history_new (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER,
+                user_id INTEGER,
+                target_user_id INTEGER DEFAULT NULL,
+                message_text TEXT,
+                timestamp INTEGER
+            )
+        ''')
+        await db.commit()
+        copy_sql = '''
+            INSERT INTO message_history_new (id, chat_id, user_id, target_user_id, message_text, timestamp)
+            SELECT rowid, chat_id, user_id, target_user_id, message_text, timestamp
+            FROM message_history
+            WHERE rowid > (SELECT COALESCE(MAX(id), 0) FROM message_history_new)
+            ORDER BY rowid
+        '''
+        while True:
+            cursor = await db.execute(copy_sql + ' LIMIT ?', (HISTORY_REKEY_CHUNK_SIZE,))
+            await db.commit()
+            if cursor.rowcount < HISTORY_REKEY_CHUNK_SIZE:
+                break
+            # Let ingestion writers in between chunks.
+            await asyncio.sleep(0.05)
+
+        # Concurrent inserts wait for the swap instead of landing in the old table.
+        await db.execute('BEGIN IMMEDIATE')
+        await db.execute(copy_sql)
+        await db.execute('DROP TABLE message_history')
+        await db.execute('ALTER TABLE message_history_new RENAME TO message_history')
+
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_message_history_chat_time ON message_history (chat_id, timestamp)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user ON message_history (user_id, chat_id)')
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_message_history_chat_user_time ON message_history (chat_id, user_id, timestamp)'
+    )
+
+async def migrate_daily_stats_backfill(db: aiosqlite.Connection):
+    await db.execute('''
+        INSERT OR REPLACE INTO daily_stats (chat_id, day, message_count)
+        SELECT chat_id, date(timestamp / 1000000, 'unixepoch'), COUNT(*)
+        FROM message_history
+        GROUP BY 1, 2
+    ''')
+
+async def create_search_index(db: aiosqlite.Connection):
+    """FTS5 index over message_history plus the queue that SearchIndexer drains.
+
+    The triggers only append to search_index_queue in the writer's own transaction;
+    tokenizing happens later, in batches. A delete of a row that was never indexed
+    just cancels its pending insert. chat_tag makes the chat filter part of the
+    MATCH, so a common word is not ranked across every group first.
+    """
+    await db.execute('''
+        CREATE VIEW IF NOT EXISTS message_search_content AS
+        SELECT id, 'c' || replace(chat_id, '-', 'm') AS chat_tag, message_text
+        FROM message_history
+    ''')
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+            chat_tag,
+            message_text,
+            content='message_search_content',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS search_index_queue (
+            seq INTEGER PRIMARY KEY,
+            row_id INTEGER,
+            op INTEGER,
+            chat_id INTEGER,
+            message_text
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_search_index_queue_row ON search_index_queue (row_id)')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_history_search_insert AFTER INSERT ON message_history
+        WHEN new.message_text IS NOT NULL
+        BEGIN
+            INSERT INTO search_index_queue (row_id, op) VALUES (new.id, 1);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_history_search_delete AFTER DELETE ON message_history
+        WHEN old.message_text IS NOT NULL
+        BEGIN
+            INSERT INTO search_index_queue (row_id, op, chat_id, message_text)
+            SELECT old.id, 0, old.chat_id, old.message_text
+            WHERE NOT EXISTS (SELECT 1 FROM search_index_queue WHERE row_id = old.id AND op = 1);
+            DELETE FROM search_index_queue WHERE row_id = old.id AND op = 1;
+        END
+    ''')
+
+async def migrate_distinct_words_backfill(db: aiosqlite.Connection):
+    """Seed the all-time distinct-words HyperLogLog of every chat from the words table."""
+    chat_id, registers = None, None
+    cursor = await db.execute('SELECT chat_id, word FROM words ORDER BY chat_id')
+    async for row_chat_id, word in cursor:
+        if row_chat_id != chat_id:
+            if registers:
+                await distinct_counters.merge_row(db, chat_id, DistinctCounters.ALL_TIME, registers)
+            chat_id, registers = row_chat_id, {kind: HyperLogLog() for kind in DistinctCounters.KINDS}
+        registers['words'].add(word)
+    if registers:
+        await distinct_counters.merge_row(db, chat_id, DistinctCounters.ALL_TIME, registers)
+
+async def migrate_history_target_index(db: aiosqlite.Connection):
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_message_history_target ON message_history (target_user_id) '
+        'WHERE target_user_id IS NOT NULL'
+    )
+
+async def migrate_hidden_messages_creator_index(db: aiosqlite.Connection):
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_hidden_messages_creator ON hidden_messages (creator_id, target_user_id, created_at)'
+    )
+
+async def migrate_purge_indexes(db: aiosqlite.Connection):
+    # hidden_messages.creator_id is already covered by idx_hidden_messages_creator.
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_hidden_messages_target ON hidden_messages (target_user_id)')
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_pending_free_premium_user ON pending_free_premium_requests (user_id)'
+    )
+
+async def migrate_search_index(db: aiosqlite.Connection):
+    await create_search_index(db)
+    await db.execute('''
+        INSERT INTO search_index_queue (row_id, op)
+        SELECT id, 1 FROM message_history
+        WHERE message_text IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM search_index_queue)
+        ORDER BY id
+    ''')
+
+# (version, description, migration, blocking). Never reorder or edit applied entries, only append.
+# Blocking migrations finish before polling starts; the rest continue in the background.
+# The words backfill (9) blocks: /stats shows its all-time row, and DistinctCounters.flush
+# would overwrite it with a merge of the row read before the backfill committed.
+MIGRATIONS = [
+    (1, 'hidden_messages.created_at', migrate_hidden_messages_created_at, True),
+    (2, 'premium_groups.end_date as epoch', migrate_premium_end_date_epoch, True),
+    (3, 'message_history user index', migrate_history_user_index, False),
+    (4, 'message_history chat/user/time index', migrate_history_chat_user_index, False),
+    (5, 'blocked stickers/packs time indexes', migrate_blocked_at_indexes, False),
+    (6, 'message_history rowid key', migrate_history_rowid_key, False),
+    (7, 'daily_stats backfill', migrate_daily_stats_backfill, False),
+    (8, 'message_history full-text index', migrate_search_index, False),
+    (9, 'all-time distinct words backfill', migrate_distinct_words_backfill, True),
+    (10, 'message_history target_user_id index', migrate_history_target_index, False),
+    (11, 'hidden_messages creator index', migrate_hidden_messages_creator_index, False),
+    (12, 'purge lookup indexes', migrate_purge_indexes, False),
+]
+
+migrations_done = asyncio.Event()
+
+async def run_migrations(blocking_only: bool = False) -> int:
+    """Apply pending MIGRATIONS; with ``blocking_only`` just the blocking ones, wherever they are in the list.
+
+    A blocking migration can thus run before older background ones, so applied versions
+    are recorded one by one in schema_migrations. user_version is the highest version
+    with everything up to it applied, and every version up to it counts as applied.
+    """
+    async with aiosqlite.connect(DB_NAME) as db:
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at INTEGER
+            )
+        ''')
+        cursor = await db.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+        cursor = await db.execute('SELECT version FROM schema_migrations WHERE version > ?', (version,))
+        applied = {row[0] for row in await cursor.fetchall()}
+
+        for target, description, migrate, blocking in MIGRATIONS:
+            if target <= version or target in applied:
+                continue
+            if blocking_only and not blocking:
+                continue
+
+            started_at = time.monotonic()
+            await migrate(db)
+            await db.execute(
+                'INSERT OR REPLACE INTO schema_migrations (version, applied_at) VALUES (?, ?)',
+                (target, int(time.time()))
+            )
+            applied.add(target)
+            while version + 1 in applied:
+                version += 1
+            await db.execute(f'PRAGMA user_version = {version}')
+            await db.commit()
+            logger.info(f"Applied migration {target} ({description}) in {time.monotonic() - started_at:.2f}s")
+
+    if not blocking_only:
+        migrations_done.set()
+    return version
+
+def parse_end_date(value) -> datetime:
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(value)
+
+class BatchWriter:
+    """Queues small writes and commits them together in one transaction."""
+
+    def __init__(self, db_name: str, flush_interval: float = 1.0, max_batch: int = 500):
+        self.db_name = db_name
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue: List[tuple] = []
+        self.flush_lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+
+    def enqueue(self, sql: str, params: tuple = ()) -> None:
+        self.queue.append((sql, params))
+        if len(self.queue) >= self.max_batch:
+            self.wakeup.set()
+
+    async def flush(self) -> int:
+        """Commit the queued writes. A failing statement is logged and skipped; the rest of the
+        batch still commits. If the batch can't be committed at all (locked DB, I/O error), it
+        goes back to the front of the queue for the next flush and the error is re-raised."""
+        async with self.flush_lock:
+            if not self.queue:
+                return 0
+            batch, self.queue = self.queue, []
+            try:
+                async with aiosqlite.connect(self.db_name) as db:
+                    for sql, params in batch:
+                        try:
+                            await db.execute(sql, params)
+                        except aiosqlite.IntegrityError as e:
+                            self.skip(sql, params, e)
+                        except aiosqlite.OperationalError as e:
+                            # Lock and I/O errors abort the whole transaction; only statement errors are skippable.
+                            if 'is locked' in str(e) or 'disk' in str(e):
+                                raise
+                            self.skip(sql, params, e)
+                    await db.commit()
+            except Exception:
+                self.queue[:0] = batch
+                raise
+            return len(batch)
+
+    @staticmethod
+    def skip(sql: str, params: tuple, error: Exception) -> None:
+        logging.error(f"Пропущен запрос пакетной записи: {error}\n{' '.join(sql.split())} {params}")
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка пакетной записи в БД: {e}")
+
+db_writer = BatchWriter(DB_NAME)
+
 async def should_send_daily_media(chat_id: int) -> bool:
     current_date = datetime.now().date()
     
@@ -224,6 +645,84 @@ async def update_last_media_timestamp(chat_id: int):
         ''', (chat_id, current_timestamp))
         await db.commit()
 
+# Bot API errors meaning the stored file_id itself is unusable; anything else is not fixed by re-uploading.
+STALE_FILE_ID_ERRORS = ('file identifier', 'file_id', 'file reference', 'wrong type of', "can't use file of type")
+
+class MediaRegistry:
+    """Uploads each local file once and reuses Telegram's file_id afterwards.
+
+    Entries are keyed by path and content hash, so an edited file is
+    uploaded again. The hash is only recomputed when mtime or size change.
+    """
+
+    def __init__(self):
+        self.file_ids: Dict[str, tuple] = {}
+        self.file_stats: Dict[str, tuple] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self.file_stats.get(path)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        self.file_stats[path] = ((stat.st_mtime_ns, stat.st_size), content_hash)
+        return content_hash
+
+    async def get_file_id(self, path: str, content_hash: str) -> Optional[str]:
+        if path not in self.file_ids:
+            async with aiosqlite.connect(DB_NAME) as db:
+                cursor = await db.execute(
+                    'SELECT content_hash, file_id FROM media_files WHERE path = ?',
+                    (path,)
+                )
+                row = await cursor.fetchone()
+            self.file_ids[path] = tuple(row) if row else (None, None)
+
+        cached_hash, file_id = self.file_ids[path]
+        return file_id if cached_hash == content_hash else None
+
+    async def store_file_id(self, path: str, content_hash: str, file_id: str) -> None:
+        self.file_ids[path] = (content_hash, file_id)
+        async with aiosqlite.connect(DB_NAME) as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO media_files (path, content_hash, file_id, uploaded_at)
+                VALUES (?, ?, ?, ?)
+            ''', (path, content_hash, file_id, int(time.time())))
+            await db.commit()
+
+    async def send(self, path: str, send_func):
+        """Call ``send_func(media)`` with a cached file_id or a fresh upload."""
+        content_hash = self.content_hash(path)
+        file_id = await self.get_file_id(path, content_hash)
+
+        if file_id:
+            try:
+                result = await send_func(file_id)
+                self.hits += 1
+                return result
+            except TelegramBadRequest as e:
+                if not any(marker in e.message.lower() for marker in STALE_FILE_ID_ERRORS):
+                    raise
+                logging.error(f"Cached file_id for {path} rejected, re-uploading: {e}")
+
+        self.misses += 1
+        result = await send_func(FSInputFile(path))
+        media = result.animation or result.video or result.document or result.photo
+        if isinstance(media, list):
+            media = media[-1]
+        if media:
+            await self.store_file_id(path, content_hash, media.file_id)
+        return result
+
+media_registry = MediaRegistry()
+
 async def send_random_daily_media(message: types.Message):
     try:
         if not await should_send_daily_media(message.chat.id):
@@ -243,11 +742,12 @@ async def send_random_daily_media(message: types.Message):
                     print(f"File not found: {random_gif_path}")
                     return
                     
-                gif = FSInputFile(random_gif_path)
-                
-                await message.bot.send_animation(
-                    chat_id=message.chat.id,
-                    animation=gif
+                await media_registry.send(
+                    random_gif_path,
+                    lambda gif: message.bot.send_animation(
+                        chat_id=message.chat.id,
+                        animation=gif
+                    )
                 )
             except Exception as e:
                 print(f"Error sending GIF.")
@@ -257,41 +757,546 @@ async def send_random_daily_media(message: types.Message):
     except Exception as e:
         print(f"Error sending daily media.")
 
-async def save_message_history(chat_id: int, user_id: int, message_text: str, target_user_id: Optional[int] = None):
-    current_time = datetime.now()
-    current_timestamp = int(current_time.timestamp() * 1000000)
+class MonotonicClock:
+    """Microsecond timestamps that never repeat or go backwards within the process."""
 
-    async with aiosqlite.connect(DB_NAME) as db:
-        try:
+    def __init__(self):
+        self.last = 0
+
+    def now_us(self) -> int:
+        timestamp = time.time_ns() // 1000
+        if timestamp <= self.last:
+            timestamp = self.last + 1
+        self.last = timestamp
+        return timestamp
+
+message_clock = MonotonicClock()
+
+STORAGE_POLICIES = ['full', 'sampled', 'counters']
+STORAGE_POLICY_LABELS = {'full': 'полностью', 'sampled': 'выборочно', 'counters': 'только счётчики'}
+DEFAULT_SAMPLE_RATE = 0.1
+
+class StoragePolicies:
+    """Per-group choice of what group_message_handler persists, cached in memory."""
+
+    def __init__(self):
+        self.policies: Dict[int, tuple] = {}
+
+    async def get(self, chat_id: int) -> tuple:
+        policy = self.policies.get(chat_id)
+        if policy is None:
+            async with aiosqlite.connect(DB_NAME) as db:
+                cursor = await db.execute(
+                    'SELECT policy, sample_rate FROM group_storage_policy WHERE chat_id = ?',
+                    (chat_id,)
+                )
+                row = await cursor.fetchone()
+            policy = self.policies[chat_id] = tuple(row) if row else ('full', DEFAULT_SAMPLE_RATE)
+        return policy
+
+    async def set(self, chat_id: int, policy: str, sample_rate: float = DEFAULT_SAMPLE_RATE) -> None:
+        async with aiosqlite.connect(DB_NAME) as db:
+            await db.execute('''
+                INSERT OR REPLACE INTO group_storage_policy (chat_id, policy, sample_rate)
+                VALUES (?, ?, ?)
+            ''', (chat_id, policy, sample_rate))
+            await db.commit()
+        self.policies[chat_id] = (policy, sample_rate)
+
+    async def should_store_text(self, chat_id: int) -> bool:
+        policy, sample_rate = await self.get(chat_id)
+        if policy == 'counters':
+            return False
+        if policy == 'sampled':
+            return random.random() < sample_rate
+        return True
+
+storage_policies = StoragePolicies()
+
+HISTORY_MOVE_CHUNK_SIZE = 1000
+
+class HistoryShards:
+    """Spreads message_history over N SQLite files by chat_id, each with its own writer connection.
+
+    A chat always lives in shard ``chat_id % N``. With N = 0 everything stays in DB_NAME.
+    DB_NAME is also part of every fan-out, since rows written before sharding was enabled
+    are moved out of it in the background; until a shard's move is done, reads of its
+    chats (paths_for) cover DB_NAME as well.
+    """
+
+    def __init__(self, count: int, directory: str):
+        self.count = count
+        self.directory = directory
+        self.writers: Dict[int, aiosqlite.Connection] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.moved: Set[int] = set()
+        # Held per moved chunk, so pause() never splits one between DB_NAME and a shard.
+        self.move_lock = asyncio.Lock()
+
+    def shard_paths(self) -> List[str]:
+        return [os.path.join(self.directory, f"history-{index:02d}.db") for index in range(self.count)]
+
+    def paths(self) -> List[str]:
+        return [DB_NAME] + self.shard_paths()
+
+    def path_for(self, chat_id: int) -> str:
+        if not self.count:
+            return DB_NAME
+        return self.shard_paths()[chat_id % self.count]
+
+    def paths_for(self, chat_id: int) -> List[str]:
+        """Files holding the chat's history: DB_NAME (first) too while its shard's move is unfinished."""
+        path = self.path_for(chat_id)
+        if path == DB_NAME or chat_id % self.count in self.moved:
+            return [path]
+        return [DB_NAME, path]
+
+    async def iter_chunks(self, chat_id: int, sql: str, after: tuple, chunk_size: int):
+        """Yield the rows of a keyset query over paths_for(chat_id), in (timestamp, id) order.
+
+        ``sql`` selects ``id, timestamp, ...`` of chat_id after (timestamp, id) with the
+        parameters (chat_id, timestamp, id, limit). With two files, a chunk only goes up to
+        the last key of every file that filled its limit, and rows moved between the two
+        reads (DB_NAME is read first, so they are seen twice, not missed) are yielded once.
+        """
+        paths = self.paths_for(chat_id)
+        while True:
+            rows, bound = [], None
+            for path in paths:
+                async with aiosqlite.connect(path) as db:
+                    cursor = await db.execute(sql, (chat_id, *after, chunk_size))
+                    part = await cursor.fetchall()
+                rows.extend(part)
+                if len(part) == chunk_size:
+                    key = (part[-1][1], part[-1][0])
+                    bound = key if bound is None else min(bound, key)
+            if not rows:
+                return
+            if len(paths) > 1:
+                rows = sorted({row[0]: row for row in rows}.values(), key=lambda row: (row[1], row[0]))
+                if bound is not None:
+                    rows = [row for row in rows if (row[1], row[0]) <= bound]
+            after = (rows[-1][1], rows[-1][0])
+            yield rows
+
+    async def init(self):
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute('SELECT shards FROM history_layout WHERE id = 1')
+            row = await cursor.fetchone()
+            if row and row[0] != self.count:
+                logging.error(f"HISTORY_SHARDS={self.count} игнорируется: история уже разбита на {row[0]} шардов")
+                self.count = row[0]
+            elif not row and self.count:
+                await db.execute('INSERT INTO history_layout (id, shards) VALUES (1, ?)', (self.count,))
+                await db.commit()
+
+            cursor = await db.execute('SELECT COALESCE(MAX(rowid), 0) FROM message_history')
+            max_id = (await cursor.fetchone())[0]
+
+        if self.count:
+            os.makedirs(self.directory, exist_ok=True)
+        for path in self.shard_paths():
+            async with aiosqlite.connect(path) as db:
+                await db.execute('PRAGMA journal_mode=WAL')
+                await db.execute('''
+                    CREATE TABLE IF NOT EXISTS message_history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER,
+                        user_id INTEGER,
+                        target_user_id INTEGER DEFAULT NULL,
+                        message_text TEXT,
+                        timestamp INTEGER
+                    )
+                ''')
+                await db.execute('CREATE INDEX IF NOT EXISTS idx_message_history_chat_time ON message_history (chat_id, timestamp)')
+                await db.execute('CREATE INDEX IF NOT EXISTS idx_message_history_user ON message_history (user_id, chat_id)')
+                await db.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_message_history_chat_user_time ON message_history (chat_id, user_id, timestamp)'
+                )
+                await migrate_history_target_index(db)
+                await create_search_index(db)
+                # New ids start above DB_NAME's, so rows moved from there keep theirs without collisions.
+                await db.execute('''
+                    INSERT INTO sqlite_sequence (name, seq)
+                    SELECT 'message_history', ?
+                    WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'message_history')
+                ''', (max_id,))
+                await db.commit()
+
+    def lock(self, index: int) -> asyncio.Lock:
+        return self.locks.setdefault(index, asyncio.Lock())
+
+    async def writer(self, index: int) -> aiosqlite.Connection:
+        """Shard's writer connection, opened on first use. Call with ``lock(index)`` held."""
+        db = self.writers.get(index)
+        if db is None:
+            db = await aiosqlite.connect(self.shard_paths()[index])
+            await db.execute('PRAGMA synchronous=NORMAL')
+            self.writers[index] = db
+        return db
+
+    async def insert(self, chat_id: int, user_id: int, target_user_id: Optional[int], message_text, timestamp: int):
+        index = chat_id % self.count
+        async with self.lock(index):
+            db = await self.writer(index)
             await db.execute('''
                 INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
                 VALUES (?, ?, ?, ?, ?)
-            ''', (chat_id, user_id, target_user_id, message_text, current_timestamp))
+            ''', (chat_id, user_id, target_user_id, message_text, timestamp))
+            await db.commit()
 
-            await db.execute('''
-                UPDATE groups 
-                SET message_count = message_count + 1 
-                WHERE chat_id = ?
-            ''', (chat_id,))
+    async def fetch_all(self, sql: str, params: tuple = ()) -> List[list]:
+        """Run a read on every history file concurrently; returns one row list per file."""
+        async def fetch(path: str) -> list:
+            async with aiosqlite.connect(path) as db:
+                cursor = await db.execute(sql, params)
+                return await cursor.fetchall()
 
-            await db.commit()
+        return await asyncio.gather(*(fetch(path) for path in self.paths()))
+
+    async def move_from_main(self):
+        """Move rows left in DB_NAME into their shards, one chunk per transaction."""
+        if not self.count:
+            return
+        await migrations_done.wait()
+        moved = 0
+        try:
+            async with aiosqlite.connect(DB_NAME) as db:
+                for index, path in enumerate(self.shard_paths()):
+                    await db.execute('ATTACH DATABASE ? AS shard', (path,))
+                    # Same as chat_id % count in Python, which is never negative.
+                    in_shard = '((chat_id % ?1) + ?1) % ?1 = ?2'
+                    while True:
+                        cursor = await db.execute(f'''
+                            SELECT MAX(id) FROM (
+                                SELECT id FROM main.message_history WHERE {in_shard} ORDER BY id LIMIT ?3
+                            )
+                        ''', (self.count, index, HISTORY_MOVE_CHUNK_SIZE))
+                        last_id = (await cursor.fetchone())[0]
+                        if last_id is None:
+                            break
+                        async with self.move_lock:
+                            await db.execute(f'''
+                                INSERT OR IGNORE INTO shard.message_history
+                                SELECT * FROM main.message_history WHERE {in_shard} AND id <= ?3
+                            ''', (self.count, index, last_id))
+                            cursor = await db.execute(
+                                f'DELETE FROM main.message_history WHERE {in_shard} AND id <= ?3',
+                                (self.count, index, last_id)
+                            )
+                            moved += cursor.rowcount
+                            await db.commit()
+                        # Let ingestion writers in between chunks.
+                        await asyncio.sleep(0.05)
+                    await db.execute('DETACH DATABASE shard')
+                    self.moved.add(index)
         except Exception as e:
-            if "UNIQUE constraint failed" in str(e):
-                current_timestamp += random.randint(1, 1000)
-                await db.execute('''
-                    INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (chat_id, user_id, target_user_id, message_text, current_timestamp))
+            logging.error(f"Ошибка переноса истории в шарды: {e}")
+        if moved:
+            logger.info(f"Moved {moved} message_history rows into {self.count} shards")
 
-                await db.execute('''
-                    UPDATE groups 
-                    SET message_count = message_count + 1 
-                    WHERE chat_id = ?
-                ''', (chat_id,))
+    async def close(self):
+        for db in self.writers.values():
+            await db.close()
+        self.writers.clear()
+
+    async def pause(self):
+        """Wait for in-flight inserts and moves, hold their locks and close the writers. Undo with resume()."""
+        await self.move_lock.acquire()
+        for index in range(self.count):
+            await self.lock(index).acquire()
+        await self.close()
+
+    def resume(self):
+        for index in range(self.count):
+            self.lock(index).release()
+        self.move_lock.release()
+
+history_shards = HistoryShards(HISTORY_SHARDS, HISTORY_SHARD_DIR)
+
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE_SIZE = 5000
+DICTIONARY_REFRESH_INTERVAL = 7 * 86400
+DICTIONARY_CHECK_INTERVAL = 3600
+DICTIONARY_MAX_ID = 0xFFFF
+
+class MessageCodec:
+    """zlib compression of message texts with a preset dictionary trained on recent messages.
+
+    Compressed values are BLOBs: a 2-byte dictionary id followed by a raw deflate stream.
+    Plain TEXT values (old rows, or texts that don't shrink) are returned as is, so both
+    kinds can live in the same column. A dictionary is kept while any row still references
+    its id; ids of deleted dictionaries are reused once the 2-byte range is exhausted.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.dictionaries: Dict[int, bytes] = {0: b''}
+        self.current_id = 0
+        self.trained_at = 0
+        self.encoded = 0
+        self.decoded = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+
+    async def load(self):
+        """(Re)read dictionaries; after a restore nothing from the replaced DB may stay in memory."""
+        dictionaries, current_id, trained_at = {0: b''}, 0, 0
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute('SELECT id, data, created_at FROM compression_dicts ORDER BY created_at, id')
+            for dict_id, data, created_at in await cursor.fetchall():
+                dictionaries[dict_id] = data
+                current_id, trained_at = dict_id, created_at
+        self.dictionaries, self.current_id, self.trained_at = dictionaries, current_id, trained_at
+
+    def encode(self, text: str):
+        if not self.enabled or not text:
+            return text
+        started_at = time.perf_counter()
+        raw = text.encode('utf-8')
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dictionaries[self.current_id]) \
+            if self.current_id else zlib.compressobj(9, zlib.DEFLATED, -15)
+        value = self.current_id.to_bytes(2, 'big') + compressor.compress(raw) + compressor.flush()
+        if len(value) >= len(raw):
+            value = text
+        self.encode_time += time.perf_counter() - started_at
+        self.encoded += 1
+        self.raw_bytes += len(raw)
+        self.stored_bytes += len(value) if isinstance(value, bytes) else len(raw)
+        return value
+
+    def decode(self, value) -> str:
+        """Original text; an empty string (logged) if the value can't be decoded, e.g. its dictionary is gone."""
+        if not isinstance(value, bytes):
+            return value
+        started_at = time.perf_counter()
+        dict_id = int.from_bytes(value[:2], 'big')
+        try:
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionaries[dict_id]) \
+                if dict_id else zlib.decompressobj(-15)
+            text = (decompressor.decompress(value[2:]) + decompressor.flush()).decode('utf-8')
+        except (KeyError, zlib.error, UnicodeDecodeError) as e:
+            logging.error(f"Не удалось распаковать сообщение (словарь #{dict_id}): {e!r}")
+            return ''
+        self.decode_time += time.perf_counter() - started_at
+        self.decoded += 1
+        return text
+
+    @staticmethod
+    def train(samples: List[str], size: int = DICTIONARY_SIZE) -> bytes:
+        """Build a preset dictionary from the most frequent words and word pairs.
+
+        Deflate matches nearer the end of the dictionary with shorter distances,
+        so the most valuable strings go last.
+        """
+        counts: Dict[str, int] = {}
+        for text in samples:
+            words = text.lower().split()
+            for gram in words + [' '.join(pair) for pair in zip(words, words[1:])]:
+                counts[gram] = counts.get(gram, 0) + 1
+
+        chosen = []
+        total = 0
+        for gram in sorted((g for g, c in counts.items() if c > 1), key=lambda g: counts[g] * len(g), reverse=True):
+            encoded = gram.encode('utf-8') + b' '
+            if total + len(encoded) > size:
+                break
+            chosen.append(encoded)
+            total += len(encoded)
+        return b''.join(reversed(chosen))
+
+    async def referenced_ids(self) -> Set[int]:
+        """Dictionary ids still needed in any history file. Scans the whole history.
+
+        Besides live rows, search_index_queue keeps the encoded text of deleted rows until
+        their FTS delete is applied. Archive segments store decoded text and never need one.
+        """
+        rows = await history_shards.fetch_all('''
+            SELECT substr(message_text, 1, 2) FROM message_history WHERE typeof(message_text) = 'blob'
+            UNION
+            SELECT substr(message_text, 1, 2) FROM search_index_queue WHERE typeof(message_text) = 'blob'
+        ''')
+        return {int.from_bytes(row[0], 'big') for shard_rows in rows for row in shard_rows}
 
-                await db.commit()
-            else:
-                raise e
+    async def prune(self, referenced: Set[int]) -> None:
+        """Delete dictionaries no row references any more. The current one is always kept."""
+        stale = [dict_id for dict_id in self.dictionaries if dict_id and dict_id != self.current_id
+                 and dict_id not in referenced]
+        if not stale:
+            return
+        async with aiosqlite.connect(DB_NAME) as db:
+            await db.executemany('DELETE FROM compression_dicts WHERE id = ?', [(dict_id,) for dict_id in stale])
+            await db.commit()
+        for dict_id in stale:
+            del self.dictionaries[dict_id]
+        logger.info(f"Pruned {len(stale)} unused compression dictionaries")
+
+    def next_id(self, referenced: Set[int]) -> Optional[int]:
+        """Next free id above everything in use, wrapping to the lowest free one past DICTIONARY_MAX_ID.
+
+        Ids referenced by rows count as taken even without a dictionary (e.g. rows restored
+        from a snapshot whose dictionaries were pruned), so they are never given new data.
+        """
+        in_use = set(self.dictionaries) | referenced
+        for dict_id in list(range(max(in_use) + 1, DICTIONARY_MAX_ID + 1)) + list(range(1, DICTIONARY_MAX_ID + 1)):
+            if dict_id not in in_use:
+                return dict_id
+        return None
+
+    async def refresh(self):
+        # Prune before switching: rows still in flight were encoded with the current dictionary, which is kept.
+        referenced = await self.referenced_ids()
+        await self.prune(referenced)
+        dict_id = self.next_id(referenced)
+        if dict_id is None:
+            logging.error("Все id словарей сжатия заняты, новый словарь не создан")
+            return
+
+        rows = await history_shards.fetch_all(
+            'SELECT message_text FROM message_history ORDER BY id DESC LIMIT ?',
+            (DICTIONARY_SAMPLE_SIZE,)
+        )
+        samples = [self.decode(row[0]) for shard_rows in rows for row in shard_rows if row[0]]
+        if not samples:
+            return
+        data = await asyncio.to_thread(self.train, samples)
+        trained_at = int(time.time())
+        async with aiosqlite.connect(DB_NAME) as db:
+            await db.execute(
+                'INSERT INTO compression_dicts (id, data, created_at) VALUES (?, ?, ?)',
+                (dict_id, data, trained_at)
+            )
+            await db.commit()
+        self.dictionaries[dict_id] = data
+        self.current_id = dict_id
+        self.trained_at = trained_at
+        logger.info(f"Message compression dictionary #{dict_id} trained on {len(samples)} messages ({len(data)} bytes)")
+
+    def format_stats(self) -> str:
+        if not self.enabled:
+            return "выключено"
+        if not self.encoded:
+            return "нет данных"
+        ratio = self.raw_bytes / self.stored_bytes if self.stored_bytes else 0
+        decode_cost = self.decode_time / self.decoded * 1e6 if self.decoded else 0
+        return (
+            f"x<code>{ratio:.2f}</code>, "
+            f"<code>{self.encode_time / self.encoded * 1e6:.0f}</code>/<code>{decode_cost:.0f}</code> мкс на сообщение"
+        )
+
+message_codec = MessageCodec(COMPRESS_MESSAGE_TEXT)
+
+SEARCH_INDEX_BATCH_SIZE = 2000
+SEARCH_INDEX_INTERVAL = 5
+
+def search_chat_tag(chat_id: int) -> str:
+    """Same token as message_search_content.chat_tag."""
+    return f"c{chat_id}".replace('-', 'm')
+
+class SearchIndexer:
+    """Drains search_index_queue of every history file into message_fts in batches."""
+
+    def __init__(self, batch_size: int = SEARCH_INDEX_BATCH_SIZE, interval: float = SEARCH_INDEX_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.indexed = 0
+
+    async def index_batch(self, path: str) -> int:
+        async with aiosqlite.connect(path) as db:
+            cursor = await db.execute('''
+                SELECT q.seq, q.row_id, q.op, COALESCE(q.chat_id, h.chat_id), COALESCE(q.message_text, h.message_text)
+                FROM search_index_queue q
+                LEFT JOIN message_history h ON q.op = 1 AND h.id = q.row_id
+                ORDER BY q.seq
+                LIMIT ?
+            ''', (self.batch_size,))
+            rows = await cursor.fetchall()
+            if not rows:
+                return 0
+
+            # External-content deletes must pass exactly the text that was indexed.
+            for seq, row_id, op, chat_id, message_text in rows:
+                if message_text is None:
+                    continue
+                values = (row_id, search_chat_tag(chat_id), message_codec.decode(message_text))
+                if op:
+                    await db.execute('INSERT INTO message_fts (rowid, chat_tag, message_text) VALUES (?, ?, ?)', values)
+                else:
+                    await db.execute(
+                        "INSERT INTO message_fts (message_fts, rowid, chat_tag, message_text) VALUES ('delete', ?, ?, ?)",
+                        values
+                    )
+            await db.execute('DELETE FROM search_index_queue WHERE seq <= ?', (rows[-1][0],))
+            await db.commit()
+            self.indexed += len(rows)
+            return len(rows)
+
+    async def run(self):
+        await migrations_done.wait()
+        while True:
+            try:
+                for path in history_shards.paths():
+                    while await self.index_batch(path) == self.batch_size:
+                        # Let ingestion writers in between batches.
+                        await asyncio.sleep(0.05)
+            except Exception as e:
+                logging.error(f"Ошибка обновления поискового индекса: {e}")
+            await asyncio.sleep(self.interval)
+
+search_indexer = SearchIndexer()
+
+async def refresh_compression_dictionary():
+    if not message_codec.enabled:
+        return
+    await migrations_done.wait()
+    while True:
+        # Restarts don't retrain: only a dictionary older than the interval is replaced.
+        if time.time() - message_codec.trained_at >= DICTIONARY_REFRESH_INTERVAL:
+            try:
+                await message_codec.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка обучения словаря сжатия: {e}")
+        await asyncio.sleep(DICTIONARY_CHECK_INTERVAL)
+
+async def save_message_history(chat_id: int, user_id: int, message_text: str, target_user_id: Optional[int] = None,
+                               store_text: bool = True):
+    current_timestamp = message_clock.now_us()
+    if store_text:
+        message_text = message_codec.encode(message_text)
+    counters = [
+        ('''
+            UPDATE groups 
+            SET message_count = message_count + 1 
+            WHERE chat_id = ?
+        ''', (chat_id,)),
+        ('''
+            INSERT INTO daily_stats (chat_id, day, message_count)
+            VALUES (?, ?, 1)
+            ON CONFLICT(chat_id, day) DO UPDATE SET message_count = message_count + 1
+        ''', (chat_id, time.strftime('%Y-%m-%d', time.gmtime(current_timestamp / 1000000)))),
+    ]
+
+    if history_shards.count:
+        # The shard has its own write lock; counters in DB_NAME are batched so they don't serialize groups again.
+        if store_text:
+            await history_shards.insert(chat_id, user_id, target_user_id, message_text, current_timestamp)
+        for sql, params in counters:
+            db_writer.enqueue(sql, params)
+        return
+
+    async with aiosqlite.connect(DB_NAME) as db:
+        if store_text:
+            await db.execute('''
+                INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, target_user_id, message_text, current_timestamp))
+
+        for sql, params in counters:
+            await db.execute(sql, params)
+
+        await db.commit()
 
 async def save_words(chat_id: int, text: str):
     words = set(re.findall(r'\b\w+\b', text.lower()))
@@ -305,6 +1310,327 @@ async def save_words(chat_id: int, text: str):
             ''', (chat_id, word, current_timestamp))
         await db.commit()
 
+STOP_WORDS = frozenset('''
+    и в во не что он на я с со как а то все всё она так его но да ты к у же вы за бы по только ее её мне
+    было вот от меня еще ещё нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до
+    вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+    чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+    совсем ним здесь этом один почти мой тем чтобы нее неё сейчас были куда зачем всех никогда можно при
+    наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три
+    эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно
+    всю между это как так вообще просто очень тебе мне меня кстати типа короче щас сегодня
+    the a an and or but if then else of to in on at by for with from as is are was were be been being it
+    its this that these those i you he she we they me him her us them my your his our their not no yes
+    do does did so just what which who whom how when where why all any can will would should could
+    have has had there here than too very also about into out up down over again
+'''.split())
+
+class CountMinSketch:
+    """Approximate counters in a ``depth x width`` table. Estimates never undercount.
+
+    With total count N, an estimate exceeds the true count by more than
+    e/width * N with probability at most e^-depth (0.27% of N, 2% chance, by default).
+    """
+
+    def __init__(self, width: int = 1024, depth: int = 4, table: Optional[np.ndarray] = None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else np.zeros((depth, width), dtype=np.uint32)
+        self.rows = np.arange(depth)
+
+    def indexes(self, item: str) -> np.ndarray:
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=4 * self.depth).digest()
+        return np.frombuffer(digest, dtype='<u4') % self.width
+
+    def add(self, item: str, count: int = 1) -> int:
+        """Add ``count`` and return the new estimate."""
+        indexes = self.indexes(item)
+        self.table[self.rows, indexes] += count
+        return int(self.table[self.rows, indexes].min())
+
+    def to_bytes(self) -> bytes:
+        return self.table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, width: int = 1024, depth: int = 4) -> 'CountMinSketch':
+        return cls(width, depth, np.frombuffer(data, dtype=np.uint32).reshape(depth, width).copy())
+
+class HeavyHitters:
+    """The k items with the largest estimates so far: a min-heap with lazily dropped stale entries."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.counts: Dict[str, int] = {}
+        self.heap: List[tuple] = []
+
+    def offer(self, item: str, estimate: int) -> None:
+        if item not in self.counts and len(self.counts) >= self.k:
+            while self.heap and self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if estimate <= self.heap[0][0]:
+                return
+            del self.counts[heapq.heappop(self.heap)[1]]
+
+        self.counts[item] = estimate
+        heapq.heappush(self.heap, (estimate, item))
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, word) for word, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, n: int) -> List[tuple]:
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
+
+class WordFrequencyTracker:
+    """Per-group word frequencies for the current day, kept as a sketch plus its top-k words.
+
+    Nothing is stored per message: every flush writes the day's sketch and top-k
+    into word_sketches/top_words. Past days keep only their top_words rows, and
+    weekly figures add those up, so a word that never made a daily top-k is missing there.
+    """
+
+    def __init__(self, top_k: int = 50, flush_interval: float = 300):
+        self.top_k = top_k
+        self.flush_interval = flush_interval
+        self.entries: Dict[tuple, list] = {}
+
+    async def load(self, chat_id: int, day: str) -> list:
+        sketch = None
+        hitters = HeavyHitters(self.top_k)
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute(
+                'SELECT sketch FROM word_sketches WHERE chat_id = ? AND day = ?',
+                (chat_id, day)
+            )
+            row = await cursor.fetchone()
+            if row:
+                sketch = CountMinSketch.from_bytes(row[0])
+                cursor = await db.execute(
+                    'SELECT word, count FROM top_words WHERE chat_id = ? AND day = ?',
+                    (chat_id, day)
+                )
+                for word, count in await cursor.fetchall():
+                    hitters.offer(word, count)
+        return [sketch or CountMinSketch(), hitters, False]
+
+    async def add(self, chat_id: int, text: str) -> None:
+        words = Counter(
+            word for word in re.findall(r'\b\w+\b', text.lower())
+            if len(word) > 2 and not word.isdigit() and word not in STOP_WORDS
+        )
+        if not words:
+            return
+
+        key = (chat_id, time.strftime('%Y-%m-%d', time.gmtime()))
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries.setdefault(key, await self.load(*key))
+
+        sketch, hitters, _ = entry
+        for word, count in words.items():
+            hitters.offer(word, sketch.add(word, count))
+        entry[2] = True
+
+    async def flush(self, chat_id: Optional[int] = None) -> None:
+        """Persist dirty entries (of one chat, if given) and forget idle or finished days.
+
+        An entry is snapshotted and marked clean before any await, so words add()ed while
+        the snapshot is being written mark it dirty again for the next flush.
+        """
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        written = []
+        try:
+            async with aiosqlite.connect(DB_NAME) as db:
+                for key, entry in list(self.entries.items()):
+                    if chat_id is not None and key[0] != chat_id:
+                        continue
+                    if entry[2]:
+                        sketch, hitters = entry[0].to_bytes(), list(entry[1].counts.items())
+                        entry[2] = False
+                        written.append(entry)
+                        await db.execute(
+                            'INSERT OR REPLACE INTO word_sketches (chat_id, day, sketch) VALUES (?, ?, ?)',
+                            (*key, sketch)
+                        )
+                        await db.execute('DELETE FROM top_words WHERE chat_id = ? AND day = ?', key)
+                        await db.executemany(
+                            'INSERT INTO top_words (chat_id, day, word, count) VALUES (?, ?, ?, ?)',
+                            [(*key, word, count) for word, count in hitters]
+                        )
+                    elif chat_id is None or key[1] != today:
+                        del self.entries[key]
+
+                if chat_id is None:
+                    # Sketches are only needed while their day is still being counted.
+                    await db.execute('DELETE FROM word_sketches WHERE day < ?', (today,))
+                await db.commit()
+        except Exception:
+            for entry in written:
+                entry[2] = True
+            raise
+
+    async def get_top_words(self, chat_id: int, days: int, n: int = 10) -> List[tuple]:
+        """Top words of the last ``days`` UTC days as stored; flush(chat_id) first to include unsaved counts."""
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute('''
+                SELECT word, SUM(count) AS total
+                FROM top_words
+                WHERE chat_id = ? AND day >= ?
+                GROUP BY word
+                ORDER BY total DESC
+                LIMIT ?
+            ''', (chat_id, since, n))
+            return await cursor.fetchall()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка сохранения частот слов: {e}")
+
+word_frequencies = WordFrequencyTracker()
+
+class HyperLogLog:
+    """Distinct-count estimate in 2^p one-byte registers.
+
+    Standard error is 1.04 / sqrt(2^p): 2.3% for p = 11, so about 95% of estimates
+    fall within 4.6% of the true count. Small counts use linear counting and are
+    close to exact. Two sketches merge by taking the register-wise maximum.
+    """
+
+    def __init__(self, p: int = 11, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    def add(self, item: str) -> None:
+        value = int.from_bytes(hashlib.blake2b(item.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = value >> (64 - self.p)
+        rank = (64 - self.p) - (value & ((1 << (64 - self.p)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m ** 2 / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * self.m and zeros:
+            return int(round(self.m * np.log(self.m / zeros)))
+        return int(round(raw))
+
+    def to_bytes(self) -> bytes:
+        # Registers of quiet groups are mostly zeros and compress to a few dozen bytes.
+        return zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: Optional[bytes], p: int = 11) -> 'HyperLogLog':
+        if not data:
+            return cls(p)
+        return cls(p, np.frombuffer(zlib.decompress(data), dtype=np.uint8).copy())
+
+class DistinctCounters:
+    """HyperLogLog counts of distinct words and active users per (chat_id, day), plus an all-time row.
+
+    Updates stay in memory and are merged into distinct_counters on flush. Merging is a
+    register-wise maximum, so flushing the same registers twice changes nothing.
+    """
+
+    KINDS = ('words', 'users')
+    ALL_TIME = 'all'
+
+    def __init__(self, flush_interval: float = 300):
+        self.flush_interval = flush_interval
+        self.entries: Dict[tuple, Dict[str, HyperLogLog]] = {}
+        self.flushing: Dict[tuple, Dict[str, HyperLogLog]] = {}
+
+    def add(self, chat_id: int, user_id: int, text: Optional[str] = None) -> None:
+        key = (chat_id, time.strftime('%Y-%m-%d', time.gmtime()))
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {kind: HyperLogLog() for kind in self.KINDS}
+        entry['users'].add(str(user_id))
+        if text:
+            for word in set(re.findall(r'\b\w+\b', text.lower())):
+                entry['words'].add(word)
+
+    async def merge_row(self, db: aiosqlite.Connection, chat_id: int, day: str, entry: Dict[str, HyperLogLog]) -> None:
+        cursor = await db.execute(
+            'SELECT words, users FROM distinct_counters WHERE chat_id = ? AND day = ?',
+            (chat_id, day)
+        )
+        row = await cursor.fetchone() or (None, None)
+        merged = [HyperLogLog.from_bytes(blob).merge(entry[kind]) for kind, blob in zip(self.KINDS, row)]
+        await db.execute(
+            'INSERT OR REPLACE INTO distinct_counters (chat_id, day, words, users) VALUES (?, ?, ?, ?)',
+            (chat_id, day, merged[0].to_bytes(), merged[1].to_bytes())
+        )
+
+    async def flush(self) -> None:
+        if not self.entries:
+            return
+        # Entries stay visible to estimate() until their merge is committed.
+        self.flushing, self.entries = self.entries, {}
+        try:
+            async with aiosqlite.connect(DB_NAME) as db:
+                for (chat_id, day), entry in self.flushing.items():
+                    await self.merge_row(db, chat_id, day, entry)
+                    await self.merge_row(db, chat_id, self.ALL_TIME, entry)
+                await db.commit()
+        except Exception:
+            for key, entry in self.flushing.items():
+                for kind in self.KINDS:
+                    self.entries.setdefault(key, {k: HyperLogLog() for k in self.KINDS})[kind].merge(entry[kind])
+            raise
+        finally:
+            self.flushing = {}
+
+    async def estimate(self, chat_id: int, kind: str, days: Optional[int] = None) -> int:
+        """Distinct ``kind`` over the last ``days`` UTC days, or all time. Reads at most ``days`` blobs."""
+        column = {'words': 'words', 'users': 'users'}[kind]
+        async with aiosqlite.connect(DB_NAME) as db:
+            if days is None:
+                cursor = await db.execute(
+                    f'SELECT {column} FROM distinct_counters WHERE chat_id = ? AND day = ?',
+                    (chat_id, self.ALL_TIME)
+                )
+                since = ''
+            else:
+                since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+                cursor = await db.execute(
+                    f'SELECT {column} FROM distinct_counters WHERE chat_id = ? AND day >= ? AND day != ?',
+                    (chat_id, since, self.ALL_TIME)
+                )
+            merged = HyperLogLog()
+            for (blob,) in await cursor.fetchall():
+                merged.merge(HyperLogLog.from_bytes(blob))
+
+        # Unflushed registers only exist for today and, right after midnight, yesterday.
+        now = time.time()
+        for day in {time.strftime('%Y-%m-%d', time.gmtime(now - offset)) for offset in (0, 86400)}:
+            if day < since:
+                continue
+            for entries in (self.entries, self.flushing):
+                entry = entries.get((chat_id, day))
+                if entry:
+                    merged.merge(entry[kind])
+        return merged.estimate()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка сохранения счётчиков уникальных значений: {e}")
+
+distinct_counters = DistinctCounters()
+
 async def get_group_stats(chat_id: int) -> Dict:
     """Получение статистики группы"""
     async with aiosqlite.connect(DB_NAME) as db:
@@ -315,17 +1641,10 @@ async def get_group_stats(chat_id: int) -> Dict:
             message_count = await cursor.fetchone()
             message_count = message_count[0] if message_count else 0
 
-        async with db.execute(
-            'SELECT COUNT(DISTINCT word) FROM words WHERE chat_id = ?',
-            (chat_id,)
-        ) as cursor:
-            word_count = await cursor.fetchone()
-            word_count = word_count[0] if word_count else 0
-
-        return {
-            'messages': message_count,
-            'words': word_count
-        }
+    return {
+        'messages': message_count,
+        'words': await distinct_counters.estimate(chat_id, 'words')
+    }
 
 log = logging.getLogger('adverts')
 
@@ -346,8 +1665,14 @@ async def show_advert(user_id: int):
 
                 log.error('Gramads: %s' % str(await response.json()))
 
+@router.chat_member()
+async def on_member_status_updated(event: types.ChatMemberUpdated):
+    chat_resolver.invalidate(event.chat.id)
+
 @router.my_chat_member()
 async def on_chat_member_updated(event: types.ChatMemberUpdated):
+    chat_resolver.invalidate(event.chat.id)
+
     if event.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
 
         current_timestamp = int(datetime.now().timestamp())
@@ -364,28 +1689,425 @@ async def on_chat_member_updated(event: types.ChatMemberUpdated):
             """
         )
 
-async def get_daily_message_stats(chat_id: int) -> List[Dict]:
+async def get_daily_message_stats(chat_id: int, days: Optional[int] = None) -> List[Dict]:
+    since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400)) if days else ''
     async with aiosqlite.connect(DB_NAME) as db:
         async with db.execute('''
-            SELECT 
-                date(datetime(timestamp/1000000, 'unixepoch')) as date,
-                COUNT(*) as message_count
-            FROM message_history 
-            WHERE chat_id = ?
-            GROUP BY date
-            ORDER BY date
-        ''', (chat_id,)) as cursor:
+            SELECT day, message_count
+            FROM daily_stats 
+            WHERE chat_id = ? AND day >= ?
+            ORDER BY day
+        ''', (chat_id, since)) as cursor:
             daily_stats = await cursor.fetchall()
             return daily_stats
 
-async def create_stats_image(chat_id: int, stats: Dict) -> BufferedInputFile:
-    daily_stats = await get_daily_message_stats(chat_id)
-    
-    dates = [datetime.strptime(str(row[0]), '%Y-%m-%d') for row in daily_stats]
-    counts = [row[1] for row in daily_stats]
+DEFAULT_RETENTION_DAYS = 0 # 0 - keep everything; groups opt in with /retention
+ARCHIVE_DIR = 'archive'
+ARCHIVE_CHUNK_SIZE = 1000
+
+def format_retention_days(retention_days: int) -> str:
+    return f"<code>{retention_days}</code> дн." if retention_days else "хранить всё"
+
+async def get_group_retention_days(db: aiosqlite.Connection, chat_id: int) -> int:
+    cursor = await db.execute(
+        'SELECT retention_days FROM group_retention WHERE chat_id = ?',
+        (chat_id,)
+    )
+    result = await cursor.fetchone()
+    return result[0] if result else DEFAULT_RETENTION_DAYS
+
+def read_archive_segment(path: str) -> List[dict]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+def list_archive_segments(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if name.endswith('.jsonl.gz'))
+
+# (kind, chat_id) -> [next segment number, ids of the last segment written, its path]
+archive_segments: Dict[tuple, list] = {}
+
+def write_archive_segment(kind: str, chat_id: int, first_id: int, last_id: int, rows: List[dict]) -> str:
+    """Write one gzip'd JSONL segment named <number>-<first id>-<last id>.jsonl.gz.
+
+    Numbers grow per chat, so names never collide and sort in archival order. The
+    directory is listed once per chat; after that the next number is kept in memory.
+    A retry of the last chunk (same ids, e.g. after the delete failed) replaces it.
+    """
+    directory = os.path.join(ARCHIVE_DIR, kind, str(chat_id))
+    state = archive_segments.get((kind, chat_id))
+    if state is None:
+        os.makedirs(directory, exist_ok=True)
+        names = list_archive_segments(directory)
+        if names:
+            last_path = os.path.join(directory, names[-1])
+            last_ids = [row['id'] for row in read_archive_segment(last_path)]
+            state = [int(names[-1].split('-', 1)[0]) + 1, last_ids, last_path]
+        else:
+            state = [1, None, None]
+        archive_segments[(kind, chat_id)] = state
+
+    ids = [row['id'] for row in rows]
+    if ids == state[1]:
+        path = state[2]
+    else:
+        path = os.path.join(directory, f"{state[0]:08d}-{first_id:012d}-{last_id:012d}.jsonl.gz")
+        state[0] += 1
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp_path, path)
+    state[1], state[2] = ids, path
+    return path
+
+async def iter_archived_rows(kind: str, chat_id: int, since: Optional[int] = None, until: Optional[int] = None):
+    """Yield archived rows of one chat in archival order, optionally filtered by timestamp.
+
+    Segments are read in a worker thread, one at a time, so the event loop never waits on gzip.
+    """
+    directory = os.path.join(ARCHIVE_DIR, kind, str(chat_id))
+    for name in await asyncio.to_thread(list_archive_segments, directory):
+        for row in await asyncio.to_thread(read_archive_segment, os.path.join(directory, name)):
+            if since is not None and row['timestamp'] < since:
+                continue
+            if until is not None and row['timestamp'] >= until:
+                continue
+            yield row
+
+async def archive_chunk(db: aiosqlite.Connection, kind: str, chat_id: int, cutoff: int) -> int:
+    """``db`` must hold the chat's ``kind`` table: its history shard for message_history."""
+    if kind == 'message_history':
+        cursor = await db.execute('''
+            SELECT id, user_id, target_user_id, message_text, timestamp
+            FROM message_history
+            WHERE chat_id = ? AND timestamp < ?
+            ORDER BY timestamp
+            LIMIT ?
+        ''', (chat_id, cutoff, ARCHIVE_CHUNK_SIZE))
+        rows = [
+            {
+                'id': r[0], 'user_id': r[1], 'target_user_id': r[2],
+                'message_text': message_codec.decode(r[3]), 'timestamp': r[4]
+            }
+            for r in await cursor.fetchall()
+        ]
+        delete_sql = 'DELETE FROM message_history WHERE id = ?'
+    else:
+        cursor = await db.execute('''
+            SELECT rowid, word, timestamp
+            FROM words
+            WHERE chat_id = ? AND timestamp < ?
+            ORDER BY rowid
+            LIMIT ?
+        ''', (chat_id, cutoff, ARCHIVE_CHUNK_SIZE))
+        rows = [{'id': r[0], 'word': r[1], 'timestamp': r[2]} for r in await cursor.fetchall()]
+        delete_sql = 'DELETE FROM words WHERE rowid = ?'
+
+    if not rows:
+        return 0
+
+    ids = [row['id'] for row in rows]
+    await asyncio.to_thread(write_archive_segment, kind, chat_id, min(ids), max(ids), rows)
+    await db.executemany(delete_sql, [(row_id,) for row_id in ids])
+    await db.commit()
+    return len(rows)
+
+async def enforce_retention():
+    """Move rows past each group's retention window into archive segments, one small chunk at a time."""
+    await migrations_done.wait()
+    while True:
+        try:
+            async with aiosqlite.connect(DB_NAME) as db:
+                # Groups without a /retention setting get DEFAULT_RETENTION_DAYS, which keeps everything.
+                cursor = await db.execute('SELECT chat_id FROM groups')
+                chat_ids = [row[0] for row in await cursor.fetchall()]
+
+                for chat_id in chat_ids:
+                    retention_days = await get_group_retention_days(db, chat_id)
+                    if not retention_days:
+                        continue
+                    cutoff = time.time() - retention_days * 86400
+
+                    archived = 0
+                    async with aiosqlite.connect(history_shards.path_for(chat_id)) as history_db:
+                        while True:
+                            count = await archive_chunk(history_db, 'message_history', chat_id, int(cutoff * 1000000))
+                            count += await archive_chunk(db, 'words', chat_id, int(cutoff))
+                            archived += count
+                            if not count:
+                                break
+                            # Let ingestion writers in between chunks.
+                            await asyncio.sleep(0.05)
+
+                    if archived:
+                        logger.info(f"Archived {archived} rows of chat {chat_id} older than {retention_days} days")
+        except Exception as e:
+            logging.error(f"Ошибка архивации истории: {e}")
+        await asyncio.sleep(3600)
+
+@router.message(Command("retention"))
+async def retention_command(message: Message):
+    """/retention <chat_id> [days|reset]"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        await message.answer(
+            "🗄 Использование:\n"
+            "<code>/retention &lt;chat_id&gt;</code> - текущий срок хранения\n"
+            "<code>/retention &lt;chat_id&gt; &lt;дни&gt;</code> - установить срок (0 - хранить всё)\n"
+            "<code>/retention &lt;chat_id&gt; reset</code> - сбросить срок\n\n"
+            f"По умолчанию: {format_retention_days(DEFAULT_RETENTION_DAYS)}"
+        )
+        return
+
+    try:
+        chat_id = int(args[0])
+    except ValueError:
+        await message.answer("❌ Некорректный ID группы.")
+        return
+
+    async with aiosqlite.connect(DB_NAME) as db:
+        if len(args) == 1:
+            retention_days = await get_group_retention_days(db, chat_id)
+            await message.answer(f"🗄 Срок хранения для <code>{chat_id}</code>: {format_retention_days(retention_days)}")
+            return
+
+        if args[1].lower() == "reset":
+            await db.execute('DELETE FROM group_retention WHERE chat_id = ?', (chat_id,))
+            await db.commit()
+            await message.answer(f"✅ Срок хранения для <code>{chat_id}</code> сброшен.")
+            return
+
+        try:
+            retention_days = int(args[1])
+            if retention_days < 0:
+                raise ValueError
+        except ValueError:
+            await message.answer("❌ Некорректное число дней.")
+            return
+
+        await db.execute('''
+            INSERT OR REPLACE INTO group_retention (chat_id, retention_days)
+            VALUES (?, ?)
+        ''', (chat_id, retention_days))
+        await db.commit()
+
+    await message.answer(f"✅ Срок хранения для <code>{chat_id}</code>: {format_retention_days(retention_days)}")
+
+HEATMAP_DAYS = 90
+HEATMAP_CHUNK_SIZE = 50_000
+HEATMAP_UTC_OFFSET = 3 * 3600 # hours on the heatmap are Moscow time
+WEEKDAY_LABELS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
+heatmap_cache: Dict[int, tuple] = {}
+
+async def get_activity_heatmap(chat_id: int) -> np.ndarray:
+    """Messages per (weekday, hour) over the last HEATMAP_DAYS, as a 7x24 array.
+
+    Timestamps are streamed in keyset chunks and folded into one 168-bin
+    np.bincount, so memory does not grow with the group. Cached per group per day.
+    """
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    cached = heatmap_cache.get(chat_id)
+    if cached and cached[0] == today:
+        return cached[1]
+    if not migrations_done.is_set():
+        # The keyset needs message_history.id (migration 6); /stats skips the panel until then.
+        return np.zeros((7, 24), dtype=np.int64)
+
+    counts = np.zeros(7 * 24, dtype=np.int64)
+    since = (int((time.time() - HEATMAP_DAYS * 86400) * 1000000), -1)
+    async for rows in history_shards.iter_chunks(chat_id, '''
+        SELECT id, timestamp FROM message_history
+        WHERE chat_id = ? AND (timestamp, id) > (?, ?)
+        ORDER BY timestamp, id
+        LIMIT ?
+    ''', since, HEATMAP_CHUNK_SIZE):
+        seconds = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)) // 1000000
+        seconds += HEATMAP_UTC_OFFSET
+        # 1970-01-01 was a Thursday; shift so that Monday is 0.
+        weekdays = (seconds // 86400 + 3) % 7
+        hours = seconds % 86400 // 3600
+        counts += np.bincount(weekdays * 24 + hours, minlength=7 * 24)
+
+    heatmap = counts.reshape(7, 24)
+    heatmap_cache[chat_id] = (today, heatmap)
+    return heatmap
+
+def draw_activity_heatmap(ax, heatmap: np.ndarray):
+    ax.imshow(heatmap, aspect='auto', cmap='magma', interpolation='nearest')
+    ax.set_title(f'Активность за {HEATMAP_DAYS} дн. (МСК)', color='#8884d8')
+    ax.set_yticks(range(7))
+    ax.set_yticklabels(WEEKDAY_LABELS)
+    ax.set_xticks(range(0, 24, 3))
+    ax.set_xticklabels([f"{hour:02d}:00" for hour in range(0, 24, 3)])
+    ax.tick_params(axis='both', colors='#8884d8')
+    for spine in ax.spines.values():
+        spine.set_edgecolor('#8884d8')
+        spine.set_linewidth(1)
+
+INTERACTION_DAYS = 30
+INTERACTION_CHUNK_SIZE = 50_000
+
+interaction_cache: Dict[int, tuple] = {}
+
+def merge_edges(edges: np.ndarray, weights: np.ndarray) -> tuple:
+    """Sum the weights of duplicate (source, target) rows of a COO edge list."""
+    unique_edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+    return unique_edges, np.bincount(inverse.ravel(), weights=weights).astype(np.int64)
+
+async def get_interaction_graph(chat_id: int) -> Dict:
+    """Who replies to whom over the last INTERACTION_DAYS, cached per group per day.
+
+    Reply pairs are streamed in keyset chunks and reduced to a weighted COO edge
+    list after every chunk, so memory follows the number of distinct pairs,
+    not the number of replies.
+    """
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    cached = interaction_cache.get(chat_id)
+    if cached and cached[0] == today:
+        return cached[1]
+    if not migrations_done.is_set():
+        # The keyset needs message_history.id (migration 6); /stats skips the section until then.
+        return {'pairs': [], 'members': []}
+
+    edges = np.empty((0, 2), dtype=np.int64)
+    weights = np.empty(0, dtype=np.int64)
+    since = (int((time.time() - INTERACTION_DAYS * 86400) * 1000000), -1)
+    # user_id 0 is the bot's own reply to a user.
+    async for rows in history_shards.iter_chunks(chat_id, '''
+        SELECT id, timestamp, user_id, target_user_id FROM message_history
+        WHERE chat_id = ? AND (timestamp, id) > (?, ?)
+          AND target_user_id IS NOT NULL AND user_id != 0
+        ORDER BY timestamp, id
+        LIMIT ?
+    ''', since, INTERACTION_CHUNK_SIZE):
+        pairs = [(row[2], row[3]) for row in rows]
+        edges, weights = merge_edges(
+            np.concatenate([edges, np.array(pairs, dtype=np.int64)]),
+            np.concatenate([weights, np.ones(len(pairs), dtype=np.int64)])
+        )
+
+    graph = {'pairs': [], 'members': []}
+    if len(weights):
+        order = np.argsort(-weights)[:5]
+        graph['pairs'] = [(int(edges[i, 0]), int(edges[i, 1]), int(weights[i])) for i in order]
+
+        # Degree = distinct reply partners in either direction, replies = weighted degree.
+        undirected = np.unique(np.sort(edges, axis=1), axis=0)
+        members, degree = np.unique(undirected.ravel(), return_counts=True)
+        replies = np.bincount(
+            np.searchsorted(members, edges.ravel()), weights=np.repeat(weights, 2), minlength=len(members)
+        ).astype(np.int64)
+        order = np.lexsort((-replies, -degree))[:5]
+        graph['members'] = [(int(members[i]), int(degree[i]), int(replies[i])) for i in order]
+
+    interaction_cache[chat_id] = (today, graph)
+    return graph
+
+async def format_interaction_graph(graph: Dict) -> str:
+    user_ids = {user_id for source, target, _ in graph['pairs'] for user_id in (source, target)}
+    user_ids.update(user_id for user_id, _, _ in graph['members'])
+    async with aiosqlite.connect(DB_NAME) as db:
+        cursor = await db.execute(
+            f"SELECT user_id, username FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})",
+            tuple(user_ids)
+        )
+        usernames = {user_id: username for user_id, username in await cursor.fetchall() if username}
+
+    # Plain names: a link or an @username would notify every listed member on each /stats.
+    def mention(user_id: int) -> str:
+        return html.escape(usernames.get(user_id, str(user_id)))
+
+    lines = [f"🕸 <b>Кто кому отвечает (за {INTERACTION_DAYS} дн.):</b>"]
+    lines += [f"• {mention(source)} → {mention(target)}: <code>{count}</code>" for source, target, count in graph['pairs']]
+    lines.append("\n🤝 <b>Самые общительные:</b>")
+    lines += [
+        f"• {mention(user_id)}: <code>{degree}</code> собеседн., <code>{replies}</code> ответов"
+        for user_id, degree, replies in graph['members']
+    ]
+    return "\n".join(lines)
+
+def draw_top_words(ax, top_words: List[tuple]):
+    words = [word for word, _ in reversed(top_words)]
+    counts = [count for _, count in reversed(top_words)]
+    ax.set_facecolor('#1a1a2e')
+    ax.barh(words, counts, color='#00ff9d', alpha=0.8)
+    ax.set_title('Топ слов за неделю', color='#8884d8')
+    ax.tick_params(axis='both', colors='#8884d8')
+    for spine in ax.spines.values():
+        spine.set_edgecolor('#8884d8')
+        spine.set_linewidth(1)
+
+STATS_RANGES = {'7d': 7, '30d': 30, '90d': 90, 'all': None}
+STATS_RANGE_LABELS = {'7d': '7 дней', '30d': '30 дней', '90d': '90 дней', 'all': 'всё время'}
+STATS_POINT_BUDGET = 120
+STATS_MARKER_LIMIT = 31
+
+def downsample_lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> tuple:
+    """Largest-Triangle-Three-Buckets: keep ``threshold`` points that preserve the visual shape."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    bucket_size = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected.append(a)
+    selected.append(n - 1)
+    return x[selected], y[selected]
+
+async def get_daily_series(chat_id: int, days: Optional[int]) -> tuple:
+    """Daily message counts with empty days filled in, downsampled to STATS_POINT_BUDGET points."""
+    daily_stats = await get_daily_message_stats(chat_id, days)
+    if not daily_stats:
+        return np.empty(0), np.empty(0)
+
+    # daily_stats days are UTC; np.datetime64('today') would be the server's local date.
+    today = np.datetime64(time.strftime('%Y-%m-%d', time.gmtime()), 'D')
+    first_day = np.datetime64(daily_stats[0][0]) if days is None else today - (days - 1)
+    day_numbers = np.arange(first_day, today + 1, dtype='datetime64[D]')
+    counts = np.zeros(len(day_numbers), dtype=np.float64)
+    indexes = (np.array([row[0] for row in daily_stats], dtype='datetime64[D]') - first_day).astype(np.int64)
+    valid = (indexes >= 0) & (indexes < len(counts))
+    counts[indexes[valid]] = np.array([row[1] for row in daily_stats], dtype=np.float64)[valid]
+
+    x = mdates.date2num(day_numbers)
+    return downsample_lttb(x, counts, STATS_POINT_BUDGET)
+
+async def create_stats_image(chat_id: int, stats: Dict, top_words: Optional[List[tuple]] = None,
+                             range_key: str = 'all') -> BufferedInputFile:
+    dates, counts = await get_daily_series(chat_id, STATS_RANGES[range_key])
     
+    heatmap = await get_activity_heatmap(chat_id)
+    panels = []
+    if heatmap.any():
+        panels.append(lambda panel_ax: draw_activity_heatmap(panel_ax, heatmap))
+    if top_words:
+        panels.append(lambda panel_ax: draw_top_words(panel_ax, top_words))
+
     plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig, axes = plt.subplots(
+        1 + len(panels), 1,
+        figsize=(10, 6 + 4 * len(panels)),
+        gridspec_kw={'height_ratios': [3] + [2] * len(panels)},
+        squeeze=False
+    )
+    ax = axes[0][0]
+    for draw, panel_row in zip(panels, axes[1:]):
+        draw(panel_row[0])
     fig.patch.set_facecolor('#1a1a2e')
     ax.set_facecolor('#1a1a2e')
     
@@ -393,11 +2115,14 @@ async def create_stats_image(chat_id: int, stats: Dict) -> BufferedInputFile:
     
     ax.plot(dates, counts, '-', color='#00ff9d', linewidth=2, alpha=0.8)
     
-    ax.scatter(dates, counts, color='#00ff9d', s=50, alpha=1, 
-              zorder=5, edgecolor='white', linewidth=1)
+    if len(dates) <= STATS_MARKER_LIMIT:
+        ax.scatter(dates, counts, color='#00ff9d', s=50, alpha=1, 
+                  zorder=5, edgecolor='white', linewidth=1)
     
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
+    long_range = len(dates) and dates[-1] - dates[0] > 365
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m.%Y' if long_range else '%d.%m'))
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.set_title(f"Сообщения за {STATS_RANGE_LABELS[range_key]}", color='#8884d8')
     
     ax.tick_params(axis='both', colors='#8884d8')
     
@@ -405,7 +2130,7 @@ async def create_stats_image(chat_id: int, stats: Dict) -> BufferedInputFile:
         spine.set_edgecolor('#8884d8')
         spine.set_linewidth(1)
     
-    plt.xticks(rotation=45)
+    plt.setp(ax.get_xticklabels(), rotation=45)
     
     plt.tight_layout()
     
@@ -419,22 +2144,49 @@ async def create_stats_image(chat_id: int, stats: Dict) -> BufferedInputFile:
 
 @router.message(Command("stats"))
 async def stats_handler(message: types.Message):
-    """/stats"""
+    """/stats [7d|30d|90d|all]"""
     if message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        args = message.text.split()[1:]
+        range_key = args[0].lower() if args and args[0].lower() in STATS_RANGES else 'all'
         stats = await get_group_stats(message.chat.id)
         user_id = message.from_user.id
         
         caption = (
             f"📊 <b>Статистика группы:</b>\n"
             f"🤍 Сообщений получено: <code>{stats['messages']}</code>\n"
-            f"💌 Слов собрано: <code>{stats['words']}</code>"
+            f"💌 Слов собрано: <code>~{stats['words']}</code>\n"
+            f"📆 Период графика: {STATS_RANGE_LABELS[range_key]} (<code>/stats 7d|30d|90d|all</code>)"
         )
         
         if stats['messages'] < REQUIRED_MESSAGES:
             caption += f"\n🤍 До активации <b>Mimi Typh</b> осталось: <code>{REQUIRED_MESSAGES - stats['messages']}</code> сообщений."
+
+        users_today, users_week, users_month = [
+            await distinct_counters.estimate(message.chat.id, 'users', days) for days in (1, 7, 30)
+        ]
+        words_today, words_week = [
+            await distinct_counters.estimate(message.chat.id, 'words', days) for days in (1, 7)
+        ]
+        caption += (
+            f"\n👥 Активных участников: сегодня <code>~{users_today}</code>, "
+            f"за неделю <code>~{users_week}</code>, за месяц <code>~{users_month}</code>"
+            f"\n🔤 Уникальных слов: сегодня <code>~{words_today}</code>, за неделю <code>~{words_week}</code>"
+        )
+
+        await word_frequencies.flush(message.chat.id)
+        top_today = await word_frequencies.get_top_words(message.chat.id, days=1, n=5)
+        top_week = await word_frequencies.get_top_words(message.chat.id, days=7, n=10)
+        if top_today:
+            caption += "\n\n🔥 <b>Топ слов за день:</b> " + ", ".join(
+                f"{html.escape(word)} (<code>{count}</code>)" for word, count in top_today
+            )
+        if top_week:
+            caption += "\n📅 <b>Топ слов за неделю:</b> " + ", ".join(
+                f"{html.escape(word)} (<code>{count}</code>)" for word, count in top_week[:5]
+            )
         
         try:
-            image = await create_stats_image(message.chat.id, stats)
+            image = await create_stats_image(message.chat.id, stats, top_week, range_key)
             
             await message.answer_photo(
                 photo=image,
@@ -446,6 +2198,14 @@ async def stats_handler(message: types.Message):
             print(f"Error creating stats image: {e}")
             await message.answer(caption)
 
+        # Sent separately: photo captions are limited to 1024 characters.
+        try:
+            graph = await get_interaction_graph(message.chat.id)
+            if graph['pairs']:
+                await message.answer(await format_interaction_graph(graph))
+        except Exception as e:
+            logging.error(f"Ошибка построения графа ответов {message.chat.id}: {e}")
+
 logger = logging.getLogger(__name__)
 
 class AdminStates(StatesGroup):
@@ -472,14 +2232,17 @@ async def handle_admin_command(message: Message, state: FSMContext):
         premium_groups = await cursor.fetchall()
     
     premium_groups_list = "\n".join(
-        [f"💬 {gid} (до {datetime.fromisoformat(end).strftime('%d.%m.%Y')})" 
+        [f"💬 {gid} (до {parse_end_date(end).strftime('%d.%m.%Y')})" 
          for gid, end in premium_groups]
     ) if premium_groups else "❌ Нет premium-групп"
 
     text = (
         f"🔐 <b>Админ-панель</b>\n\n"
         f"👥 Всего пользователей: <code>{total_users}</code>\n"
-        f"💬 Активных групп: <code>{active_groups}</code>\n\n"
+        f"💬 Активных групп: <code>{active_groups}</code>\n"
+        f"🎞 Медиа-кэш: <code>{media_registry.hits}</code> попаданий / <code>{media_registry.misses}</code> загрузок\n"
+        f"💾 Последний бэкап: {format_backup_stats()}\n"
+        f"🗜 Сжатие истории: {message_codec.format_stats()}\n\n"
         f"🏆 Premium-группы:\n{premium_groups_list}"
     )
 
@@ -490,6 +2253,197 @@ async def handle_admin_command(message: Message, state: FSMContext):
     ])
     await message.answer(text, reply_markup=keyboard)
 
+BACKUP_DIR = 'backups'
+BACKUP_INTERVAL = 6 * 3600
+BACKUP_KEEP = 7
+
+backup_stats = {'path': None, 'duration': None, 'size': None, 'finished_at': None}
+
+def format_backup_stats() -> str:
+    if not backup_stats['finished_at']:
+        return "нет"
+    return (
+        f"<code>{datetime.fromtimestamp(backup_stats['finished_at']).strftime('%d.%m.%Y %H:%M')}</code>, "
+        f"<code>{backup_stats['duration']:.1f}</code> сек., "
+        f"<code>{backup_stats['size'] / (1024**2):.1f}</code> MB"
+    )
+
+def compress_file(source: str, target: str) -> None:
+    with open(source, 'rb') as src, gzip.open(target, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1 << 20), b''):
+            dst.write(chunk)
+
+def decompress_file(source: str, target: str) -> None:
+    with gzip.open(source, 'rb') as src, open(target, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1 << 20), b''):
+            dst.write(chunk)
+
+def list_backups() -> List[str]:
+    """Main snapshots, oldest first. Shard files of a snapshot sit next to it as <name>.history-NN.db.gz."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(BACKUP_DIR)
+        if name.endswith('.db.gz') and '.history-' not in name
+    )
+
+def backup_shard_names(name: str) -> List[str]:
+    """Archive names for the current shards of the snapshot ``name`` (a list_backups() entry)."""
+    stem = name[:-len('.db.gz')]
+    return [f"{stem}.{os.path.basename(path)}.gz" for path in history_shards.shard_paths()]
+
+def remove_backup(name: str) -> None:
+    stem = name[:-len('.db.gz')]
+    for file_name in os.listdir(BACKUP_DIR):
+        if file_name == name or file_name.startswith(stem + '.history-'):
+            os.remove(os.path.join(BACKUP_DIR, file_name))
+
+async def snapshot_file(source_path: str, archive_path: str) -> None:
+    async with aiosqlite.connect(source_path) as source:
+        await source.execute('VACUUM INTO ?', (archive_path[:-len('.gz')],))
+
+def compress_snapshot(archive_path: str) -> int:
+    snapshot_path = archive_path[:-len('.gz')]
+    compress_file(snapshot_path, archive_path)
+    os.remove(snapshot_path)
+    return os.path.getsize(archive_path)
+
+async def create_backup() -> str:
+    """Snapshot DB_NAME and every history shard with VACUUM INTO, then gzip them.
+
+    VACUUM INTO reads inside one transaction, so each copy is consistent. On a WAL
+    database that read does not block writers, unlike the stepwise backup API,
+    which restarts whenever another connection writes between steps. So that the
+    files also agree with each other (shard rows vs. counters batched into DB_NAME,
+    rows moved out of DB_NAME), the batch writer, shard writers and the move are
+    paused until the last copy is taken; compression runs after they resume.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    started_at = time.monotonic()
+    name = f"database-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db.gz"
+    archive_path = os.path.join(BACKUP_DIR, name)
+    # Shards first: every compression dictionary their rows reference is then still in the main snapshot.
+    archive_paths = [os.path.join(BACKUP_DIR, shard_name) for shard_name in backup_shard_names(name)]
+    archive_paths.append(archive_path)
+
+    await db_writer.flush()
+    async with db_writer.flush_lock:
+        await history_shards.pause()
+        try:
+            for path, target in zip(history_shards.shard_paths() + [DB_NAME], archive_paths):
+                await snapshot_file(path, target)
+        finally:
+            history_shards.resume()
+
+    size = 0
+    for target in archive_paths:
+        size += await asyncio.to_thread(compress_snapshot, target)
+
+    for old_name in list_backups()[:-BACKUP_KEEP]:
+        remove_backup(old_name)
+
+    backup_stats.update(
+        path=archive_path,
+        duration=time.monotonic() - started_at,
+        size=size,
+        finished_at=time.time()
+    )
+    logger.info(f"Backup {archive_path} written in {backup_stats['duration']:.1f}s ({backup_stats['size']} bytes)")
+    return archive_path
+
+async def restore_file(archive_path: str, target_path: str) -> None:
+    snapshot_path = archive_path[:-len('.gz')]
+    await asyncio.to_thread(decompress_file, archive_path, snapshot_path)
+    try:
+        async with aiosqlite.connect(snapshot_path) as source, aiosqlite.connect(target_path) as target:
+            await source.backup(target)
+    finally:
+        os.remove(snapshot_path)
+
+async def restore_backup(name: str) -> None:
+    """Copy a snapshot over DB_NAME and the history shards with background writers paused.
+
+    Pending batched writes are flushed first and the batch writer stays locked until
+    the copy is done; shard writers are closed and their locks held. Each file is
+    copied in a single backup step, so it happens under one write lock and handlers
+    that write meanwhile just wait on the busy timeout.
+    """
+    shard_names = backup_shard_names(name)
+    missing = [shard_name for shard_name in shard_names if not os.path.exists(os.path.join(BACKUP_DIR, shard_name))]
+    if missing:
+        raise ValueError(f"в бэкапе нет файлов шардов: {', '.join(missing)}")
+
+    await db_writer.flush()
+    async with db_writer.flush_lock:
+        await history_shards.pause()
+        try:
+            await restore_file(os.path.join(BACKUP_DIR, name), DB_NAME)
+            for path, shard_name in zip(history_shards.shard_paths(), shard_names):
+                await restore_file(os.path.join(BACKUP_DIR, shard_name), path)
+        finally:
+            history_shards.resume()
+
+    # Nothing read from or counted against the replaced files may stay in memory.
+    await module_registry.load()
+    await known_entities.load()
+    await message_codec.load()
+    storage_policies.policies.clear()
+    word_frequencies.entries.clear()
+    distinct_counters.entries.clear()
+    heatmap_cache.clear()
+    interaction_cache.clear()
+    hidden_messages_cache.items.clear()
+    # The snapshot may predate a finished move out of DB_NAME.
+    history_shards.moved.clear()
+    asyncio.create_task(history_shards.move_from_main())
+
+async def run_scheduled_backups():
+    await migrations_done.wait()
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            await create_backup()
+        except Exception as e:
+            logging.error(f"Ошибка создания бэкапа: {e}")
+
+@router.message(Command("backup"))
+async def backup_command(message: Message):
+    """/backup [list]"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+
+    args = message.text.split()[1:]
+    if args and args[0] == "list":
+        backups = list_backups()
+        text = "\n".join(f"• <code>{name}</code>" for name in backups) if backups else "❌ Нет бэкапов"
+        await message.answer(f"💾 <b>Бэкапы:</b>\n{text}")
+        return
+
+    await message.answer("⏳ Создаю бэкап...")
+    try:
+        await create_backup()
+        await message.answer(f"✅ Бэкап создан: {format_backup_stats()}")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка бэкапа: <code>{html.escape(str(e))}</code>")
+
+@router.message(Command("restore"))
+async def restore_command(message: Message):
+    """/restore <name>"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+
+    args = message.text.split()[1:]
+    if not args or args[0] not in list_backups():
+        await message.answer("❌ Укажите имя бэкапа из <code>/backup list</code>.")
+        return
+
+    await message.answer(f"⏳ Восстанавливаю <code>{html.escape(args[0])}</code>...")
+    try:
+        await restore_backup(args[0])
+        await message.answer("✅ База данных восстановлена.")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка восстановления: <code>{html.escape(str(e))}</code>")
+
 @router.callback_query(lambda c: c.data == "broadcast")
 async def handle_broadcast_callback(callback: CallbackQuery, state: FSMContext):
     if callback.from_user.id != ADMIN_USER_ID:
@@ -588,19 +2542,16 @@ async def process_user_for_deletion(message: Message, state: FSMContext, bot: Bo
         return
     
     try:
-        user = await bot.get_chat(user_id)
-        
-        async with aiosqlite.connect(DB_NAME) as db:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM message_history WHERE user_id = ?",
-                (user_id,))
-            message_count = (await cursor.fetchone())[0]
-            
-            cursor = await db.execute(
-                "SELECT COUNT(DISTINCT chat_id) FROM message_history WHERE user_id = ?",
-                (user_id,))
-            groups_count = (await cursor.fetchone())[0]
-            
+        user = await chat_resolver.get_chat(bot, user_id)
+        
+        # A chat lives in a single shard, so per-shard distinct counts add up.
+        shard_counts = await history_shards.fetch_all(
+            "SELECT COUNT(*), COUNT(DISTINCT chat_id) FROM message_history WHERE user_id = ?",
+            (user_id,))
+        message_count = sum(rows[0][0] for rows in shard_counts)
+        groups_count = sum(rows[0][1] for rows in shard_counts)
+
+        async with aiosqlite.connect(DB_NAME) as db:
             cursor = await db.execute(
                 "SELECT joined_timestamp FROM users WHERE user_id = ?",
                 (user_id,))
@@ -654,28 +2605,25 @@ async def confirm_user_deletion(callback: CallbackQuery, state: FSMContext, bot:
     user_id = int(callback.data.split("_")[2])
     
     try:
-        user = await bot.get_chat(user_id)
+        user = await chat_resolver.get_chat(bot, user_id)
         
         async with aiosqlite.connect(DB_NAME) as db:
             await db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-            await db.execute("DELETE FROM message_history WHERE user_id = ?", (user_id,))
             await db.execute("DELETE FROM last_button_press WHERE user_id = ?", (user_id,))
             await db.commit()
+            known_entities.forget_user(user_id)
             
             cursor = await db.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
             if await cursor.fetchone():
                 raise Exception("Не удалось удалить пользователя из базы данных")
         
-        success_msg = (
-            f"✅ Пользователь <code>{user_id}</code> успешно удален!\n\n"
-            f"📛 Имя: {html.escape(user.first_name)}\n"
-            f"👤 Username: @{user.username if user.username else 'нет'}\n\n"
-            f"Все данные безвозвратно удалены из системы."
-        )
-        
         await callback.message.delete()
         
-        await callback.message.answer(success_msg)
+        progress_msg = await callback.message.answer(
+            f"🗑 Пользователь <code>{user_id}</code> ({html.escape(user.first_name)}) удален из списка пользователей.\n"
+            f"⏳ Удаление истории запущено в фоне..."
+        )
+        await start_user_purge(bot, user_id, progress_msg.chat.id, progress_msg.message_id)
         
         logger.warning(f"Администратор удалил пользователя {user_id} ({user.first_name})")
         
@@ -689,6 +2637,149 @@ async def confirm_user_deletion(callback: CallbackQuery, state: FSMContext, bot:
     await state.clear()
     await callback.answer()
 
+PURGE_BATCH_SIZE = 500
+PURGE_PROGRESS_EVERY = 20
+
+# Each statement removes at most one batch (?2) of rows linked to user ?1 and seeks an index.
+# message_history steps run on every history file, the rest on DB_NAME.
+PURGE_STEPS = [
+    ('message_history', '''
+        DELETE FROM message_history WHERE id IN (
+            SELECT id FROM message_history WHERE user_id = ?1 LIMIT ?2
+        )
+    '''),
+    ('message_history', '''
+        UPDATE message_history SET target_user_id = NULL WHERE id IN (
+            SELECT id FROM message_history WHERE target_user_id = ?1 LIMIT ?2
+        )
+    '''),
+    ('hidden_messages', '''
+        DELETE FROM hidden_messages WHERE rowid IN (
+            SELECT rowid FROM hidden_messages WHERE creator_id = ?1 LIMIT ?2
+        )
+    '''),
+    ('hidden_messages', '''
+        DELETE FROM hidden_messages WHERE rowid IN (
+            SELECT rowid FROM hidden_messages WHERE target_user_id = ?1 LIMIT ?2
+        )
+    '''),
+    ('pending_free_premium_requests', '''
+        DELETE FROM pending_free_premium_requests WHERE id IN (
+            SELECT id FROM pending_free_premium_requests WHERE user_id = ?1 LIMIT ?2
+        )
+    '''),
+]
+
+def purge_user_from_archive(user_id: int) -> int:
+    """Rewrite message_history archive segments without the user's rows."""
+    removed = 0
+    root = os.path.join(ARCHIVE_DIR, 'message_history')
+    if not os.path.isdir(root):
+        return 0
+    for chat_dir in os.listdir(root):
+        directory = os.path.join(root, chat_dir)
+        for name in os.listdir(directory):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            path = os.path.join(directory, name)
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f]
+            kept = [row for row in rows if row['user_id'] != user_id]
+            if len(kept) == len(rows):
+                continue
+            removed += len(rows) - len(kept)
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                for row in kept:
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, path)
+    return removed
+
+async def start_user_purge(bot: Bot, user_id: int, admin_chat_id: int, progress_message_id: int):
+    async with aiosqlite.connect(DB_NAME) as db:
+        await db.execute('''
+            INSERT OR REPLACE INTO purge_jobs
+            (user_id, status, deleted_rows, admin_chat_id, progress_message_id, started_at)
+            VALUES (?, 'running', 0, ?, ?, ?)
+        ''', (user_id, admin_chat_id, progress_message_id, int(time.time())))
+        await db.commit()
+    asyncio.create_task(run_user_purge(bot, user_id))
+
+async def edit_progress_message(bot: Bot, admin_chat_id: int, progress_message_id: int, text: str):
+    try:
+        await bot.edit_message_text(text, chat_id=admin_chat_id, message_id=progress_message_id)
+    except Exception as e:
+        logging.error(f"Не удалось обновить сообщение о прогрессе: {e}")
+
+async def run_user_purge(bot: Bot, user_id: int):
+    """Delete a user's rows in small batches. Safe to restart: every batch is committed on its own."""
+    await migrations_done.wait()
+    try:
+        forget_hidden_messages(user_id)
+        # Queued hidden-message drafts must land before the batches below can delete them.
+        await db_writer.flush()
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute(
+                'SELECT deleted_rows, admin_chat_id, progress_message_id FROM purge_jobs WHERE user_id = ?',
+                (user_id,)
+            )
+            deleted_rows, admin_chat_id, progress_message_id = await cursor.fetchone()
+
+            batches = 0
+            for table, sql in PURGE_STEPS:
+                paths = history_shards.paths() if table == 'message_history' else [DB_NAME]
+                for path in paths:
+                    async with aiosqlite.connect(path) as target_db:
+                        while True:
+                            cursor = await target_db.execute(sql, (user_id, PURGE_BATCH_SIZE))
+                            rowcount = cursor.rowcount
+                            await target_db.commit()
+                            deleted_rows += rowcount
+                            await db.execute(
+                                'UPDATE purge_jobs SET deleted_rows = ? WHERE user_id = ?',
+                                (deleted_rows, user_id)
+                            )
+                            await db.commit()
+                            batches += 1
+
+                            if batches % PURGE_PROGRESS_EVERY == 0:
+                                await edit_progress_message(
+                                    bot, admin_chat_id, progress_message_id,
+                                    f"⏳ Удаление данных пользователя <code>{user_id}</code>...\n"
+                                    f"📦 Таблица: <code>{table}</code>\n"
+                                    f"🗑 Удалено записей: <code>{deleted_rows}</code>"
+                                )
+
+                            if rowcount < PURGE_BATCH_SIZE:
+                                break
+                            # Let ingestion writers in between batches.
+                            await asyncio.sleep(0.05)
+
+            deleted_rows += await asyncio.to_thread(purge_user_from_archive, user_id)
+
+            await db.execute('''
+                UPDATE purge_jobs SET status = 'done', deleted_rows = ?, finished_at = ?
+                WHERE user_id = ?
+            ''', (deleted_rows, int(time.time()), user_id))
+            await db.commit()
+
+        await edit_progress_message(
+            bot, admin_chat_id, progress_message_id,
+            f"✅ Пользователь <code>{user_id}</code> успешно удален!\n\n"
+            f"🗑 Удалено записей: <code>{deleted_rows}</code>\n"
+            f"Все данные безвозвратно удалены из системы."
+        )
+    except Exception as e:
+        logging.error(f"Ошибка удаления данных пользователя {user_id}: {e}")
+
+async def resume_user_purges(bot: Bot):
+    async with aiosqlite.connect(DB_NAME) as db:
+        cursor = await db.execute("SELECT user_id FROM purge_jobs WHERE status = 'running'")
+        user_ids = [row[0] for row in await cursor.fetchall()]
+    for user_id in user_ids:
+        logger.info(f"Resuming purge of user {user_id}")
+        asyncio.create_task(run_user_purge(bot, user_id))
+
 @router.callback_query(F.data == "cancel_delete")
 async def cancel_user_deletion(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text("❌ Удаление пользователя отменено.")
@@ -708,10 +2799,9 @@ async def process_group_id(message: Message, state: FSMContext, bot: Bot):
     try:
         group_id = int(message.text)
         try:
-            chat = await bot.get_chat(group_id)
+            chat = await chat_resolver.get_chat(bot, group_id)
             
-            bot_member = await bot.get_chat_member(group_id, bot.id)
-            if not bot_member.status == ChatMemberStatus.ADMINISTRATOR:
+            if not await chat_resolver.is_admin(bot, group_id, bot.id):
                 await message.answer("❌ Бот не является администратором в этой группе!")
                 await state.clear()
                 return
@@ -756,7 +2846,7 @@ async def process_group_premium_days(message: Message, state: FSMContext, bot: B
                 INSERT OR REPLACE INTO premium_groups 
                 (group_id, user_id, end_date) 
                 VALUES (?, ?, ?)
-            ''', (group_id, ADMIN_USER_ID, end_date.isoformat()))
+            ''', (group_id, ADMIN_USER_ID, int(end_date.timestamp())))
             
             if backup:
                 settings = json.loads(backup[0])
@@ -772,6 +2862,7 @@ async def process_group_premium_days(message: Message, state: FSMContext, bot: B
                         INSERT OR REPLACE INTO group_modules 
                         (group_id, module_name, is_active) VALUES (?, ?, ?)
                     ''', (group_id, module_name, is_active))
+                    await module_registry.set_enabled(group_id, module_name, bool(is_active))
                 
                 await db.execute('DELETE FROM group_settings_backup WHERE group_id = ?', (group_id,))
             
@@ -801,7 +2892,93 @@ async def process_group_premium_days(message: Message, state: FSMContext, bot: B
 #==============================================================================================
 #==============================================================================================
 
-available_modules = ['ping', 'bansticker', 'triggers', 'pl']
+available_modules = ['ping', 'bansticker', 'triggers', 'pl', 'search']
+
+class ModuleRegistry:
+    """In-memory view of group_modules: one bitmask per group.
+
+    Bit ``i`` is set when ``available_modules[i]`` is active. Loaders
+    registered for a module run once, the first time any group enables it.
+    """
+
+    def __init__(self, modules: List[str]):
+        self.bits = {name: 1 << index for index, name in enumerate(modules)}
+        self.group_masks: Dict[int, int] = {}
+        self.loaders: Dict[str, object] = {}
+        self.loaded: Set[str] = set()
+
+    def loader(self, module_name: str):
+        def decorator(func):
+            self.loaders[module_name] = func
+            return func
+        return decorator
+
+    async def load(self) -> None:
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute(
+                'SELECT group_id, module_name FROM group_modules WHERE is_active = 1'
+            )
+            rows = await cursor.fetchall()
+
+        self.group_masks.clear()
+        for group_id, module_name in rows:
+            bit = self.bits.get(module_name)
+            if bit:
+                self.group_masks[group_id] = self.group_masks.get(group_id, 0) | bit
+
+        for module_name in self.bits:
+            if any(mask & self.bits[module_name] for mask in self.group_masks.values()):
+                await self.ensure_loaded(module_name)
+
+    async def ensure_loaded(self, module_name: str) -> None:
+        if module_name in self.loaded:
+            return
+        self.loaded.add(module_name)
+        loader = self.loaders.get(module_name)
+        if loader:
+            try:
+                await loader()
+                logger.info(f"Loaded module {module_name}")
+            except Exception as e:
+                logging.error(f"Ошибка загрузки модуля {module_name}: {e}")
+
+    def is_enabled(self, group_id: int, module_name: str) -> bool:
+        return bool(self.group_masks.get(group_id, 0) & self.bits.get(module_name, 0))
+
+    def enabled_modules(self, group_id: int) -> List[str]:
+        mask = self.group_masks.get(group_id, 0)
+        return [name for name, bit in self.bits.items() if mask & bit]
+
+    async def set_enabled(self, group_id: int, module_name: str, is_active: bool) -> None:
+        bit = self.bits.get(module_name)
+        if not bit:
+            return
+        mask = self.group_masks.get(group_id, 0)
+        mask = mask | bit if is_active else mask & ~bit
+        if mask:
+            self.group_masks[group_id] = mask
+        else:
+            self.group_masks.pop(group_id, None)
+        if is_active:
+            await self.ensure_loaded(module_name)
+
+    def clear(self, group_id: int) -> None:
+        self.group_masks.pop(group_id, None)
+
+module_registry = ModuleRegistry(available_modules)
+
+class ModuleFilter(BaseFilter):
+    def __init__(self, module_name: str):
+        self.module_name = module_name
+
+    async def __call__(self, event) -> bool:
+        if isinstance(event, CallbackQuery):
+            if not event.message:
+                return False
+            chat_id = event.message.chat.id
+        else:
+            chat_id = event.chat.id
+        return module_registry.is_enabled(chat_id, self.module_name)
 
 group_subscription_prices = {
     1: 100,   # 200 руб. / 2 = 100 XTR
@@ -840,6 +3017,14 @@ async def get_group_config_keyboard(chat_id: int, has_premium: bool, response_ch
             )
         ])
     
+    policy, _ = await storage_policies.get(chat_id)
+    buttons.append([
+        InlineKeyboardButton(
+            text=f"💾 Хранение: {STORAGE_POLICY_LABELS[policy]}",
+            callback_data=f"config_storage_{chat_id}_{initiator_id}"
+        )
+    ])
+    
     buttons.append([
         InlineKeyboardButton(
             text="🔄 Продлить подписку" if has_premium else "💎 Оформить подписку",
@@ -849,17 +3034,418 @@ async def get_group_config_keyboard(chat_id: int, has_premium: bool, response_ch
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-last_press_times = {}
+class ExpiringStore:
+    """Dict with a TTL counted from the last set() and a hard size cap (oldest evicted first).
 
-async def check_flood(user_id: int, interval: int = 1) -> bool:
-    current_time = time.time()
-    last_press = last_press_times.get(user_id, 0)
-    
-    if current_time - last_press < interval:
+    get() does not refresh the TTL, so cached values are re-read at least once per ttl.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items: "OrderedDict[object, tuple]" = OrderedDict()
+
+    def get(self, key, now: float):
+        entry = self.items.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > self.ttl:
+            del self.items[key]
+            return None
+        return entry[1]
+
+    def set(self, key, value, now: float) -> None:
+        self.items[key] = (now, value)
+        self.items.move_to_end(key)
+        self.evict(now)
+
+    def evict(self, now: float) -> None:
+        items = self.items
+        while items:
+            key, (touched_at, _) = next(iter(items.items()))
+            if len(items) <= self.max_size and now - touched_at <= self.ttl:
+                break
+            del items[key]
+
+    def invalidate(self, key) -> None:
+        self.items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+class TokenBucketLimiter:
+    def __init__(self, capacity: float, refill_rate: float, max_keys: int = 100_000):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        # An idle bucket is full again after capacity / refill_rate seconds, so it can be forgotten.
+        self.buckets = ExpiringStore(ttl=capacity / refill_rate, max_size=max_keys)
+
+    def allow(self, key, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self.buckets.get(key, now)
+        if bucket is None:
+            tokens = self.capacity
+        else:
+            tokens, updated = bucket
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_rate)
+
+        if tokens < 1:
+            return False
+
+        self.buckets.set(key, (tokens - 1, now), now)
         return True
-    
-    last_press_times[user_id] = current_time
-    return False
+
+# Text commands matched by lambda/F filters, which register_commands() can't see.
+FLOOD_TEXT_COMMANDS = {'.cfg', '.module', '.pl', '.пинг', '.бот'}
+# Plain words that are commands only as the whole message; "бот, привет" is ordinary chat.
+FLOOD_EXACT_COMMANDS = {'пинг', 'бот'}
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Outer middleware limiting callbacks and commands per user and per chat.
+
+    Only messages whose first word is a known command are throttled; ordinary
+    messages (history, triggers, AI replies) always reach the handlers.
+    """
+
+    def __init__(self, user_limiter: TokenBucketLimiter, chat_limiter: TokenBucketLimiter,
+                 commands: Set[str] = frozenset(), exact_commands: Set[str] = frozenset()):
+        self.user_limiter = user_limiter
+        self.chat_limiter = chat_limiter
+        self.commands = set(commands)
+        self.exact_commands = set(exact_commands)
+
+    def register_commands(self, router: Router) -> None:
+        """Add every prefix + name of the Command filters on router's message handlers."""
+        for handler in router.message.handlers:
+            for handler_filter in handler.filters or ():
+                command = handler_filter.callback
+                if isinstance(command, Command):
+                    self.commands.update(
+                        prefix + name.lower()
+                        for name in command.commands if isinstance(name, str)
+                        for prefix in command.prefix
+                    )
+
+    def is_command(self, text: Optional[str]) -> bool:
+        if not text or not text.strip():
+            return False
+        if text.strip().lower() in self.exact_commands:
+            return True
+        return text.split(maxsplit=1)[0].split('@', 1)[0].lower() in self.commands
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            chat_id = event.message.chat.id if event.message else None
+        elif isinstance(event, Message):
+            if not self.is_command(event.text):
+                return await handler(event, data)
+            chat_id = event.chat.id
+        else:
+            return await handler(event, data)
+
+        user_id = event.from_user.id if event.from_user else None
+        now = time.monotonic()
+        if user_id is not None and not self.user_limiter.allow(user_id, now) or \
+                chat_id is not None and chat_id != user_id and not self.chat_limiter.allow(chat_id, now):
+            if isinstance(event, CallbackQuery):
+                await event.answer("⏳ Подождите немножечко", show_alert=False)
+            return None
+
+        return await handler(event, data)
+
+flood_middleware = FloodControlMiddleware(
+    user_limiter=TokenBucketLimiter(capacity=3, refill_rate=1),
+    chat_limiter=TokenBucketLimiter(capacity=20, refill_rate=5),
+    commands=FLOOD_TEXT_COMMANDS,
+    exact_commands=FLOOD_EXACT_COMMANDS
+)
+
+class ChatResolver:
+    """TTL cache for chat administrators and chat metadata.
+
+    Entries are dropped on chat_member / my_chat_member updates, so the TTL
+    only bounds staleness for changes the bot was not told about.
+    """
+
+    def __init__(self, admins_ttl: float = 600, chat_ttl: float = 3600, max_chats: int = 50_000):
+        self.admins = ExpiringStore(ttl=admins_ttl, max_size=max_chats)
+        self.chats = ExpiringStore(ttl=chat_ttl, max_size=max_chats)
+
+    async def get_admin_ids(self, bot: Bot, chat_id: int) -> Set[int]:
+        now = time.monotonic()
+        admin_ids = self.admins.get(chat_id, now)
+        if admin_ids is None:
+            administrators = await bot.get_chat_administrators(chat_id)
+            admin_ids = frozenset(member.user.id for member in administrators)
+            self.admins.set(chat_id, admin_ids, now)
+        return admin_ids
+
+    async def is_admin(self, bot: Bot, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.get_admin_ids(bot, chat_id)
+
+    async def get_chat(self, bot: Bot, chat_id: int):
+        now = time.monotonic()
+        chat = self.chats.get(chat_id, now)
+        if chat is None:
+            chat = await bot.get_chat(chat_id)
+            self.chats.set(chat_id, chat, now)
+        return chat
+
+    def invalidate(self, chat_id: int) -> None:
+        self.admins.invalidate(chat_id)
+        self.chats.invalidate(chat_id)
+
+chat_resolver = ChatResolver()
+
+class GroupContext:
+    """Everything a group handler needs, resolved once per update."""
+
+    def __init__(self, bot: Bot, chat_id: int, user_id: int, first_name: str, is_group: bool,
+                 response_chance: Optional[int], has_premium: bool, max_latency: Optional[float] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.first_name = first_name
+        self.is_group = is_group
+        self.response_chance = response_chance
+        self.has_premium = has_premium
+        self.max_latency = max_latency
+        self._is_admin: Optional[bool] = None
+
+    def has_module(self, module_name: str) -> bool:
+        return module_registry.is_enabled(self.chat_id, module_name)
+
+    async def is_admin(self) -> bool:
+        if self._is_admin is None:
+            try:
+                self._is_admin = await chat_resolver.is_admin(self.bot, self.chat_id, self.user_id)
+            except Exception as e:
+                logging.error(f"Ошибка проверки прав в {self.chat_id}: {e}")
+                self._is_admin = False
+        return self._is_admin
+
+async def load_group_settings(chat_id: int) -> tuple:
+    """(response_chance, has_premium, max_latency) of a group in one query."""
+    async with aiosqlite.connect(DB_NAME) as db:
+        cursor = await db.execute('''
+            SELECT
+                (SELECT response_chance FROM group_config WHERE chat_id = :chat_id),
+                (SELECT end_date FROM premium_groups WHERE group_id = :chat_id),
+                (SELECT max_latency FROM group_latency WHERE chat_id = :chat_id)
+        ''', {'chat_id': chat_id})
+        response_chance, end_date, max_latency = await cursor.fetchone()
+
+    has_premium = bool(end_date) and parse_end_date(end_date) > datetime.now()
+    return response_chance, has_premium, max_latency
+
+class GroupContextMiddleware(BaseMiddleware):
+    """Outer message middleware injecting ``group_context`` into handlers."""
+
+    def __init__(self):
+        self.db_round_trips = 0
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, Message) or not event.from_user:
+            return await handler(event, data)
+
+        is_group = event.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP)
+        response_chance, has_premium, max_latency = None, False, None
+        if is_group:
+            response_chance, has_premium, max_latency = await load_group_settings(event.chat.id)
+            self.db_round_trips += 1
+
+        data['group_context'] = GroupContext(
+            bot=data['bot'],
+            chat_id=event.chat.id,
+            user_id=event.from_user.id,
+            first_name=html.escape(event.from_user.first_name),
+            is_group=is_group,
+            response_chance=response_chance,
+            has_premium=has_premium,
+            max_latency=max_latency
+        )
+        return await handler(event, data)
+
+group_context_middleware = GroupContextMiddleware()
+
+EXPORT_DIR = 'exports'
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_PROGRESS_EVERY = 25
+# Bot API documents are capped at 50 MB; the margin covers output still buffered in the compressor.
+EXPORT_PART_SIZE = 45 * 1024 * 1024
+EXPORT_FIELDS = {
+    'history': ['id', 'user_id', 'target_user_id', 'message_text', 'timestamp'],
+    'stats': ['day', 'message_count'],
+}
+
+active_exports: Set[int] = set()
+
+async def iter_export_chunks(kind: str, chat_id: int):
+    """Yield lists of row dicts, at most EXPORT_CHUNK_SIZE at a time.
+
+    Every chunk is its own short keyset query, so no read transaction stays open
+    between chunks and writers are never held up by a long export.
+    """
+    # The history keyset needs message_history.id (migration 6).
+    await migrations_done.wait()
+    if kind == 'stats':
+        last_day = ''
+        while True:
+            async with aiosqlite.connect(DB_NAME) as db:
+                cursor = await db.execute('''
+                    SELECT day, message_count FROM daily_stats
+                    WHERE chat_id = ? AND day > ?
+                    ORDER BY day
+                    LIMIT ?
+                ''', (chat_id, last_day, EXPORT_CHUNK_SIZE))
+                rows = await cursor.fetchall()
+            if not rows:
+                return
+            last_day = rows[-1][0]
+            yield [{'day': day, 'message_count': count} for day, count in rows]
+        return
+
+    chunk = []
+    async for row in iter_archived_rows('message_history', chat_id):
+        chunk.append(row)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+    async for rows in history_shards.iter_chunks(chat_id, '''
+        SELECT id, timestamp, user_id, target_user_id, message_text
+        FROM message_history
+        WHERE chat_id = ? AND (timestamp, id) > (?, ?)
+        ORDER BY timestamp, id
+        LIMIT ?
+    ''', (-1, -1), EXPORT_CHUNK_SIZE):
+        yield [
+            {
+                'id': r[0], 'user_id': r[2], 'target_user_id': r[3],
+                'message_text': message_codec.decode(r[4]), 'timestamp': r[1]
+            }
+            for r in rows
+        ]
+
+def write_export_chunk(f, fmt: str, fields: List[str], rows: List[dict]) -> None:
+    if fmt == 'csv':
+        csv.DictWriter(f, fieldnames=fields).writerows(rows)
+    else:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+async def run_export(bot: Bot, chat_id: int, kind: str, fmt: str, recipient_id: int,
+                     progress_chat_id: int, progress_message_id: int):
+    """Stream one chat's rows into gzip files chunk by chunk, then send them to the requester privately.
+
+    A new part is started once the current one reaches EXPORT_PART_SIZE, so every document
+    stays under the Bot API limit and each part is a complete file on its own.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    stem = f"{kind}-{chat_id}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    fields = EXPORT_FIELDS[kind]
+    parts: List[str] = []
+    exported = 0
+    chunks = 0
+
+    def open_part():
+        path = os.path.join(EXPORT_DIR, f"{stem}.part{len(parts) + 1:03d}.{fmt}.gz")
+        parts.append(path)
+        f = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        if fmt == 'csv':
+            csv.writer(f).writerow(fields)
+        return f
+
+    try:
+        f = open_part()
+        try:
+            async for rows in iter_export_chunks(kind, chat_id):
+                if os.path.getsize(parts[-1]) >= EXPORT_PART_SIZE:
+                    f.close()
+                    f = open_part()
+                await asyncio.to_thread(write_export_chunk, f, fmt, fields, rows)
+                exported += len(rows)
+                chunks += 1
+                if chunks % EXPORT_PROGRESS_EVERY == 0:
+                    await edit_progress_message(
+                        bot, progress_chat_id, progress_message_id,
+                        f"⏳ Экспорт <code>{chat_id}</code>...\n📦 Выгружено записей: <code>{exported}</code>"
+                    )
+        finally:
+            f.close()
+
+        for number, path in enumerate(parts, 1):
+            if len(parts) == 1:
+                filename, part_caption = f"{stem}.{fmt}.gz", ""
+            else:
+                filename, part_caption = os.path.basename(path), f", часть {number}/{len(parts)}"
+            await bot.send_document(
+                recipient_id,
+                FSInputFile(path, filename=filename),
+                caption=f"📦 Экспорт <code>{chat_id}</code>: <code>{exported}</code> записей{part_caption}"
+            )
+        delivered = " Файл отправлен в личные сообщения." if recipient_id != progress_chat_id else ""
+        await edit_progress_message(
+            bot, progress_chat_id, progress_message_id,
+            f"✅ Экспорт <code>{chat_id}</code> завершён: <code>{exported}</code> записей.{delivered}"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка экспорта {chat_id}: {e}")
+        await edit_progress_message(
+            bot, progress_chat_id, progress_message_id,
+            f"❌ Ошибка экспорта: <code>{html.escape(str(e))}</code>"
+            + ("\nЕсли бот не может написать вам, начните с ним личный диалог." if recipient_id != progress_chat_id else "")
+        )
+    finally:
+        active_exports.discard(chat_id)
+        for path in parts:
+            if os.path.exists(path):
+                os.remove(path)
+
+@router.message(Command("export"))
+async def export_command(message: Message, bot: Bot, group_context: GroupContext):
+    """/export [history|stats] [csv|jsonl] [chat_id]"""
+    kind, fmt, chat_id = 'history', 'jsonl', None
+    for arg in message.text.split()[1:]:
+        if arg in EXPORT_FIELDS:
+            kind = arg
+        elif arg in ('csv', 'jsonl'):
+            fmt = arg
+        elif arg.lstrip('-').isdigit():
+            chat_id = int(arg)
+
+    is_bot_admin = message.from_user.id == ADMIN_USER_ID
+    if group_context.is_group:
+        if chat_id is not None and not is_bot_admin:
+            chat_id = None
+        chat_id = chat_id or message.chat.id
+        if not is_bot_admin and not await group_context.is_admin():
+            await message.reply("❌ Экспорт доступен только администраторам группы.")
+            return
+    elif not is_bot_admin:
+        return
+    elif chat_id is None:
+        await message.answer("❌ Укажите ID группы: <code>/export [history|stats] [csv|jsonl] &lt;chat_id&gt;</code>")
+        return
+
+    if chat_id in active_exports:
+        await message.reply("⏳ Экспорт этой группы уже выполняется.")
+        return
+
+    active_exports.add(chat_id)
+    try:
+        progress = await message.reply(f"⏳ Экспорт <code>{chat_id}</code> начат...")
+    except Exception:
+        active_exports.discard(chat_id)
+        raise
+    # Exports contain the whole chat history, so the file goes to the requester's private chat, never to the group.
+    asyncio.create_task(run_export(
+        bot, chat_id, kind, fmt, message.from_user.id, message.chat.id, progress.message_id
+    ))
 
 async def check_group_premium_status(group_id: int) -> bool:
     async with aiosqlite.connect('database.db') as db:
@@ -869,16 +3455,11 @@ async def check_group_premium_status(group_id: int) -> bool:
         )
         result = await cursor.fetchone()
         if result:
-            return datetime.fromisoformat(result[0]) > datetime.now()
+            return parse_end_date(result[0]) > datetime.now()
     return False
 
 @router.callback_query(lambda c: c.data.startswith("back_to_config_"))
 async def back_to_config_handler(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-
-
     data = callback.data.split("_")
     group_id = int(data[3])
     initiator_id = int(data[4])
@@ -892,8 +3473,7 @@ async def back_to_config_handler(callback: CallbackQuery, bot: Bot):
     try:
         has_premium = await check_group_premium_status(group_id)
 
-        member = await bot.get_chat_member(group_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await chat_resolver.is_admin(bot, group_id, user_id):
             await callback.answer("❌ Нужны права админа!", show_alert=True)
             return
 
@@ -903,7 +3483,7 @@ async def back_to_config_handler(callback: CallbackQuery, bot: Bot):
                 (group_id,)
             )
             result = await cursor.fetchone()
-            has_premium = result and datetime.fromisoformat(result[0]) > datetime.now()
+            has_premium = result and parse_end_date(result[0]) > datetime.now()
 
             response_chance = 1
             if has_premium:
@@ -925,10 +3505,6 @@ async def back_to_config_handler(callback: CallbackQuery, bot: Bot):
 
 @router.callback_query(lambda c: c.data.startswith("group_subscribe_"))
 async def group_subscribe_handler(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-
     data = callback.data.split("_")
     chat_id = int(data[2])
     initiator_id = int(data[3])
@@ -940,8 +3516,7 @@ async def group_subscribe_handler(callback: CallbackQuery, bot: Bot):
         return
 
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await chat_resolver.is_admin(bot, chat_id, user_id):
             await callback.answer("❌ Нужны права админа!", show_alert=True)
             return
 
@@ -954,7 +3529,7 @@ async def group_subscribe_handler(callback: CallbackQuery, bot: Bot):
             
             text = f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n 🌟 Выберите срок Premium подписки для группы\n\n"
             if result:
-                end_date = datetime.fromisoformat(result[0])
+                end_date = parse_end_date(result[0])
                 if end_date > datetime.now():
                     remaining = end_date - datetime.now()
                     text += f"🔹 Текущая подписка активна до: {end_date.strftime('%d.%m.%Y %H:%M')}\n"
@@ -974,9 +3549,6 @@ async def group_subscribe_handler(callback: CallbackQuery, bot: Bot):
 
 @router.callback_query(lambda c: c.data.startswith("gpremium_"))
 async def process_group_premium_purchase(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
     data = callback.data.split("_")
     group_id = int(data[1])
     months = int(data[2])
@@ -1000,22 +3572,14 @@ async def process_group_premium_purchase(callback: CallbackQuery, bot: Bot):
                 await callback.answer("❌ Ваш аккаунт удален.", show_alert=True)
                 return
 
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT 1 FROM users WHERE user_id = ?',
-                (user_id,)
+        if user_id not in known_entities.users:
+            await callback.answer(
+                "❌ Сначала начните с /start",
+                show_alert=True
             )
-            user_exists = await cursor.fetchone()
-            
-            if not user_exists:
-                await callback.answer(
-                    "❌ Сначала начните с /start",
-                    show_alert=True
-                )
-                return
+            return
 
-        member = await bot.get_chat_member(group_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await chat_resolver.is_admin(bot, group_id, user_id):
             await callback.answer("❌ Нужны права админа!", show_alert=True)
             return
         
@@ -1050,7 +3614,7 @@ async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery):
 
 async def send_group_invoice(user_id: int, group_id: int, months: int, amount_xtr: int, bot: Bot):
     try:
-        chat = await bot.get_chat(group_id)
+        chat = await chat_resolver.get_chat(bot, group_id)
         group_name = chat.title
     except Exception as e:
         print(f"Ошибка при получении информации о группе: {e}")
@@ -1094,7 +3658,7 @@ async def process_successful_group_payment(message: Message):
         )
         result = await cursor.fetchone()
         
-        if result and (end_date := datetime.fromisoformat(result[0])) > now:
+        if result and (end_date := parse_end_date(result[0])) > now:
             new_end_date = end_date + relativedelta(months=months)
         else:
             new_end_date = now + relativedelta(months=months)
@@ -1102,7 +3666,7 @@ async def process_successful_group_payment(message: Message):
         await db.execute('''
             INSERT OR REPLACE INTO premium_groups 
             (group_id, user_id, end_date) VALUES (?, ?, ?)
-        ''', (group_id, user_id, new_end_date.isoformat()))
+        ''', (group_id, user_id, int(new_end_date.timestamp())))
         
         if backup:
             settings = json.loads(backup[0])
@@ -1118,6 +3682,7 @@ async def process_successful_group_payment(message: Message):
                     INSERT OR REPLACE INTO group_modules 
                     (group_id, module_name, is_active) VALUES (?, ?, ?)
                 ''', (group_id, module_name, is_active))
+                await module_registry.set_enabled(group_id, module_name, bool(is_active))
             
             await db.execute('DELETE FROM group_settings_backup WHERE group_id = ?', (group_id,))
         
@@ -1144,10 +3709,6 @@ class FreePremiumStates(StatesGroup):
 
 @router.callback_query(lambda c: c.data.startswith("gfree_premium_"))
 async def free_premium_handler(callback: types.CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-
     data = callback.data.split("_")
     group_id = int(data[2])
     initiator_id = int(data[3])
@@ -1159,8 +3720,7 @@ async def free_premium_handler(callback: types.CallbackQuery, bot: Bot):
         return
 
     try:
-        member = await bot.get_chat_member(group_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await chat_resolver.is_admin(bot, group_id, user_id):
             await callback.answer("❌ Нужны права админа!", show_alert=True)
             return
 
@@ -1186,10 +3746,6 @@ async def free_premium_handler(callback: types.CallbackQuery, bot: Bot):
 
 @router.callback_query(lambda c: c.data.startswith("submit_tiktok_"))
 async def submit_tiktok_handler(callback: types.CallbackQuery, bot: Bot, state: FSMContext):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-
     data = callback.data.split("_")
     group_id = int(data[2])
     initiator_id = int(data[3])
@@ -1325,7 +3881,7 @@ async def process_views(message: types.Message, state: FSMContext, bot: Bot):
                 (group_id,)
             )
             result = await cursor.fetchone()
-            if result and (end_date := datetime.fromisoformat(result[0])) > now:
+            if result and (end_date := parse_end_date(result[0])) > now:
                 new_end_date = end_date + timedelta(days=days)
             else:
                 new_end_date = now + timedelta(days=days)
@@ -1333,7 +3889,7 @@ async def process_views(message: types.Message, state: FSMContext, bot: Bot):
             await db.execute('''
                 INSERT OR REPLACE INTO premium_groups 
                 (group_id, user_id, end_date) VALUES (?, ?, ?)
-            ''', (group_id, user_id, new_end_date.isoformat()))
+            ''', (group_id, user_id, int(new_end_date.timestamp())))
             
             await db.execute(
                 'UPDATE pending_free_premium_requests SET status = ? WHERE group_id = ? AND user_id = ? AND status = ?',
@@ -1362,13 +3918,13 @@ async def check_expired_group_premium(bot: Bot):
             cursor = await db.execute('''
                 SELECT group_id, user_id, end_date 
                 FROM premium_groups 
-                WHERE datetime(end_date) < datetime('now')
-            ''')
+                WHERE end_date < ?
+            ''', (int(time.time()),))
             expired_groups = await cursor.fetchall()
             
             for group_id, user_id, end_date in expired_groups:
                 try:
-                    chat = await bot.get_chat(group_id)
+                    chat = await chat_resolver.get_chat(bot, group_id)
                     group_name = chat.title
                     group_mention = f'<a href="tg://user?id={group_id}">{html.escape(group_name)}</a>'
                 except Exception as e:
@@ -1398,6 +3954,7 @@ async def check_expired_group_premium(bot: Bot):
                 
                 await db.execute('DELETE FROM group_config WHERE chat_id = ?', (group_id,))
                 await db.execute('DELETE FROM group_modules WHERE group_id = ?', (group_id,))
+                module_registry.clear(group_id)
                 await db.execute('DELETE FROM premium_groups WHERE group_id = ?', (group_id,))
                 
                 try:
@@ -1422,51 +3979,34 @@ async def check_expired_group_premium(bot: Bot):
 
 @router.message(lambda m: m.text and m.text.lower().strip().startswith(".cfg"))
 @router.message(Command("gpremium"))
-async def cmd_group_config(message: Message, bot: Bot):
-    user_id = message.from_user.id
-    first_name = html.escape(message.from_user.first_name)
-    chat_id = message.chat.id
+async def cmd_group_config(message: Message, bot: Bot, group_context: GroupContext):
+    user_id = group_context.user_id
+    first_name = group_context.first_name
+    chat_id = group_context.chat_id
     
-    if message.chat.type not in ["group", "supergroup"]:
+    if not group_context.is_group:
         return
     
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await group_context.is_admin():
             return
 
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT end_date FROM premium_groups WHERE group_id = ?',
-                (chat_id,)
-            )
-            result = await cursor.fetchone()
-            has_premium = result and datetime.fromisoformat(result[0]) > datetime.now()
-
-            response_chance = 1
-            if has_premium:
-                cursor = await db.execute(
-                    'SELECT response_chance FROM group_config WHERE chat_id = ?',
-                    (chat_id,)
-                )
-                config = await cursor.fetchone()
-                response_chance = config[0] if config else 1
+        has_premium = group_context.has_premium
+        response_chance = 1
+        if has_premium and group_context.response_chance:
+            response_chance = group_context.response_chance
 
-            text = (f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n ⚙️ Настройки группы\n\n"
-                   f"🔹 Premium статус: {'активен' if has_premium else 'не активен'}")
+        text = (f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n ⚙️ Настройки группы\n\n"
+               f"🔹 Premium статус: {'активен' if has_premium else 'не активен'}")
 
-            keyboard = await get_group_config_keyboard(chat_id, has_premium, response_chance, user_id)
-            await message.answer(text, reply_markup=keyboard)
+        keyboard = await get_group_config_keyboard(chat_id, has_premium, response_chance, user_id)
+        await message.answer(text, reply_markup=keyboard)
                 
     except Exception as e:
         await message.answer(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>, ⚠️ Упс, ошибка...")
 
 @router.callback_query(F.data.startswith("config_chance_"))
 async def chance_handler(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-    
     data = callback.data.split("_")
     chat_id = int(data[2])
     current_chance = int(data[3])
@@ -1483,8 +4023,7 @@ async def chance_handler(callback: CallbackQuery, bot: Bot):
         return
     
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status not in ["administrator", "creator"]:
+        if not await chat_resolver.is_admin(bot, chat_id, user_id):
             await callback.answer("❌ Нужны права админа!", show_alert=True)
             return
     except Exception as e:
@@ -1506,7 +4045,7 @@ async def chance_handler(callback: CallbackQuery, bot: Bot):
             (chat_id,)
         )
         result = await cursor.fetchone()
-        has_premium = result and datetime.fromisoformat(result[0]) > datetime.now()
+        has_premium = result and parse_end_date(result[0]) > datetime.now()
 
     try:
         keyboard = await get_group_config_keyboard(chat_id, has_premium, new_chance, initiator_id)
@@ -1520,6 +4059,42 @@ async def chance_handler(callback: CallbackQuery, bot: Bot):
         print(f"Ошибка при обновлении сообщения: {e}")
         await callback.answer("⚠️ Упс, ошибка...", show_alert=True)
 
+@router.callback_query(F.data.startswith("config_storage_"))
+async def storage_policy_handler(callback: CallbackQuery, bot: Bot):
+    data = callback.data.split("_")
+    chat_id = int(data[2])
+    initiator_id = int(data[3])
+    user_id = callback.from_user.id
+    first_name = html.escape(callback.from_user.first_name)
+
+    if user_id != initiator_id:
+        await callback.answer("❌ Не твоя кнопка!", show_alert=True)
+        return
+
+    try:
+        if not await chat_resolver.is_admin(bot, chat_id, user_id):
+            await callback.answer("❌ Нужны права админа!", show_alert=True)
+            return
+
+        policy, sample_rate = await storage_policies.get(chat_id)
+        new_policy = STORAGE_POLICIES[(STORAGE_POLICIES.index(policy) + 1) % len(STORAGE_POLICIES)]
+        await storage_policies.set(chat_id, new_policy, sample_rate)
+
+        response_chance, has_premium = await load_group_settings(chat_id)
+        if not has_premium or not response_chance:
+            response_chance = 1
+
+        keyboard = await get_group_config_keyboard(chat_id, has_premium, response_chance, initiator_id)
+        await callback.message.edit_text(
+            f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n ⚙️ Настройки группы\n\n"
+            f"🔹 Premium статус: {'активен' if has_premium else 'не активен'}",
+            reply_markup=keyboard
+        )
+        await callback.answer(f"✅ Хранение: {STORAGE_POLICY_LABELS[new_policy]}")
+    except Exception as e:
+        logging.error(f"Ошибка в storage_policy_handler: {e}")
+        await callback.answer("⚠️ Упс, ошибка...", show_alert=True)
+
 async def generate_modules_interface(
     group_id: int,
     initiator_id: int,
@@ -1529,17 +4104,9 @@ async def generate_modules_interface(
     first_name: str
 ) -> None:
     try:
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT module_name, is_active FROM group_modules WHERE group_id = ?',
-                (group_id,)
-            )
-            modules = await cursor.fetchall()
-            active_modules = {module[0]: module[1] for module in modules}
-
         buttons = []
         for module in available_modules:
-            status = "✅" if active_modules.get(module, 0) else "❌"
+            status = "✅" if module_registry.is_enabled(group_id, module) else "❌"
             buttons.append([
                 InlineKeyboardButton(
                     text=f"{html.escape(module)} {status}",
@@ -1571,10 +4138,6 @@ async def generate_modules_interface(
 
 @router.callback_query(lambda c: c.data.startswith("manage_modules_"))
 async def manage_modules_handler(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-    
     try:
         data = callback.data.split('_')
         group_id = int(data[2])
@@ -1591,8 +4154,7 @@ async def manage_modules_handler(callback: CallbackQuery, bot: Bot):
             return
 
         try:
-            member = await bot.get_chat_member(group_id, user_id)
-            if member.status not in ["administrator", "creator"]:
+            if not await chat_resolver.is_admin(bot, group_id, user_id):
                 await callback.answer("❌ Нужны права админа!", show_alert=True)
                 return
         except Exception as e:
@@ -1615,10 +4177,6 @@ async def manage_modules_handler(callback: CallbackQuery, bot: Bot):
 
 @router.callback_query(lambda c: c.data.startswith("toggle_module_"))
 async def toggle_module_handler(callback: CallbackQuery, bot: Bot):
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-    
     try:
         data = callback.data.split('_')
         group_id = int(data[2])
@@ -1636,28 +4194,27 @@ async def toggle_module_handler(callback: CallbackQuery, bot: Bot):
             return
 
         try:
-            member = await bot.get_chat_member(group_id, user_id)
-            if member.status not in ["administrator", "creator"]:
+            if not await chat_resolver.is_admin(bot, group_id, user_id):
                 await callback.answer("❌ Нужны права админа!", show_alert=True)
                 return
         except Exception as e:
             await callback.answer("⚠️ Упс, ошибка...", show_alert=True)
             return
 
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = ?',
-                (group_id, module_name)
-            )
-            result = await cursor.fetchone()
-            new_status = 1 - (result[0] if result else 0)
+        if module_name not in available_modules:
+            await callback.answer("⚠️ Упс, ошибка...", show_alert=True)
+            return
 
+        new_status = 0 if module_registry.is_enabled(group_id, module_name) else 1
+
+        async with aiosqlite.connect('database.db') as db:
             await db.execute('''
                 INSERT INTO group_modules (group_id, module_name, is_active)
                 VALUES (?, ?, ?)
                 ON CONFLICT(group_id, module_name) DO UPDATE SET is_active = excluded.is_active
             ''', (group_id, module_name, new_status))
             await db.commit()
+        await module_registry.set_enabled(group_id, module_name, bool(new_status))
 
         await generate_modules_interface(
             group_id=group_id,
@@ -1677,30 +4234,25 @@ async def toggle_module_handler(callback: CallbackQuery, bot: Bot):
         await callback.answer("⚠️ Упс, ошибка...", show_alert=True)
 
 @router.message(lambda m: m.text and m.text.startswith(".module"))
-async def handle_module_command(message: Message, bot: Bot):
+async def handle_module_command(message: Message, bot: Bot, group_context: GroupContext):
     try:
         await message.delete()
     except Exception as e:
         logging.error(f"Ошибка при удалении сообщения: {e}")
 
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    first_name = html.escape(message.from_user.first_name)
+    user_id = group_context.user_id
+    chat_id = group_context.chat_id
+    first_name = group_context.first_name
 
-    if message.chat.type not in ["group", "supergroup"]:
+    if not group_context.is_group:
         return
 
-    try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if not await check_group_premium_status(chat_id):
-            await message.answer(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n❌ Эта команда доступна только с Premium подпиской!")
-            return
-        
-        if member.status not in ["administrator", "creator"]:
-            await message.answer(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n❌ Нужны права админа!")
-            return
-    except Exception as e:
-        await message.answer("❌ Ошибка проверки прав.")
+    if not group_context.has_premium:
+        await message.answer(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n❌ Эта команда доступна только с Premium подпиской!")
+        return
+    
+    if not await group_context.is_admin():
+        await message.answer(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>,\n❌ Нужны права админа!")
         return
 
     args = message.text.split()[1:]
@@ -1732,29 +4284,13 @@ async def process_module_command(group_id: int, args: list) -> str:
         return "📦 Доступные модули:\n" + "\n".join(modules_list)
 
     if len(args) >= 2 and args[0] == '-a' and args[1] == '-ls':
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute('''
-                SELECT module_name FROM group_modules 
-                WHERE group_id = ? AND is_active = 1
-            ''', (group_id,))
-            active_modules = await cursor.fetchall()
-            
-            valid_active_modules = []
-            for module in active_modules:
-                if module[0] in available_modules:
-                    valid_active_modules.append(module[0])
-                else:
-                    await db.execute('''
-                        DELETE FROM group_modules 
-                        WHERE group_id = ? AND module_name = ?
-                    ''', (group_id, module[0]))
-                    await db.commit()
-            
-            if valid_active_modules:
-                active_modules_list = [f"{i+1}. <code>{html.escape(m)}</code>" 
-                                     for i, m in enumerate(valid_active_modules)]
-                return "✅ Активные модули:\n" + "\n".join(active_modules_list)
-            return "ℹ️ Нет активных модулей."
+        valid_active_modules = module_registry.enabled_modules(group_id)
+        
+        if valid_active_modules:
+            active_modules_list = [f"{i+1}. <code>{html.escape(m)}</code>" 
+                                 for i, m in enumerate(valid_active_modules)]
+            return "✅ Активные модули:\n" + "\n".join(active_modules_list)
+        return "ℹ️ Нет активных модулей."
 
     if args[0] == '-a' and len(args) >= 2:
         module_name = args[1]
@@ -1771,6 +4307,7 @@ async def process_module_command(group_id: int, args: list) -> str:
                 ON CONFLICT(group_id, module_name) DO UPDATE SET is_active = 1
             ''', (group_id, module_name))
             await db.commit()
+        await module_registry.set_enabled(group_id, module_name, True)
         return f"✅ Модуль <code>{html.escape(module_name)}</code> активирован."
 
     if args[0] == '-d' and len(args) >= 2:
@@ -1779,22 +4316,17 @@ async def process_module_command(group_id: int, args: list) -> str:
         if module_name not in available_modules:
             return f"❌ Модуль <code>{html.escape(module_name)}</code> не существует."
             
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute('''
-                SELECT 1 FROM group_modules 
-                WHERE group_id = ? AND module_name = ? AND is_active = 1
-            ''', (group_id, module_name))
-            exists = await cursor.fetchone()
+        if not module_registry.is_enabled(group_id, module_name):
+            return f"ℹ️ Модуль <code>{html.escape(module_name)}</code> и так не активен."
             
-            if not exists:
-                return f"ℹ️ Модуль <code>{html.escape(module_name)}</code> и так не активен."
-                
+        async with aiosqlite.connect('database.db') as db:
             await db.execute('''
                 UPDATE group_modules 
                 SET is_active = 0 
                 WHERE group_id = ? AND module_name = ?
             ''', (group_id, module_name))
             await db.commit()
+        await module_registry.set_enabled(group_id, module_name, False)
         return f"✅ Модуль <code>{html.escape(module_name)}</code> деактивирован."
 
     return "❌ Неверная команда. Используйте <code>.module help</code> для справки."
@@ -1857,28 +4389,17 @@ async def get_real_server_info():
         "russian_block_status": russian_block_status,
         "system": f"{system_info['system']} {system_info['release']} ({system_info['machine']})",
         "ram_usage": ram_usage,
-        "cpu_usage": f"{cpu_usage} ({cpu_count} ядер)",
-        "disk_usage": disk_usage,
-        "uptime": uptime_str,
-        "network_usage": network_usage
-    }
-
-@router.message(Command("ping", prefix="!/."))
-@router.message(F.text.lower().in_(["пинг", ".пинг", "бот", ".бот"]))
-async def ping_command(message: Message):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    first_name = message.from_user.first_name
-
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "ping"',
-            (chat_id,)
-        )
-        result = await cursor.fetchone()
-        
-    if not result or not result[0]:
-        return
+        "cpu_usage": f"{cpu_usage} ({cpu_count} ядер)",
+        "disk_usage": disk_usage,
+        "uptime": uptime_str,
+        "network_usage": network_usage
+    }
+
+@router.message(Command("ping", prefix="!/."), ModuleFilter("ping"))
+@router.message(F.text.lower().in_(["пинг", ".пинг", "бот", ".бот"]), ModuleFilter("ping"))
+async def ping_command(message: Message, group_context: GroupContext):
+    user_id = group_context.user_id
+    first_name = group_context.first_name
     
     start_time = time.time()
     msg = await message.answer("🏓 Измерение пинга и сбор системной информации...")
@@ -1908,18 +4429,30 @@ async def ping_command(message: Message):
     
     await msg.edit_text(response)
 
+LANGUAGES_CACHE_TTL = 3600
+languages_cache = {'languages': None, 'fetched_at': 0.0}
+
 async def get_supported_languages() -> Optional[List[Dict]]:
+    if languages_cache['languages'] and time.monotonic() - languages_cache['fetched_at'] < LANGUAGES_CACHE_TTL:
+        return languages_cache['languages']
+
     url = "https://emkc.org/api/v2/piston/runtimes"
     try:
         async with aiohttp.ClientSession() as session:
             async with session.get(url, timeout=10) as response:
                 if response.status == 200:
-                    return await response.json()
+                    languages_cache['languages'] = await response.json()
+                    languages_cache['fetched_at'] = time.monotonic()
+                    return languages_cache['languages']
                 return None
     except Exception as e:
         print(f"Error fetching languages: {e}")
         return None
 
+@module_registry.loader("pl")
+async def load_pl_module():
+    await get_supported_languages()
+
 async def execute_code(language: str, version: str, code: str) -> Optional[Dict]:
     url = "https://emkc.org/api/v2/piston/execute"
     payload = {
@@ -1945,17 +4478,9 @@ async def execute_code(language: str, version: str, code: str) -> Optional[Dict]
         print(f"Piston API exception: {str(e)}")
         return None
 
-@router.message(lambda m: m.text and m.text.startswith(".pl"))
+@router.message(lambda m: m.text and m.text.startswith(".pl"), ModuleFilter("pl"))
 async def pl_command_handler(message: Message, bot: Bot):
     chat_id = message.chat.id
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "pl"',
-            (chat_id,)
-        )
-        result = await cursor.fetchone()
-        if not result or not result[0]:
-            return
     try:
         await message.delete()
     except:
@@ -2124,31 +4649,17 @@ async def pl_command_handler(message: Message, bot: Bot):
             "<code>.pl langs</code> - список языков"
         )
 
-@router.callback_query(lambda c: c.data.startswith("pl_langs_"))
+@router.callback_query(lambda c: c.data.startswith("pl_langs_"), ModuleFilter("pl"))
 async def handle_langs_pagination(callback: CallbackQuery, bot: Bot):
     data = callback.data.split("_")
     chat_id = int(data[2])
     user_id = int(data[3])
     page = int(data[4])
 
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "pl"',
-            (chat_id,)
-        )
-        module_active = await cursor.fetchone()
-        
-        if not module_active or not module_active[0]:
-            return
-    
     if callback.from_user.id != user_id:
         await callback.answer("❌ Не твоя кнопка!", show_alert=True)
         return
     
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-    
     languages = await get_supported_languages()
     if not languages:
         await callback.answer("🚫 Не удалось получить список языков", show_alert=True)
@@ -2186,30 +4697,16 @@ async def handle_langs_pagination(callback: CallbackQuery, bot: Bot):
     )
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("pl_close_"))
+@router.callback_query(lambda c: c.data.startswith("pl_close_"), ModuleFilter("pl"))
 async def handle_close_menu(callback: CallbackQuery, bot: Bot):
     data = callback.data.split("_")
     chat_id = int(data[2])
     user_id = int(data[3])
     
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "pl"',
-            (chat_id,)
-        )
-        module_active = await cursor.fetchone()
-        
-        if not module_active or not module_active[0]:
-            return
-    
     if callback.from_user.id != user_id:
         await callback.answer("❌ Не твоя кнопка!", show_alert=True)
         return
     
-    if await check_flood(callback.from_user.id):
-        await callback.answer("⏳ Подождите немножечко", show_alert=False)
-        return
-    
     try:
         await callback.message.delete()
         await callback.answer("✅ Меню закрыто")
@@ -2249,34 +4746,19 @@ async def get_group_triggers(group_id: int) -> List[str]:
         return [row[0] for row in rows]
 
 
-@router.message(Command("triggers", prefix="."))
-async def handle_triggers_command(message: Message, bot: Bot):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    first_name = html.escape(message.from_user.first_name)
+@router.message(Command("triggers", prefix="."), ModuleFilter("triggers"))
+async def handle_triggers_command(message: Message, bot: Bot, group_context: GroupContext):
+    chat_id = group_context.chat_id
+    user_id = group_context.user_id
+    first_name = group_context.first_name
     
-    if message.chat.type not in ["group", "supergroup"]:
+    if not group_context.is_group:
         return
     
-    try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        if member.status not in ["administrator", "creator"]:
-            await message.reply(f"❌ <a href=\"tg://user?id={user_id}\">{first_name}</a>, нужны права админа!")
-            return
-    except Exception as e:
-        await message.reply("❌ Ошибка проверки прав.")
+    if not await group_context.is_admin():
+        await message.reply(f"❌ <a href=\"tg://user?id={user_id}\">{first_name}</a>, нужны права админа!")
         return
     
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "triggers"',
-            (chat_id,)
-        )
-        module_active = await cursor.fetchone()
-        
-        if not module_active or not module_active[0]:
-            return
-    
     args = message.text.split()[1:]
     
     if not args:
@@ -2323,35 +4805,118 @@ async def handle_triggers_command(message: Message, bot: Bot):
         )
         await message.reply(help_text)
         
-@router.message(Command("bansticker"))
-async def banstick_command(message: Message, bot: Bot):
-    await handle_ban_command(message, bot, ban_type="sticker")
+SEARCH_PAGE_SIZE = 5
+
+search_queries = ExpiringStore(ttl=900, max_size=10_000)
+
+def build_search_query(chat_id: int, query: str) -> str:
+    """Quote every word, so user input is matched literally instead of parsed as FTS5 syntax."""
+    words = ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+    return f"chat_tag:{search_chat_tag(chat_id)} AND message_text:({words})"
+
+async def search_history(chat_id: int, query: str, page: int) -> List[tuple]:
+    """(user_id, message_text, timestamp) of the page's matches plus one, to tell if a next page exists."""
+    paths = history_shards.paths_for(chat_id)
+    # With two files (mid-move) each is read from the top and the ranked results merged.
+    start = page * SEARCH_PAGE_SIZE if len(paths) == 1 else 0
+    rows = []
+    for path in paths:
+        async with aiosqlite.connect(path) as db:
+            cursor = await db.execute('''
+                SELECT h.id, bm25(message_fts) AS rank, h.user_id, h.message_text, h.timestamp
+                FROM message_fts
+                JOIN message_history h ON h.id = message_fts.rowid
+                WHERE message_fts MATCH ? AND h.chat_id = ?
+                ORDER BY rank
+                LIMIT ? OFFSET ?
+            ''', (build_search_query(chat_id, query), chat_id,
+                  (page + 1) * SEARCH_PAGE_SIZE + 1 - start, start))
+            rows.extend(await cursor.fetchall())
+    rows = sorted({row[0]: row for row in rows}.values(), key=lambda row: row[1])
+    return [row[2:] for row in rows[page * SEARCH_PAGE_SIZE - start:][:SEARCH_PAGE_SIZE + 1]]
+
+async def render_search_page(token: str, chat_id: int, user_id: int, query: str, page: int) -> tuple:
+    rows = await search_history(chat_id, query, page)
+    if not rows and page == 0:
+        return f"🔎 По запросу <code>{html.escape(query)}</code> ничего не найдено.", None
+
+    lines = []
+    for found_user_id, message_text, timestamp in rows[:SEARCH_PAGE_SIZE]:
+        text = message_codec.decode(message_text)
+        if len(text) > 200:
+            text = text[:200] + "…"
+        author = "Mimi" if found_user_id == 0 else f"<a href=\"tg://user?id={found_user_id}\">{found_user_id}</a>"
+        date = datetime.fromtimestamp(timestamp / 1000000).strftime('%d.%m.%Y %H:%M')
+        lines.append(f"• <i>{date}</i> {author}: {html.escape(text)}")
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"search_{token}_{page - 1}"))
+    if len(rows) > SEARCH_PAGE_SIZE:
+        nav_buttons.append(InlineKeyboardButton(text="▶️ Вперед", callback_data=f"search_{token}_{page + 1}"))
 
-@router.message(Command("banstickerpack"))
-async def banpack_command(message: Message, bot: Bot):
-    await handle_ban_command(message, bot, ban_type="pack")
+    text = (
+        f"🔎 <b>Результаты по запросу</b> <code>{html.escape(query)}</code> (страница {page + 1}):\n\n" +
+        "\n".join(lines)
+    )
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
 
-async def handle_ban_command(message: Message, bot: Bot, ban_type: str):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    first_name = html.escape(message.from_user.first_name)
+@router.message(Command("search", prefix="."), ModuleFilter("search"))
+async def search_command(message: Message, group_context: GroupContext):
+    if not group_context.is_group:
+        return
 
-    if message.chat.type not in ["group", "supergroup"]:
+    query = ' '.join(message.text.split()[1:]).strip()
+    if not query:
+        await message.reply("🔎 Использование: <code>.search [слова]</code>")
         return
 
-    member = await bot.get_chat_member(chat_id, user_id)
-    if member.status not in ["administrator", "creator"]:
-        await message.reply(f"❌ <a href=\"tg://user?id={user_id}\">{first_name}</a>, нужны права админа!")
+    token = uuid4().hex[:12]
+    search_queries.set(token, (group_context.chat_id, group_context.user_id, query), time.monotonic())
+    try:
+        text, keyboard = await render_search_page(token, group_context.chat_id, group_context.user_id, query, 0)
+    except Exception as e:
+        logging.error(f"Ошибка поиска в {group_context.chat_id}: {e}")
+        await message.reply("❌ Не удалось выполнить поиск.")
+        return
+    await message.reply(text, reply_markup=keyboard)
+
+@router.callback_query(lambda c: c.data.startswith("search_"), ModuleFilter("search"))
+async def search_pagination_handler(callback: CallbackQuery):
+    _, token, page = callback.data.split("_")
+    entry = search_queries.get(token, time.monotonic())
+    if entry is None:
+        await callback.answer("⌛ Поиск устарел, повторите запрос.", show_alert=True)
         return
 
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = ?',
-            (chat_id, 'bansticker')
-        )
-        result = await cursor.fetchone()
-        if not result or not result[0]:
-            return
+    chat_id, user_id, query = entry
+    if callback.from_user.id != user_id:
+        await callback.answer("❌ Не твоя кнопка!", show_alert=True)
+        return
+
+    text, keyboard = await render_search_page(token, chat_id, user_id, query, max(0, int(page)))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@router.message(Command("bansticker"), ModuleFilter("bansticker"))
+async def banstick_command(message: Message, bot: Bot, group_context: GroupContext):
+    await handle_ban_command(message, bot, group_context, ban_type="sticker")
+
+@router.message(Command("banstickerpack"), ModuleFilter("bansticker"))
+async def banpack_command(message: Message, bot: Bot, group_context: GroupContext):
+    await handle_ban_command(message, bot, group_context, ban_type="pack")
+
+async def handle_ban_command(message: Message, bot: Bot, group_context: GroupContext, ban_type: str):
+    chat_id = group_context.chat_id
+    user_id = group_context.user_id
+    first_name = group_context.first_name
+
+    if not group_context.is_group:
+        return
+
+    if not await group_context.is_admin():
+        await message.reply(f"❌ <a href=\"tg://user?id={user_id}\">{first_name}</a>, нужны права админа!")
+        return
 
     if not message.reply_to_message or not message.reply_to_message.sticker:
         await message.reply(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>, ответь на стикер для блокировки.")
@@ -2383,29 +4948,18 @@ async def handle_ban_command(message: Message, bot: Bot, ban_type: str):
             await message.reply(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>, стикерпак <code>{pack_name}</code> заблокирован.")
             await bot.delete_message(chat_id, message.reply_to_message.message_id)
 
-@router.message(Command("unsticker"))
-async def unstick_command(message: Message, bot: Bot):
-    chat_id = message.chat.id
-    user_id = message.from_user.id
-    first_name = html.escape(message.from_user.first_name)
+@router.message(Command("unsticker"), ModuleFilter("bansticker"))
+async def unstick_command(message: Message, bot: Bot, group_context: GroupContext):
+    user_id = group_context.user_id
+    first_name = group_context.first_name
 
-    if message.chat.type not in ["group", "supergroup"]:
+    if not group_context.is_group:
         return
 
-    member = await bot.get_chat_member(chat_id, user_id)
-    if member.status not in ["administrator", "creator"]:
+    if not await group_context.is_admin():
         await message.reply(f"❌ <a href=\"tg://user?id={user_id}\">{first_name}</a>, нужны права админа!")
         return
 
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = ?',
-            (chat_id, 'bansticker')
-        )
-        result = await cursor.fetchone()
-        if not result or not result[0]:
-            return
-
     args = message.text.split()[1:]
     if not args:
         await show_blocked_list(message, bot)
@@ -2483,6 +5037,88 @@ async def unblock_item(message: Message, bot: Bot, item_id: str):
 
     await message.reply(f"<a href=\"tg://user?id={user_id}\">{first_name}</a>, не найден заблокированный стикер.")
 
+HIDDEN_MESSAGE_TTL = 7 * 24 * 3600
+
+# Inline queries arrive on every keystroke, so drafts live only in memory, under their random token.
+# A row is written once the message is sent (chosen_inline_result, when inline feedback is enabled
+# in BotFather) or, without feedback, on its first reveal. The same draft keeps its token.
+HIDDEN_DRAFT_TTL = 24 * 3600
+hidden_drafts = ExpiringStore(ttl=HIDDEN_DRAFT_TTL, max_size=50_000)
+hidden_draft_tokens = ExpiringStore(ttl=HIDDEN_DRAFT_TTL, max_size=50_000)
+hidden_messages_cache = ExpiringStore(ttl=3600, max_size=10_000)
+
+def create_hidden_draft(creator_id: int, target_user_id: int, message_text: str) -> str:
+    """Keep a draft for an inline result and return its random reveal token. No I/O.
+
+    The token is random, so callback_data says nothing about the text.
+    """
+    now = time.monotonic()
+    draft_key = (creator_id, target_user_id, message_text)
+    message_id = hidden_draft_tokens.get(draft_key, now)
+    if message_id is not None and hidden_drafts.get(message_id, now) is not None:
+        return message_id
+
+    message_id = secrets.token_urlsafe(16)
+    hidden_drafts.set(message_id, (creator_id, target_user_id, message_text, int(time.time())), now)
+    hidden_draft_tokens.set(draft_key, message_id, now)
+    return message_id
+
+def store_hidden_message(message_id: str) -> Optional[tuple]:
+    """Persist a sent draft. Returns the stored message, or None if no such draft is pending."""
+    now = time.monotonic()
+    hidden = hidden_drafts.get(message_id, now)
+    if hidden is None:
+        return None
+    hidden_drafts.invalidate(message_id)
+    hidden_draft_tokens.invalidate(hidden[:3])
+    creator_id, target_user_id, message_text, created_at = hidden
+    db_writer.enqueue('''
+        INSERT OR IGNORE INTO hidden_messages (message_id, chat_id, creator_id, target_user_id, message_text, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (message_id, creator_id, creator_id, target_user_id, message_text, created_at))
+    hidden_messages_cache.set(message_id, hidden, now)
+    return hidden
+
+def forget_hidden_messages(user_id: int) -> None:
+    """Drop drafts and cached messages created by or addressed to ``user_id``."""
+    for key in [key for key in hidden_draft_tokens.items if user_id in key[:2]]:
+        hidden_draft_tokens.invalidate(key)
+    for store in (hidden_drafts, hidden_messages_cache):
+        for key, (_, hidden) in list(store.items.items()):
+            if user_id in hidden[:2]:
+                store.invalidate(key)
+
+async def get_hidden_message(message_id: str) -> Optional[tuple]:
+    now = time.monotonic()
+    hidden = hidden_messages_cache.get(message_id, now) or store_hidden_message(message_id)
+    if hidden is None:
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute(
+                'SELECT creator_id, target_user_id, message_text, created_at FROM hidden_messages WHERE message_id = ?',
+                (message_id,)
+            )
+            hidden = await cursor.fetchone()
+        if hidden is None:
+            return None
+        hidden_messages_cache.set(message_id, tuple(hidden), now)
+
+    if hidden[3] and time.time() - hidden[3] > HIDDEN_MESSAGE_TTL:
+        return None
+    return hidden
+
+async def cleanup_hidden_messages():
+    while True:
+        try:
+            async with aiosqlite.connect(DB_NAME) as db:
+                await db.execute(
+                    'DELETE FROM hidden_messages WHERE created_at < ?',
+                    (int(time.time()) - HIDDEN_MESSAGE_TTL,)
+                )
+                await db.commit()
+        except Exception as e:
+            logging.error(f"Ошибка очистки скрытых сообщений: {e}")
+        await asyncio.sleep(3600)
+
 class RegexpInlineQueryFilter(BaseFilter):
     def __init__(self, regexp: str, flags: int = 0):
         self.regexp = regexp
@@ -2523,13 +5159,7 @@ async def handle_inline_hide(inline_query: InlineQuery, bot: Bot, match: re.Matc
         )
         return
 
-    message_id = str(uuid4())
-    async with aiosqlite.connect('database.db') as db:
-        await db.execute('''
-            INSERT INTO hidden_messages (message_id, chat_id, creator_id, target_user_id, message_text)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (message_id, chat_id, creator_id, target_user_id, message_text))
-        await db.commit()
+    message_id = create_hidden_draft(creator_id, target_user_id, message_text)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💭 Раскрыть", callback_data=f"reveal_{message_id}")]
@@ -2547,32 +5177,30 @@ async def handle_inline_hide(inline_query: InlineQuery, bot: Bot, match: re.Matc
     
     await inline_query.answer([result], cache_time=1)
 
+@router.chosen_inline_result()
+async def handle_hidden_message_chosen(chosen: ChosenInlineResult):
+    store_hidden_message(chosen.result_id)
+
 @router.callback_query(lambda c: c.data.startswith("reveal_"))
 async def handle_reveal_callback(callback: CallbackQuery, bot: Bot):
-    message_id = callback.data.split("_")[1]
+    message_id = callback.data[len("reveal_"):]
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id if callback.message else user_id
 
-    async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT creator_id, target_user_id, message_text FROM hidden_messages WHERE message_id = ?',
-            (message_id,)
-        )
-        result = await cursor.fetchone()
-        
-        if not result:
-            await callback.answer("⚠️ Сообщение не найдено или удалено.", show_alert=True)
-            return
-        
-        creator_id, target_user_id, message_text = result
-        
-        if user_id not in [creator_id, target_user_id]:
-            await callback.answer("☠ Anti-Piracy Screen ☠\n\tYour information is being sent to the proper authorities.\n\tDo not attempt to turn on the button again.\n\tPiracy carries up to 10 years imprisonment and a 10,000 fine", show_alert=True)
-            return
+    hidden = await get_hidden_message(message_id)
+    if not hidden:
+        await callback.answer("⚠️ Сообщение не найдено или удалено.", show_alert=True)
+        return
+    
+    creator_id, target_user_id, message_text, _ = hidden
+    
+    if user_id not in [creator_id, target_user_id]:
+        await callback.answer("☠ Anti-Piracy Screen ☠\n\tYour information is being sent to the proper authorities.\n\tDo not attempt to turn on the button again.\n\tPiracy carries up to 10 years imprisonment and a 10,000 fine", show_alert=True)
+        return
 
-        await callback.answer(message_text, show_alert=True)
+    await callback.answer(message_text, show_alert=True)
 
-@router.message(F.sticker)
+@router.message(F.sticker, ModuleFilter("bansticker"))
 async def check_sticker(message: Message, bot: Bot):
     chat_id = message.chat.id
     sticker = message.sticker
@@ -2580,14 +5208,6 @@ async def check_sticker(message: Message, bot: Bot):
     pack_name = sticker.set_name
 
     async with aiosqlite.connect('database.db') as db:
-        cursor = await db.execute(
-            'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = ?',
-            (chat_id, 'bansticker')
-        )
-        result = await cursor.fetchone()
-        if not result or not result[0]:
-            return
-
         cursor = await db.execute(
             'SELECT 1 FROM blocked_stickers WHERE group_id = ? AND sticker_id = ?',
             (chat_id, sticker_id)
@@ -2609,29 +5229,54 @@ async def check_sticker(message: Message, bot: Bot):
 #==============================================================================================
 #==============================================================================================
 
+class MessageWindow:
+    __slots__ = ('timestamps', 'head', 'last_seen')
+
+    def __init__(self, size: int):
+        self.timestamps = array('d', [float('-inf')]) * size
+        self.head = 0
+        self.last_seen = float('-inf')
+
 class MessageTracker:
-    def __init__(self, message_limit: int = 3, time_window: int = 5):
+    def __init__(self, message_limit: int = 3, time_window: int = 5, sweep_interval: float = 60.0):
         self.message_limit = message_limit
         self.time_window = time_window
-        self.user_messages: Dict[int, deque] = {}
+        self.sweep_interval = sweep_interval
+        self.user_messages: Dict[int, MessageWindow] = {}
+        self.last_sweep = time.monotonic()
         
     def is_spam(self, user_id: int) -> bool:
-        if user_id not in self.user_messages:
-            self.user_messages[user_id] = deque()
-            
-        messages = self.user_messages[user_id]
-        current_time = datetime.now()
-        
-        while messages and (current_time - messages[0]) > timedelta(seconds=self.time_window):
-            messages.popleft()
-            
-        if len(messages) >= self.message_limit:
-            logger.warning(f"Spam detected from user {user_id}: {len(messages)} messages in {self.time_window} seconds")
+        current_time = time.monotonic()
+        if current_time - self.last_sweep >= self.sweep_interval:
+            self.sweep(current_time)
+
+        window = self.user_messages.get(user_id)
+        if window is None:
+            window = self.user_messages[user_id] = MessageWindow(self.message_limit)
+
+        # The slot under head holds the oldest of the last message_limit accepted messages.
+        if current_time - window.timestamps[window.head] <= self.time_window:
+            logger.warning(f"Spam detected from user {user_id}: {self.message_limit} messages in {self.time_window} seconds")
             return True
-            
-        messages.append(current_time)
+
+        window.timestamps[window.head] = current_time
+        window.head = (window.head + 1) % self.message_limit
+        window.last_seen = current_time
         return False
 
+    def sweep(self, current_time: Optional[float] = None) -> int:
+        if current_time is None:
+            current_time = time.monotonic()
+        self.last_sweep = current_time
+
+        idle_users = [
+            user_id for user_id, window in self.user_messages.items()
+            if current_time - window.last_seen > self.time_window
+        ]
+        for user_id in idle_users:
+            del self.user_messages[user_id]
+        return len(idle_users)
+
 class ConnectionPool:
     def __init__(self, api_key: str, pool_size: int = 5):
         self.api_key = api_key
@@ -2667,6 +5312,149 @@ class ConnectionPool:
                     return i, self.connections[i], lock
             await asyncio.sleep(0.1)
 
+DEFAULT_MAX_REPLY_LATENCY = 8.0
+
+class ReplyPlanner:
+    """Plans one end-to-end reply latency instead of stacking sleeps.
+
+    The target covers "thinking" plus typing time for the answer. Time spent
+    waiting for the backend counts towards it, so only the remainder is slept.
+    """
+
+    def __init__(self, min_delay: float = 3.0, max_delay: float = 5.0,
+                 min_typing_time: float = 1.5, char_delay: float = 0.05,
+                 typing_variability: float = 0.03,
+                 max_latency: float = DEFAULT_MAX_REPLY_LATENCY):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_typing_time = min_typing_time
+        self.char_delay = char_delay
+        self.typing_variability = typing_variability
+        self.max_latency = max_latency
+
+    def target_latency(self, response: Optional[str], max_latency: Optional[float] = None) -> float:
+        target = random.uniform(self.min_delay, self.max_delay)
+
+        if response:
+            typing_time = len(response) * (self.char_delay + random.uniform(-self.typing_variability, self.typing_variability))
+            words = len(response.split())
+            if words > 5:
+                typing_time += random.uniform(0.5, 1.5) * (words // 8)
+            target += max(self.min_typing_time, typing_time)
+        else:
+            target += self.min_typing_time
+
+        limit = self.max_latency if max_latency is None else max_latency
+        return max(0.0, min(target, limit))
+
+    async def wait_until_target(self, started_at: float, response: Optional[str],
+                                max_latency: Optional[float] = None) -> float:
+        target = self.target_latency(response, max_latency)
+        remaining = target - (time.monotonic() - started_at)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        return target
+
+async def get_group_max_latency(chat_id: int) -> Optional[float]:
+    async with aiosqlite.connect(DB_NAME) as db:
+        cursor = await db.execute(
+            'SELECT max_latency FROM group_latency WHERE chat_id = ?',
+            (chat_id,)
+        )
+        result = await cursor.fetchone()
+        return result[0] if result else None
+
+@router.message(Command("latency"))
+async def latency_command(message: Message):
+    """/latency <chat_id> [seconds|reset]"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+
+    args = message.text.split()[1:]
+    if not args:
+        await message.answer(
+            "⏱ Использование:\n"
+            "<code>/latency &lt;chat_id&gt;</code> - текущий лимит\n"
+            "<code>/latency &lt;chat_id&gt; &lt;секунды&gt;</code> - установить лимит\n"
+            "<code>/latency &lt;chat_id&gt; reset</code> - сбросить лимит\n\n"
+            f"По умолчанию: <code>{DEFAULT_MAX_REPLY_LATENCY}</code> сек."
+        )
+        return
+
+    try:
+        chat_id = int(args[0])
+    except ValueError:
+        await message.answer("❌ Некорректный ID группы.")
+        return
+
+    if len(args) == 1:
+        max_latency = await get_group_max_latency(chat_id)
+        current = max_latency if max_latency is not None else DEFAULT_MAX_REPLY_LATENCY
+        await message.answer(f"⏱ Лимит задержки для <code>{chat_id}</code>: <code>{current}</code> сек.")
+        return
+
+    async with aiosqlite.connect(DB_NAME) as db:
+        if args[1].lower() == "reset":
+            await db.execute('DELETE FROM group_latency WHERE chat_id = ?', (chat_id,))
+            await db.commit()
+            await message.answer(f"✅ Лимит задержки для <code>{chat_id}</code> сброшен.")
+            return
+
+        try:
+            max_latency = float(args[1])
+            if max_latency < 0:
+                raise ValueError
+        except ValueError:
+            await message.answer("❌ Некорректное число секунд.")
+            return
+
+        await db.execute('''
+            INSERT OR REPLACE INTO group_latency (chat_id, max_latency)
+            VALUES (?, ?)
+        ''', (chat_id, max_latency))
+        await db.commit()
+
+    await message.answer(f"✅ Лимит задержки для <code>{chat_id}</code>: <code>{max_latency}</code> сек.")
+
+class TypingManager:
+    """One "typing" loop per chat, shared by all replies in flight there."""
+
+    def __init__(self, refresh_interval: float = 4.5):
+        self.refresh_interval = refresh_interval
+        self.active_replies: Dict[int, int] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def start(self, bot: Bot, chat_id: int) -> None:
+        self.active_replies[chat_id] = self.active_replies.get(chat_id, 0) + 1
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self._typing_loop(bot, chat_id))
+
+    def stop(self, chat_id: int) -> None:
+        count = self.active_replies.get(chat_id, 0) - 1
+        if count > 0:
+            self.active_replies[chat_id] = count
+            return
+
+        self.active_replies.pop(chat_id, None)
+        task = self.tasks.pop(chat_id, None)
+        if task and not task.done():
+            task.cancel()
+
+    async def _typing_loop(self, bot: Bot, chat_id: int) -> None:
+        try:
+            while True:
+                try:
+                    await bot.send_chat_action(chat_id, ChatAction.TYPING)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Failed to send typing action to {chat_id}: {e}")
+                await asyncio.sleep(self.refresh_interval)
+        except asyncio.CancelledError:
+            pass
+
+typing_manager = TypingManager()
+
 class ChatManager:
     def __init__(self, api_key: str, char_id: str, pool_size: int = 5, 
                  min_delay: float = 3.0, max_delay: float = 5.0,
@@ -2675,18 +5463,13 @@ class ChatManager:
         self.pool = ConnectionPool(api_key, pool_size)
         self.user_chats: Dict[int, dict] = {}
         self.chat_locks: Dict[int, asyncio.Lock] = {}
-        self.min_delay = min_delay
-        self.max_delay = max_delay
+        self.planner = ReplyPlanner(min_delay, max_delay)
         self.message_tracker = MessageTracker(message_limit, time_window)
 
     async def send_message(self, user_id: int, message: str) -> str:
         if self.message_tracker.is_spam(user_id):
             logger.warning(f"Ignoring message from user {user_id} due to spam protection")
             return None
-            
-        delay = random.uniform(self.min_delay, self.max_delay)
-        logger.info(f"Waiting {delay:.1f} seconds before processing message for user {user_id}")
-        await asyncio.sleep(delay)
         
         if user_id not in self.chat_locks:
             self.chat_locks[user_id] = asyncio.Lock()
@@ -2739,84 +5522,96 @@ chat_manager = ChatManager(
     char_id='cYXxq0NFDa8lHhgtiAdv-9a534eDWbg-YiUtIfX7yoE'  # CHARACTER ID
 )
 
+class KnownEntities:
+    """IDs already stored in users / groups, seeded from the DB at startup."""
+
+    def __init__(self):
+        self.users: Set[int] = set()
+        self.groups: Set[int] = set()
+
+    async def load(self) -> None:
+        async with aiosqlite.connect(DB_NAME) as db:
+            cursor = await db.execute('SELECT user_id FROM users')
+            self.users = {row[0] for row in await cursor.fetchall()}
+            cursor = await db.execute('SELECT chat_id FROM groups')
+            self.groups = {row[0] for row in await cursor.fetchall()}
+        logger.info(f"Loaded {len(self.users)} known users and {len(self.groups)} known groups")
+
+    def forget_user(self, user_id: int) -> None:
+        self.users.discard(user_id)
+
+known_entities = KnownEntities()
+
+def ensure_user_exists(user_id: int, username: Optional[str]) -> None:
+    if user_id in known_entities.users:
+        return
+    known_entities.users.add(user_id)
+    db_writer.enqueue('''
+        INSERT OR IGNORE INTO users (user_id, username, joined_timestamp)
+        VALUES (?, ?, ?)
+    ''', (user_id, username, int(datetime.now().timestamp())))
+
 async def ensure_group_exists(chat_id: int, chat_title: str) -> None:
-    current_timestamp = int(datetime.now().timestamp())
-    
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('SELECT chat_id FROM groups WHERE chat_id = ?', (chat_id,))
-        existing_group = await cursor.fetchone()
-        
-        if not existing_group:
-            await db.execute('''
-                INSERT INTO groups 
-                (chat_id, message_count, joined_timestamp, title, is_active)
-                VALUES (?, 0, ?, ?, TRUE)
-            ''', (chat_id, current_timestamp, chat_title))
-            await db.commit()
+    if chat_id in known_entities.groups:
+        return
+
+    db_writer.enqueue('''
+        INSERT OR IGNORE INTO groups 
+        (chat_id, message_count, joined_timestamp, title, is_active)
+        VALUES (?, 0, ?, ?, TRUE)
+    ''', (chat_id, int(datetime.now().timestamp()), chat_title))
+    db_writer.enqueue(
+        'INSERT OR IGNORE INTO group_config (chat_id, response_chance) VALUES (?, ?)',
+        (chat_id, 1)
+    )
+    # message_count is incremented right after this, so the row has to exist first.
+    # Only mark the group known once that is committed, so a failed flush is retried.
+    await db_writer.flush()
+    known_entities.groups.add(chat_id)
+    logger.info(f"Добавлена новая группа в БД: {chat_title} (ID: {chat_id})")
 
 @router.message(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
-async def group_message_handler(message: types.Message, bot: Bot):
+async def group_message_handler(message: types.Message, bot: Bot, group_context: GroupContext):
     if not message.text:
         return
 
-    try:
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT 1 FROM groups WHERE chat_id = ?',
-                (message.chat.id,)
-            )
-            group_exists = await cursor.fetchone()
-            
-            if not group_exists:
-                await db.execute(
-                    '''INSERT INTO groups (chat_id, title, joined_timestamp) 
-                    VALUES (?, ?, ?)''',
-                    (message.chat.id, message.chat.title, int(time.time()))
-                )
-                await db.execute(
-                    'INSERT INTO group_config (chat_id, response_chance) VALUES (?, ?)',
-                    (message.chat.id, 1)
-                )
-                await db.commit()
-                logger.info(f"Добавлена новая группа в БД: {message.chat.title} (ID: {message.chat.id})")
+    started_at = time.monotonic()
 
+    try:
         await ensure_group_exists(message.chat.id, message.chat.title)
-        await save_message_history(message.chat.id, message.from_user.id, message.text)
-        await save_words(message.chat.id, message.text)
+        store_text = await storage_policies.should_store_text(message.chat.id)
+        reply_to = message.reply_to_message
+        # In forum topics every message "replies" to the topic's service message.
+        if reply_to and (reply_to.forum_topic_created or
+                         message.is_topic_message and reply_to.message_id == message.message_thread_id):
+            reply_to = None
+        target_user_id = None
+        if reply_to and reply_to.from_user and not reply_to.from_user.is_bot \
+                and reply_to.from_user.id != message.from_user.id:
+            target_user_id = reply_to.from_user.id
+        await save_message_history(
+            message.chat.id, message.from_user.id, message.text,
+            target_user_id=target_user_id, store_text=store_text
+        )
+        distinct_counters.add(message.chat.id, message.from_user.id, message.text if store_text else None)
+        if store_text:
+            await save_words(message.chat.id, message.text)
+            await word_frequencies.add(message.chat.id, message.text)
 
         stats = await get_group_stats(message.chat.id)
         
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT is_active FROM group_modules WHERE group_id = ? AND module_name = "triggers"',
-                (message.chat.id,)
-            )
-            triggers_module_active = await cursor.fetchone()
-            
-            triggers = standard_triggers.copy()
-            
-            if triggers_module_active and triggers_module_active[0]:
-                custom_triggers = await get_group_triggers(message.chat.id)
-                triggers.update(custom_triggers)
-            
-            cursor = await db.execute(
-                'SELECT response_chance FROM group_config WHERE chat_id = ?',
-                (message.chat.id,)
-            )
-            chance_row = await cursor.fetchone()
-            response_chance = chance_row[0]/100 if chance_row else 0.01
+        triggers = standard_triggers.copy()
+        
+        if group_context.has_module("triggers"):
+            custom_triggers = await get_group_triggers(message.chat.id)
+            triggers.update(custom_triggers)
+        
+        chance = group_context.response_chance
+        response_chance = chance/100 if chance is not None else 0.01
 
         message_words = set(message.text.lower().split())
         should_respond = any(trigger.lower() in message_words for trigger in triggers)
         is_reply_to_bot = message.reply_to_message and message.reply_to_message.from_user.id == message.bot.id
-        
-        async with aiosqlite.connect('database.db') as db:
-            cursor = await db.execute(
-                'SELECT response_chance FROM group_config WHERE chat_id = ?',
-                (message.chat.id,)
-            )
-            chance_row = await cursor.fetchone()
-            response_chance = chance_row[0]/100 if chance_row else 0.01
 
         random_response_chance = random.random() < response_chance
         
@@ -2828,70 +5623,14 @@ async def group_message_handler(message: types.Message, bot: Bot):
                 )
                 return
 
-            typing_task = None
+            typing_manager.start(message.bot, message.chat.id)
             try:
-                INITIAL_DELAY = random.uniform(0.3, 1.5)
-                MIN_TYPING_TIME = 1.5
-                BASE_CHAR_DELAY = 0.05
-                TYPING_VARIABILITY = 0.03
-                THINKING_PAUSE_CHANCE = 0.15
-                THINKING_PAUSE_DURATION = (0.8, 2.0)
-                
-                await asyncio.sleep(INITIAL_DELAY)
-
-                async def realistic_typing():
-                    try:
-                        last_action_time = time.time()
-                        while True:
-                            current_time = time.time()
-                            elapsed = current_time - last_action_time
-                            
-                            if random.random() < THINKING_PAUSE_CHANCE:
-                                pause = random.uniform(*THINKING_PAUSE_DURATION)
-                                await asyncio.sleep(pause)
-                                last_action_time = time.time()
-                                continue
-                            
-                            await message.bot.send_chat_action(message.chat.id, "typing")
-                            
-                            delay = random.uniform(2.5, 4.5)
-                            await asyncio.sleep(delay)
-                            last_action_time = time.time()
-                            
-                    except asyncio.CancelledError:
-                        pass
-
-                typing_task = asyncio.create_task(realistic_typing())
-                
-                start_time = time.time()
-                
                 response = await chat_manager.send_message(
                     user_id=message.from_user.id,
                     message=message.text
                 )
                 
-                if response:
-                    base_typing_time = len(response) * (BASE_CHAR_DELAY + random.uniform(-TYPING_VARIABILITY, TYPING_VARIABILITY))
-                    
-                    if len(response.split()) > 5:
-                        base_typing_time += random.uniform(0.5, 1.5) * (len(response.split()) // 8)
-                    
-                    typing_duration = max(MIN_TYPING_TIME, base_typing_time)
-                else:
-                    typing_duration = MIN_TYPING_TIME
-                
-                elapsed = time.time() - start_time
-                if elapsed < typing_duration:
-                    remaining_delay = typing_duration - elapsed
-                    
-                    while remaining_delay > 0:
-                        chunk = min(remaining_delay, random.uniform(0.7, 1.8))
-                        await asyncio.sleep(chunk)
-                        remaining_delay -= chunk
-                        
-                        if remaining_delay > 0.5 and random.random() < 0.3:
-                            await asyncio.sleep(random.uniform(0.2, 0.7))
-                            remaining_delay -= 0.7
+                await chat_manager.planner.wait_until_target(started_at, response, group_context.max_latency)
 
                 if response:
                     await save_message_history(
@@ -2901,10 +5640,7 @@ async def group_message_handler(message: types.Message, bot: Bot):
                         target_user_id=message.from_user.id
                     )
                     
-                    async with aiosqlite.connect(DB_NAME) as db:
-                        analysis_delay = random.uniform(0.4, 1.2)
-                        await asyncio.sleep(analysis_delay)
-                        
+                    async with aiosqlite.connect(history_shards.path_for(message.chat.id)) as db:
                         cursor = await db.execute('''
                             SELECT message_text 
                             FROM message_history 
@@ -2913,9 +5649,8 @@ async def group_message_handler(message: types.Message, bot: Bot):
                             ORDER BY timestamp DESC 
                             LIMIT 5
                         ''', (message.chat.id,))
-                        history = await cursor.fetchall()
+                        history = [message_codec.decode(row[0]) for row in await cursor.fetchall()]
 
-                    await asyncio.sleep(random.uniform(0.05, 0.3))
                     await message.reply(
                         text=html.escape(response)
                     )
@@ -2925,15 +5660,7 @@ async def group_message_handler(message: types.Message, bot: Bot):
             except Exception as e:
                     logger.error(f"Ошибка обработки: {str(e)}")
             finally:
-                if typing_task and not typing_task.done():
-                    typing_task.cancel()
-                    try:
-                        await typing_task
-                    except:
-                        pass
-                
-                await asyncio.sleep(0.1)
-                await message.bot.send_chat_action(message.chat.id, "cancel")
+                typing_manager.stop(message.chat.id)
 
     except Exception as e:
         error_id = str(uuid.uuid4())[:8]
@@ -2984,43 +5711,63 @@ async def private_message_handler(message: types.Message):
         ]
     )
     
-    current_timestamp = int(datetime.now().timestamp())
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, joined_timestamp)
-            VALUES (?, ?, ?)
-        ''', (message.from_user.id, message.from_user.username, current_timestamp))
-        await db.commit()
-
-    animation = FSInputFile("start.mp4")
-    
-    await message.answer_animation(
-        animation=animation,
-        caption=(
-            "🩷 Привет, дорогой! Меня зовут <b>Мими 🍼</b>, и я очень рада быть "
-            "добавленной в твою замечательную чат-группу.\n\n"
-            "Я могу отвечать на ваши сообщение таким образом, который <b>все будут любить!</b> 💕 \n\n"
-            "<i>PS: Вы автоматически подтвежаете с <a href='https://telegra.ph/Politika-Konfidencialnosti-i-Usloviya-Ispolzovaniya-03-27'>Условиями использования</a></i>"
-        ), reply_markup=keyboard
+    ensure_user_exists(message.from_user.id, message.from_user.username)
+
+    await media_registry.send(
+        "start.mp4",
+        lambda animation: message.answer_animation(
+            animation=animation,
+            caption=(
+                "🩷 Привет, дорогой! Меня зовут <b>Мими 🍼</b>, и я очень рада быть "
+                "добавленной в твою замечательную чат-группу.\n\n"
+                "Я могу отвечать на ваши сообщение таким образом, который <b>все будут любить!</b> 💕 \n\n"
+                "<i>PS: Вы автоматически подтвежаете с <a href='https://telegra.ph/Politika-Konfidencialnosti-i-Usloviya-Ispolzovaniya-03-27'>Условиями использования</a></i>"
+            ), reply_markup=keyboard
+        )
     )
 
 async def main():
     await init_db()
+    await run_migrations(blocking_only=True)
+    await history_shards.init()
+    await message_codec.load()
+    await module_registry.load()
+    await known_entities.load()
     bot = Bot(
         token="",
         default=DefaultBotProperties(parse_mode="HTML") 
     )
     
     asyncio.create_task(check_expired_group_premium(bot))
+    asyncio.create_task(cleanup_hidden_messages())
+    asyncio.create_task(db_writer.run())
+    asyncio.create_task(run_migrations())
+    asyncio.create_task(enforce_retention())
+    asyncio.create_task(history_shards.move_from_main())
+    asyncio.create_task(refresh_compression_dictionary())
+    asyncio.create_task(search_indexer.run())
+    asyncio.create_task(word_frequencies.run())
+    asyncio.create_task(distinct_counters.run())
+    asyncio.create_task(run_scheduled_backups())
+    await resume_user_purges(bot)
     dp = Dispatcher()
+    flood_middleware.register_commands(router)
+    dp.message.outer_middleware(flood_middleware)
+    dp.message.outer_middleware(group_context_middleware)
+    dp.callback_query.outer_middleware(flood_middleware)
     dp.include_router(router)
     await bot.delete_webhook(drop_pending_updates=True)
     
     try:
         await dp.start_polling(bot, 
             drop_pending_updates=True,
+            allowed_updates=dp.resolve_used_update_types(),
             timeout=30)
     finally:
+        await db_writer.flush()
+        await word_frequencies.flush()
+        await distinct_counters.flush()
+        await history_shards.close()
         await bot.session.close()
         await chat_manager.close()
 
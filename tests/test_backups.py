@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sqlite3
+
+import main
+
+
+def test_restore_brings_back_every_file_and_drops_in_memory_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shards = main.HistoryShards(2, str(tmp_path / 'history'))
+    monkeypatch.setattr(main, 'history_shards', shards)
+    monkeypatch.setattr(main, 'migrations_done', asyncio.Event())
+
+    def history_count(path):
+        with sqlite3.connect(path) as db:
+            return db.execute('SELECT COUNT(*) FROM message_history').fetchone()[0]
+
+    async def run():
+        await main.init_db()
+        await main.run_migrations()
+        await shards.init()
+        await main.save_message_history(4, 1, 'до бэкапа')
+        archive_path = await main.create_backup()
+
+        await main.save_message_history(4, 1, 'после бэкапа')
+        await main.word_frequencies.add(4, 'после бэкапа')
+        main.distinct_counters.add(4, 1, 'после бэкапа')
+        await main.restore_backup(os.path.basename(archive_path))
+        await asyncio.sleep(0)
+        return archive_path
+
+    asyncio.run(run())
+    assert history_count(shards.path_for(4)) == 1
+    with sqlite3.connect(main.DB_NAME) as db:
+        assert db.execute('SELECT COALESCE(SUM(message_count), 0) FROM daily_stats WHERE chat_id = 4').fetchone()[0] == 1
+    assert main.word_frequencies.entries == {}
+    assert main.distinct_counters.entries == {}
@@ -0,0 +1,25 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(scope='module')
+def middleware():
+    middleware = main.FloodControlMiddleware(
+        main.TokenBucketLimiter(capacity=3, refill_rate=1),
+        main.TokenBucketLimiter(capacity=20, refill_rate=5),
+        commands=main.FLOOD_TEXT_COMMANDS,
+        exact_commands=main.FLOOD_EXACT_COMMANDS
+    )
+    middleware.register_commands(main.router)
+    return middleware
+
+
+@pytest.mark.parametrize('text', ['/stats', '/stats@mimi_bot 7d', '.search кот', '!ping', '.пинг', 'бот', ' Пинг '])
+def test_commands_are_throttled(middleware, text):
+    assert middleware.is_command(text)
+
+
+@pytest.mark.parametrize('text', ['привет', 'бот, ты тут?', 'пинг понг', '...', '/unknown', '', None])
+def test_ordinary_messages_pass(middleware, text):
+    assert not middleware.is_command(text)
@@ -0,0 +1,65 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+
+import aiosqlite
+from aiogram.types import Chat, Message, User
+
+import main
+
+
+def make_message(chat_id: int, chat_type: str, first_name: str = 'Ann') -> Message:
+    return Message(
+        message_id=1,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=chat_type, title='group' if chat_id < 0 else None),
+        from_user=User(id=42, is_bot=False, first_name=first_name),
+        text='hello'
+    )
+
+
+def count_connections(monkeypatch) -> list:
+    opened = []
+    connect = aiosqlite.connect
+
+    def counting_connect(*args, **kwargs):
+        opened.append(args[0] if args else kwargs.get('database'))
+        return connect(*args, **kwargs)
+
+    monkeypatch.setattr(main.aiosqlite, 'connect', counting_connect)
+    return opened
+
+
+def test_group_update_costs_one_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    asyncio.run(main.init_db())
+    with sqlite3.connect(main.DB_NAME) as db:
+        db.execute('INSERT INTO group_config (chat_id, response_chance) VALUES (-100, 7)')
+        db.execute('INSERT INTO group_latency (chat_id, max_latency) VALUES (-100, 2.5)')
+    opened = count_connections(monkeypatch)
+    middleware = main.GroupContextMiddleware()
+    contexts = []
+
+    async def handler(event, data):
+        contexts.append(data['group_context'])
+
+    asyncio.run(middleware(handler, make_message(-100, 'supergroup', '<b>Ann</b>'), {'bot': None}))
+    asyncio.run(middleware(handler, make_message(42, 'private'), {'bot': None}))
+
+    group, private = contexts
+    assert len(opened) == 1 and middleware.db_round_trips == 1
+    assert group.is_group and group.response_chance == 7 and not group.has_premium
+    assert group.max_latency == 2.5 and private.max_latency is None
+    assert group.first_name == '&lt;b&gt;Ann&lt;/b&gt;'
+    assert not private.is_group and private.response_chance is None
+
+
+def test_disabled_module_filter_needs_no_io(monkeypatch):
+    opened = count_connections(monkeypatch)
+    monkeypatch.setattr(main.module_registry, 'group_masks', {-100: main.module_registry.bits['ping']})
+
+    ping = asyncio.run(main.ModuleFilter('ping')(make_message(-100, 'supergroup')))
+    search = asyncio.run(main.ModuleFilter('search')(make_message(-100, 'supergroup')))
+
+    assert (ping, search) == (True, False)
+    assert opened == []
@@ -0,0 +1,35 @@
+import asyncio
+import sqlite3
+
+import main
+
+
+def stored_rows() -> list:
+    with sqlite3.connect(main.DB_NAME) as db:
+        return db.execute('SELECT message_id, creator_id, target_user_id, message_text FROM hidden_messages').fetchall()
+
+
+def test_only_the_revealed_draft_is_written(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        await main.init_db()
+        tokens = [main.create_hidden_draft(1, 2, "привет"[:length]) for length in range(1, 7)]
+        assert main.create_hidden_draft(1, 2, "привет") == tokens[-1]
+        await main.db_writer.flush()
+        assert stored_rows() == []
+
+        hidden = await main.get_hidden_message(tokens[-1])
+        await main.db_writer.flush()
+        return tokens, hidden
+
+    tokens, hidden = asyncio.run(run())
+    assert len(set(tokens)) == len(tokens)
+    assert hidden[:3] == (1, 2, "привет")
+    assert stored_rows() == [(tokens[-1], 1, 2, "привет")]
+
+
+def test_purge_forgets_pending_drafts():
+    token = main.create_hidden_draft(7, 8, "секрет")
+    main.forget_hidden_messages(8)
+    assert main.store_hidden_message(token) is None
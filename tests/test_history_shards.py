@@ -0,0 +1,49 @@
+import asyncio
+import sqlite3
+
+import main
+
+INSERT_HISTORY = '''
+    INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
+    VALUES (?, ?, NULL, ?, ?)
+'''
+CHUNK_SQL = '''
+    SELECT id, timestamp FROM message_history
+    WHERE chat_id = ? AND (timestamp, id) > (?, ?)
+    ORDER BY timestamp, id
+    LIMIT ?
+'''
+
+
+def test_chat_is_read_from_both_files_until_its_move_is_done(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shards = main.HistoryShards(2, str(tmp_path / 'history'))
+    monkeypatch.setattr(main, 'history_shards', shards)
+    monkeypatch.setattr(main, 'migrations_done', asyncio.Event())
+
+    async def read_all():
+        return [row async for rows in shards.iter_chunks(4, CHUNK_SQL, (-1, -1), 3) for row in rows]
+
+    async def run():
+        await main.init_db()
+        await main.run_migrations()
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.executemany(INSERT_HISTORY, [(4, 1, f"old {i}", i * 2) for i in range(10)])
+        await shards.init()
+        # Half moved already, and one row caught in both files between a chunk's insert and delete.
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.execute('ATTACH DATABASE ? AS shard', (shards.path_for(4),))
+            db.execute('INSERT INTO shard.message_history SELECT * FROM main.message_history WHERE id <= 6')
+            db.execute('DELETE FROM main.message_history WHERE id <= 5')
+        await shards.insert(4, 2, None, 'new', 5)
+
+        during_move = await read_all()
+        assert shards.paths_for(4) == [main.DB_NAME, shards.path_for(4)]
+        await shards.move_from_main()
+        return during_move, await read_all()
+
+    during_move, after_move = asyncio.run(run())
+    assert shards.paths_for(4) == [shards.path_for(4)]
+    expected = sorted([(i + 1, i * 2) for i in range(10)] + [(11, 5)], key=lambda row: (row[1], row[0]))
+    assert during_move == expected
+    assert after_move == expected
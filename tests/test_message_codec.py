@@ -0,0 +1,38 @@
+import asyncio
+import sqlite3
+
+import main
+
+
+def test_prune_keeps_dictionaries_of_queued_fts_deletes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    codec = main.MessageCodec(True)
+    monkeypatch.setattr(main, 'message_codec', codec)
+
+    async def run():
+        await main.init_db()
+        await main.run_migrations()
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.executemany('INSERT INTO compression_dicts (id, data, created_at) VALUES (?, ?, 0)',
+                           [(1, b'old words'), (2, b'new words')])
+        await codec.load()
+        codec.current_id = 1
+        value = codec.encode('old words old words old words')
+        with sqlite3.connect(main.DB_NAME) as db:
+            # Indexed, then deleted: only the queued FTS delete still holds the encoded text.
+            db.execute('INSERT INTO message_history (chat_id, user_id, message_text, timestamp) VALUES (1, 1, ?, 1)',
+                       (value,))
+            db.execute('DELETE FROM search_index_queue')
+            db.execute('DELETE FROM message_history')
+        codec.current_id = 2
+        await codec.prune(await codec.referenced_ids())
+        return value
+
+    value = asyncio.run(run())
+    assert set(codec.dictionaries) == {0, 1, 2}
+    assert codec.decode(value) == 'old words old words old words'
+
+
+def test_decode_with_missing_dictionary_fails_soft():
+    codec = main.MessageCodec(True)
+    assert codec.decode((7).to_bytes(2, 'big') + b'\x00') == ''
@@ -0,0 +1,58 @@
+import main
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_tracker(monkeypatch, **kwargs):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, 'monotonic', clock)
+    return main.MessageTracker(**kwargs), clock
+
+
+def test_limit_within_window_is_spam(monkeypatch):
+    tracker, clock = make_tracker(monkeypatch, message_limit=3, time_window=5)
+    assert [tracker.is_spam(1) for _ in range(4)] == [False, False, False, True]
+    # Other users have their own window.
+    assert tracker.is_spam(2) is False
+    clock.now += 5.1
+    assert tracker.is_spam(1) is False
+
+
+def test_rejected_messages_do_not_extend_the_window(monkeypatch):
+    tracker, clock = make_tracker(monkeypatch, message_limit=2, time_window=5)
+    tracker.is_spam(1)
+    tracker.is_spam(1)
+    for _ in range(10):
+        clock.now += 0.4
+        assert tracker.is_spam(1) is True
+    clock.now += 1.1
+    assert tracker.is_spam(1) is False
+
+
+def test_sweep_evicts_idle_users(monkeypatch):
+    tracker, clock = make_tracker(monkeypatch, message_limit=3, time_window=5, sweep_interval=60)
+    for user_id in range(1000):
+        tracker.is_spam(user_id)
+    clock.now += 30
+    tracker.is_spam(5000)
+    assert len(tracker.user_messages) == 1001
+
+    clock.now += 31
+    tracker.is_spam(5001)
+    assert set(tracker.user_messages) == {5001}
+
+
+def test_window_storage_is_fixed_size(monkeypatch):
+    tracker, clock = make_tracker(monkeypatch, message_limit=3, time_window=5)
+    for _ in range(100):
+        clock.now += 10
+        tracker.is_spam(1)
+    window = tracker.user_messages[1]
+    assert len(window.timestamps) == 3
+    assert not hasattr(window, '__dict__')
@@ -0,0 +1,105 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+
+import main
+
+# message_history as init_db created it before migration 6, copied verbatim.
+OLD_HISTORY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS message_history (
+        chat_id INTEGER,
+        user_id INTEGER,
+        target_user_id INTEGER DEFAULT NULL,
+        message_text TEXT,
+        timestamp INTEGER,
+        PRIMARY KEY (chat_id, timestamp)
+    )
+'''
+INSERT_HISTORY = '''
+    INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+
+def test_history_rowid_key_keeps_rows_written_during_copy(tmp_path, monkeypatch):
+    """Migration 6 runs in the background: inserts that land mid-copy must all survive the swap."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'HISTORY_REKEY_CHUNK_SIZE', 500)
+    old_rows = [(i % 7, i % 13, None, f"old {i}", i) for i in range(20_000)]
+    with sqlite3.connect(main.DB_NAME) as db:
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(OLD_HISTORY_SCHEMA)
+        db.executemany(INSERT_HISTORY, old_rows)
+
+    async def run():
+        migrating = True
+        written = []
+
+        async def write(chat_id):
+            async with aiosqlite.connect(main.DB_NAME, timeout=30) as db:
+                while migrating:
+                    text = f"new {chat_id} {len(written)}"
+                    await db.execute(INSERT_HISTORY, (chat_id, 1, None, text, 10**9 + len(written)))
+                    await db.commit()
+                    written.append(text)
+                    await asyncio.sleep(0.005)
+
+        writers = [asyncio.create_task(write(chat_id)) for chat_id in range(4)]
+        async with aiosqlite.connect(main.DB_NAME) as db:
+            await main.migrate_history_rowid_key(db)
+            await db.commit()
+        migrating = False
+        await asyncio.gather(*writers)
+        return written
+
+    written = asyncio.run(run())
+
+    with sqlite3.connect(main.DB_NAME) as db:
+        texts = [row[0] for row in db.execute('SELECT message_text FROM message_history ORDER BY id')]
+        columns = [row[1] for row in db.execute('PRAGMA table_info(message_history)')]
+    assert written, "no writes happened while the migration was copying"
+    assert columns[0] == 'id'
+    assert texts[:len(old_rows)] == [row[3] for row in old_rows]
+    assert sorted(texts[len(old_rows):]) == sorted(written)
+
+
+def test_blocking_migrations_run_first_wherever_they_are_listed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    applied = []
+
+    def migration(version):
+        async def migrate(db):
+            applied.append(version)
+        return migrate
+
+    monkeypatch.setattr(main, 'MIGRATIONS', [
+        (1, 'blocking', migration(1), True),
+        (2, 'background', migration(2), False),
+        (3, 'background', migration(3), False),
+        (4, 'blocking', migration(4), True),
+    ])
+    monkeypatch.setattr(main, 'migrations_done', asyncio.Event())
+
+    async def run():
+        at_startup = await main.run_migrations(blocking_only=True)
+        in_background = await main.run_migrations()
+        again = await main.run_migrations()
+        return at_startup, in_background, again
+
+    assert asyncio.run(run()) == (1, 4, 4)
+    assert applied == [1, 4, 2, 3]
+
+
+def test_distinct_words_backfill_finishes_before_polling(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'migrations_done', asyncio.Event())
+
+    async def run():
+        await main.init_db()
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.executemany('INSERT INTO words (chat_id, word) VALUES (1, ?)', [(f'word{i}',) for i in range(100)])
+        await main.run_migrations(blocking_only=True)
+        return await main.distinct_counters.estimate(1, 'words')
+
+    assert 95 <= asyncio.run(run()) <= 105
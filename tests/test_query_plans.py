@@ -0,0 +1,100 @@
+import ast
+import asyncio
+import inspect
+import os
+import re
+import sqlite3
+import textwrap
+
+import pytest
+
+import main
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    """In-memory copy of the schema init_db and every migration produce."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('schema'))
+    try:
+        async def build():
+            await main.init_db()
+            await main.run_migrations()
+
+        asyncio.run(build())
+        memory = sqlite3.connect(':memory:')
+        with sqlite3.connect(main.DB_NAME) as source:
+            source.backup(memory)
+    finally:
+        os.chdir(cwd)
+    yield memory
+    memory.close()
+
+
+def queries(function) -> list:
+    """SQL literals inside a main.py function, so the plans are those of the statements the bot runs."""
+    tree = ast.parse(textwrap.dedent(inspect.getsource(function)))
+    return [
+        node.value for node in ast.walk(tree)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str)
+        and re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE)\b', node.value, re.IGNORECASE)
+    ]
+
+
+def query(function, marker: str) -> str:
+    matches = [sql for sql in queries(function) if marker in ' '.join(sql.split())]
+    assert len(matches) == 1, f"{function.__name__}: {len(matches)} queries contain {marker!r}"
+    return matches[0]
+
+
+def plan(db, sql: str) -> str:
+    numbered = [int(n) for n in re.findall(r'\?(\d+)', sql)]
+    count = max(numbered) if numbered else sql.count('?')
+    return '\n'.join(row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, (0,) * count))
+
+
+def test_user_message_count_uses_user_index(db):
+    sql = query(main.process_user_for_deletion, 'FROM message_history WHERE user_id = ?')
+    assert 'USING COVERING INDEX idx_message_history_user (user_id=?)' in plan(db, sql)
+
+
+def test_recent_bot_replies_use_chat_user_time_index(db):
+    sql = query(main.group_message_handler, 'AND user_id = 0')
+    result = plan(db, sql)
+    assert 'USING INDEX idx_message_history_chat_user_time (chat_id=? AND user_id=?)' in result
+    assert 'TEMP B-TREE' not in result
+
+
+def test_premium_expiry_seeks_end_date(db):
+    sql = query(main.check_expired_group_premium, 'WHERE end_date < ?')
+    assert 'USING INDEX idx_premium_groups_end_date (end_date<?)' in plan(db, sql)
+
+
+@pytest.mark.parametrize('table', ['blocked_stickers', 'blocked_packs'])
+def test_blocked_lists_are_read_in_index_order(db, table):
+    sql = query(main.show_blocked_list, f'FROM {table} ')
+    result = plan(db, sql)
+    assert f'USING INDEX idx_{table}_time (group_id=?)' in result
+    assert 'TEMP B-TREE' not in result
+
+
+@pytest.mark.parametrize('function', [main.iter_export_chunks, main.get_activity_heatmap, main.get_interaction_graph])
+def test_history_chunks_seek_by_row_value_keyset(db, function):
+    sql = query(function, '(timestamp, id) > (?, ?)')
+    result = plan(db, sql)
+    assert 'idx_message_history_chat_time (chat_id=? AND timestamp>?)' in result
+    assert 'TEMP B-TREE' not in result
+
+
+def test_search_is_driven_by_the_fts_index(db):
+    sql = query(main.search_history, 'WHERE message_fts MATCH ?')
+    result = plan(db, sql)
+    assert 'SCAN message_fts VIRTUAL TABLE INDEX' in result
+    assert 'SEARCH h USING INTEGER PRIMARY KEY (rowid=?)' in result
+
+
+@pytest.mark.parametrize('table, sql', main.PURGE_STEPS)
+def test_purge_steps_seek_an_index(db, table, sql):
+    result = plan(db, sql)
+    assert 'SCAN' not in result
+    assert re.search(rf'SEARCH {table} USING (COVERING )?INDEX \w+ \(\w+=\?\)', result), result
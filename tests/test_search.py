@@ -0,0 +1,45 @@
+import asyncio
+import sqlite3
+
+import main
+
+INSERT_HISTORY = '''
+    INSERT INTO message_history (chat_id, user_id, target_user_id, message_text, timestamp)
+    VALUES (?, ?, NULL, ?, ?)
+'''
+
+
+def test_search_finds_indexed_rows_of_one_chat_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        await main.init_db()
+        await main.run_migrations()
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.executemany(INSERT_HISTORY, [
+                (-100, 1, 'Привет, как дела?', 1),
+                (-100, 2, 'дела отлично', 2),
+                (-200, 3, 'у меня тоже дела', 3),
+                (-100, 4, 'совсем другое', 4),
+            ])
+        # Rows are only searchable once the indexer has drained the queue.
+        assert await main.search_history(-100, 'дела', 0) == []
+        await main.search_indexer.index_batch(main.DB_NAME)
+        found = await main.search_history(-100, 'дела', 0)
+
+        with sqlite3.connect(main.DB_NAME) as db:
+            db.execute('DELETE FROM message_history WHERE user_id = 2')
+        await main.search_indexer.index_batch(main.DB_NAME)
+        return found, await main.search_history(-100, 'дела', 0)
+
+    found, after_delete = asyncio.run(run())
+    assert sorted(row[0] for row in found) == [1, 2]
+    assert [row[0] for row in after_delete] == [1]
+
+
+def test_search_query_is_matched_literally():
+    fts_query = main.build_search_query(-100, 'a" OR chat_tag:c1 NEAR(')
+    assert fts_query.startswith(f"chat_tag:{main.search_chat_tag(-100)} AND ")
+    with sqlite3.connect(':memory:') as db:
+        db.execute('CREATE VIRTUAL TABLE t USING fts5(chat_tag, message_text)')
+        db.execute('SELECT * FROM t WHERE t MATCH ?', (fts_query,)).fetchall()
@@ -0,0 +1,31 @@
+import asyncio
+import sqlite3
+
+import aiosqlite
+
+import main
+
+
+def test_words_added_during_flush_are_flushed_next_time(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    tracker = main.WordFrequencyTracker()
+    executemany = aiosqlite.Connection.executemany
+
+    async def add_while_writing(self, sql, parameters):
+        if 'top_words' in sql:
+            await tracker.add(1, 'добавлено посреди записи')
+        return await executemany(self, sql, parameters)
+
+    async def run():
+        await main.init_db()
+        await main.run_migrations()
+        await tracker.add(1, 'первое сообщение')
+        monkeypatch.setattr(aiosqlite.Connection, 'executemany', add_while_writing)
+        await tracker.flush()
+        monkeypatch.setattr(aiosqlite.Connection, 'executemany', executemany)
+        await tracker.flush()
+
+    asyncio.run(run())
+    with sqlite3.connect(main.DB_NAME) as db:
+        words = {row[0] for row in db.execute('SELECT word FROM top_words WHERE chat_id = 1')}
+    assert {'первое', 'добавлено', 'посреди', 'записи'} <= words